@@ -0,0 +1,730 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import warnings
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+# Sizes of the synthetic inputs at every scale: stations, grid of the rasters (see GRIDS), years of
+# 30-minute precipitation, stations of the GPR search and cells per side of the precipitation cube
+SCALES = {'small': {'stations': 500, 'grid': '0p1', 'years': 1, 'gpr_stations': 200, 'cube_cells': 4},
+
+          'medium': {'stations': 5000, 'grid': '0p1', 'years': 5, 'gpr_stations': 500, 'cube_cells': 8},
+
+          'large': {'stations': 50000, 'grid': '1km', 'years': 20, 'gpr_stations': 1000, 'cube_cells': 16}}
+
+# Resolution in degrees of the global synthetic rasters
+GRIDS = {'0p1': 0.1, '1km': 1 / 120}
+
+NODATA = -9999
+
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October',
+
+          'November', 'December']
+
+
+def land_mask(lat, lon):
+
+    """
+    Returns a deterministic pseudo land mask, so that the rasters have no-data regions like the oceans.
+
+    Parameters:
+    lat, lon (numpy.ndarray): Coordinates in degrees.
+
+    Returns:
+    land (numpy.ndarray): True on land.
+    """
+
+    return (np.sin(np.radians(lon) * 3) * np.cos(np.radians(lat) * 2) + 0.3 * np.sin(np.radians(lat) * 7)) > -0.2
+
+
+def erosivity_field(lat, lon, seed):
+
+    """
+    Returns a smooth synthetic R-factor field with some small-scale texture.
+
+    Parameters:
+    lat, lon (numpy.ndarray): Coordinates in degrees.
+    seed (int): Variant of the field, e.g. one per product or month.
+
+    Returns:
+    values (numpy.ndarray): R-factor (MJ mm ha-1 h-1 yr-1).
+    """
+
+    phase = 0.7 * seed
+
+    return (2000 * (1.2 + np.sin(np.radians(lon) * 2 + phase) * np.cos(np.radians(lat)))
+
+            + 150 * np.sin(np.radians(lat) * 50 + phase) * np.cos(np.radians(lon) * 40))
+
+
+def synthetic_raster(path, grid, seed=0, categorical=False, strip_rows=256):
+
+    """
+    Writes a global synthetic GeoTIFF, strip by strip so that the 1 km grid never has to fit in memory.
+
+    Rasters are tiled and deflate-compressed like the published products. Continuous rasters hold
+    erosivity_field with NODATA outside land_mask, categorical ones Koppen-Geiger-like codes 1-30 with 0
+    outside land_mask.
+
+    Parameters:
+    path (str): Path of the GeoTIFF; it is not written again if it exists.
+    grid (str): Key of GRIDS.
+    seed (int): Variant of the field.
+    categorical (bool): Write class codes instead of erosivity.
+    strip_rows (int): Number of rows generated at once.
+
+    Returns:
+    path (str): Path of the GeoTIFF.
+    """
+
+    if os.path.exists(path):
+
+        return path
+
+    resolution = GRIDS[grid]
+
+    width, height = int(round(360 / resolution)), int(round(180 / resolution))
+
+    profile = {'driver': 'GTiff', 'width': width, 'height': height, 'count': 1, 'dtype': 'uint8' if categorical else 'float32',
+
+               'crs': 'EPSG:4326', 'transform': from_origin(-180, 90, resolution, resolution),
+
+               'nodata': 0 if categorical else NODATA, 'tiled': True, 'blockxsize': 256, 'blockysize': 256,
+
+               'compress': 'deflate', 'predictor': 2 if categorical else 3}
+
+    # Write to a temporary file first so an interrupted run never leaves a partial raster
+    tmp_path = f"{path[:-4]}.{os.getpid()}.tmp.tif"
+
+    lon = -180 + (np.arange(width) + 0.5) * resolution
+
+    with rasterio.open(tmp_path, 'w', **profile) as dst:
+
+        for row_off in range(0, height, strip_rows):
+
+            rows = min(strip_rows, height - row_off)
+
+            lat = 90 - (np.arange(row_off, row_off + rows) + 0.5) * resolution
+
+            lat_grid, lon_grid = np.meshgrid(lat, lon, indexing='ij')
+
+            land = land_mask(lat_grid, lon_grid)
+
+            if categorical:
+
+                codes = (np.floor((lat_grid + 90) / 6) * 7 + np.floor((lon_grid + 180) / 9) + seed) % 30 + 1
+
+                values = np.where(land, codes, 0).astype('uint8')
+
+            else:
+
+                values = np.where(land, erosivity_field(lat_grid, lon_grid, seed), NODATA).astype('float32')
+
+            dst.write(values, 1, window=Window(0, row_off, width, rows))
+
+    os.replace(tmp_path, path)
+
+    return path
+
+
+def synthetic_stations(path, n, seed=0):
+
+    """
+    Writes a synthetic station table with the columns of the filtered station data.
+
+    Stations lie on land_mask. R_Final follows erosivity_field with noise, and the GloRESatE, GloREDa and
+    GloREDa1.2 columns are noisy estimates of it.
+
+    Parameters:
+    path (str): Path of the CSV file; it is not written again if it exists.
+    n (int): Number of stations.
+    seed (int): Seed of the random generator.
+
+    Returns:
+    path (str): Path of the CSV file.
+    """
+
+    if os.path.exists(path):
+
+        return path
+
+    rng = np.random.default_rng(seed)
+
+    lat, lon = np.empty(0), np.empty(0)
+
+    # Rejection sampling of land points
+    while len(lat) < n:
+
+        candidate_lat, candidate_lon = rng.uniform(-60, 75, 2 * n), rng.uniform(-180, 180, 2 * n)
+
+        land = land_mask(candidate_lat, candidate_lon)
+
+        lat, lon = np.concatenate((lat, candidate_lat[land])), np.concatenate((lon, candidate_lon[land]))
+
+    lat, lon = lat[:n], lon[:n]
+
+    r_final = erosivity_field(lat, lon, 0) * rng.lognormal(0, 0.3, n)
+
+    df = pd.DataFrame({'Lat': lat, 'Lon': lon, 'R_Final': r_final,
+
+                       'Continent': np.array(['Africa', 'Asia', 'Europe', 'North America', 'Oceania',
+
+                                              'South America'])[(np.floor((lon + 180) / 60)).astype(int) % 6],
+
+                       'Country': [f"Country {code}" for code in (np.floor((lat + 90) / 10) * 36 + np.floor((lon + 180) / 10)).astype(int)]})
+
+    for column in ['GloRESatE', 'GloREDa', 'GloREDa1.2']:
+
+        df[column] = r_final * rng.lognormal(0, 0.25, n)
+
+    df.to_csv(path, index=False)
+
+    return path
+
+
+def synthetic_precipitation(path, years, seed=0):
+
+    """
+    Writes a synthetic 30-minute rainfall intensity series (mm/hour) for one grid cell as .npy.
+
+    Wet time steps come in clusters of a few hours, with gamma-distributed intensities.
+
+    Parameters:
+    path (str): Path of the .npy file; it is not written again if it exists.
+    years (int): Length of the series in years.
+    seed (int): Seed of the random generator.
+
+    Returns:
+    path (str): Path of the .npy file.
+    """
+
+    if os.path.exists(path):
+
+        return path
+
+    rng = np.random.default_rng(seed)
+
+    n_steps = years * 365 * 48
+
+    wet = np.convolve(rng.random(n_steps) < 0.01, np.ones(8), 'same') > 0
+
+    np.save(path, np.where(wet, rng.gamma(0.7, 6.0, n_steps), 0.0))
+
+    return path
+
+
+def synthetic_cube(path, series_path, cells):
+
+    """
+    Writes a (time, lat, lon) precipitation cube as .npy, cell by cell so that it never has to fit in memory.
+
+    Every cell holds the series of synthetic_precipitation rolled by a different number of time steps, so
+    that the cells do not share their storms.
+
+    Parameters:
+    path (str): Path of the .npy file; it is not written again if it exists.
+    series_path (str): Path of the series written by synthetic_precipitation.
+    cells (int): Number of rows and columns of the cube.
+
+    Returns:
+    path (str): Path of the .npy file.
+    """
+
+    if os.path.exists(path):
+
+        return path
+
+    series = np.load(series_path).astype('float32')
+
+    tmp_path = f"{path[:-4]}.{os.getpid()}.tmp.npy"
+
+    cube = np.lib.format.open_memmap(tmp_path, mode='w+', dtype='float32', shape=(len(series), cells, cells))
+
+    for cell in range(cells * cells):
+
+        cube[:, cell // cells, cell % cells] = np.roll(series, cell * 997)
+
+    cube.flush()
+
+    del cube
+
+    os.replace(tmp_path, path)
+
+    return path
+
+
+def synthetic_data(data_dir, scale):
+
+    """
+    Generates (or reuses) the synthetic inputs of a scale.
+
+    Parameters:
+    data_dir (str): Directory of the synthetic inputs, shared by all scales and runs.
+    scale (str): Key of SCALES.
+
+    Returns:
+    data (dict): Paths of the inputs: 'stations', 'raster', 'classes', 'months' (column name to path),
+                 'precipitation' and 'cube'.
+    """
+
+    os.makedirs(data_dir, exist_ok=True)
+
+    sizes = SCALES[scale]
+
+    grid = sizes['grid']
+
+    def path(name):
+
+        return os.path.join(data_dir, name)
+
+    precipitation = synthetic_precipitation(path(f"precipitation_{sizes['years']}y.npy"), sizes['years'])
+
+    cells = sizes['cube_cells']
+
+    return {'stations': synthetic_stations(path(f"stations_{sizes['stations']}.csv"), sizes['stations']),
+
+            'raster': synthetic_raster(path(f"GloRESatE_{grid}.tif"), grid, seed=1),
+
+            'classes': synthetic_raster(path(f"Koppen_{grid}.tif"), grid, categorical=True),
+
+            'months': {month: synthetic_raster(path(f"GloREDa_{month}_0p1.tif"), '0p1', seed=10 + index)
+
+                       for index, month in enumerate(MONTHS)},
+
+            'precipitation': precipitation,
+
+            'cube': synthetic_cube(path(f"cube_{sizes['years']}y_{cells}.npy"), precipitation, cells)}
+
+
+def case_idw_windowed(data, sizes):
+
+    # inverse_distance_weighted reading only the blocks around the stations
+    from MetricsCalculator import MetCalculator
+
+    df = pd.read_csv(data['stations'])
+
+    return lambda: MetCalculator().inverse_distance_weighted(df, data['raster'], 'GloRESatE', 0, windowed=True)
+
+
+def case_idw_full(data, sizes):
+
+    # inverse_distance_weighted reading the full band
+    from MetricsCalculator import MetCalculator
+
+    df = pd.read_csv(data['stations'])
+
+    return lambda: MetCalculator().inverse_distance_weighted(df, data['raster'], 'GloRESatE', 0)
+
+
+def case_sample_monthly(data, sizes):
+
+    # The twelve monthly rasters of GloREDa1.2 on the thread pool of sample_rasters
+    from MetricsCalculator import MetCalculator
+
+    df = pd.read_csv(data['stations'])
+
+    return lambda: MetCalculator().sample_rasters(df, data['months'], 0, windowed=True, n_workers=None)
+
+
+def case_sample_classes(data, sizes):
+
+    # Koppen-Geiger classes by 3x3 majority vote
+    from MetricsCalculator import MetCalculator, KOPPEN_GEIGER_CLASSES
+
+    df = pd.read_csv(data['stations'])
+
+    return lambda: MetCalculator().sample_classes(df, data['classes'], 'ClimateType', KOPPEN_GEIGER_CLASSES, method='majority')
+
+
+def case_sample_classes_nearest(data, sizes):
+
+    # Koppen-Geiger classes of the pixel of every station
+    from MetricsCalculator import MetCalculator, KOPPEN_GEIGER_CLASSES
+
+    df = pd.read_csv(data['stations'])
+
+    return lambda: MetCalculator().sample_classes(df, data['classes'], 'ClimateType', KOPPEN_GEIGER_CLASSES)
+
+
+def case_metrics(data, sizes):
+
+    # The single-dataset metrics ubrmse, nse and correlation
+    from MetricsCalculator import MetCalculator
+
+    df = pd.read_csv(data['stations'])
+
+    calculator = MetCalculator()
+
+    def run():
+
+        calculator.ubrmse(df['R_Final'], df['GloRESatE'])
+
+        calculator.nse(df['R_Final'], df['GloRESatE'])
+
+        calculator.correlation(df['R_Final'], df['GloRESatE'])
+
+    return run
+
+
+def case_grouped_metrics(data, sizes):
+
+    # Metrics per country in one pass
+    from MetricsCalculator import MetCalculator
+
+    df = pd.read_csv(data['stations'])
+
+    return lambda: MetCalculator().grouped_metrics(df['R_Final'], df['GloRESatE'], df['Country'])
+
+
+def case_bootstrap_intervals(data, sizes):
+
+    # Bootstrap confidence intervals of the metrics per continent
+    from MetricsCalculator import MetCalculator
+
+    df = pd.read_csv(data['stations'])
+
+    codes, continents = pd.factorize(df['Continent'])
+
+    return lambda: MetCalculator().bootstrap_intervals(df['R_Final'], df['GloRESatE'], codes, len(continents),
+
+                                                       n_resamples=1000, random_state=0)
+
+
+def case_raster_metrics(data, sizes):
+
+    # Metrics of GloRESatE against a GloREDa1.2 month over all pixels, per Koppen-Geiger zone; the 1 km
+    # rasters are resampled onto the 0.1 degree grid of the reference tile by tile
+    from MetricsCalculator import MetCalculator, KOPPEN_GEIGER_CLASSES
+
+    resampling = None if sizes['grid'] == '0p1' else 'average'
+
+    return lambda: MetCalculator().raster_metrics(data['months']['January'], data['raster'], 1, data['classes'],
+
+                                                  KOPPEN_GEIGER_CLASSES, resampling=resampling)
+
+
+def case_gpr_search(data, sizes):
+
+    # A short Bayesian search of the GPR hyperparameters
+    from GPR import GPRModel
+
+    df = pd.read_csv(data['stations']).iloc[:sizes['gpr_stations']]
+
+    def run():
+
+        model = GPRModel(df[['GloRESatE', 'GloREDa', 'GloREDa1.2']].values, df['R_Final'].values)
+
+        # Keep the printed hyperparameters out of the benchmark output
+        with redirect_stdout(io.StringIO()):
+
+            model.optimize_hyperparameters(init_points=10, n_iter=5, log_space=True, fixed_kernel=True)
+
+    return run
+
+
+def case_gpr_search_default(data, sizes):
+
+    # The same search with the default settings, run sequentially by BayesianOptimization.maximize
+    from GPR import GPRModel
+
+    df = pd.read_csv(data['stations']).iloc[:sizes['gpr_stations']]
+
+    def run():
+
+        model = GPRModel(df[['GloRESatE', 'GloREDa', 'GloREDa1.2']].values, df['R_Final'].values)
+
+        # The refitted kernels warn about the bounds of the synthetic data
+        with redirect_stdout(io.StringIO()), warnings.catch_warnings():
+
+            warnings.simplefilter('ignore')
+
+            model.optimize_hyperparameters(init_points=10, n_iter=5)
+
+    return run
+
+
+def case_erosivity30(data, sizes):
+
+    # Event segmentation and erosivity of the whole 30-minute series
+    from Erosivity import erosivity30
+
+    prc = np.load(data['precipitation'])
+
+    return lambda: erosivity30(prc)
+
+
+def case_event_stream(data, sizes):
+
+    # The same series fed to EventStream one month at a time
+    from Erosivity import EventStream, SETTINGS_30MIN
+
+    settings = dict(SETTINGS_30MIN)
+
+    scale = settings.pop('scale')
+
+    prc = np.load(data['precipitation']) * scale
+
+    def run():
+
+        stream = EventStream(**settings)
+
+        chunks = range(0, len(prc), 30 * 48)
+
+        for start in chunks:
+
+            stream.update(prc[start:start + 30 * 48], final=start == chunks[-1])
+
+    return run
+
+
+def case_rfactor_grid(data, sizes):
+
+    # R-factor rasters of the memory-mapped precipitation cube, in tiles on the process pool
+    from ErosivityGrid import rfactor_grid
+
+    cube = np.load(data['cube'], mmap_mode='r')
+
+    times = np.datetime64('2001-01-01') + np.arange(len(cube)) * np.timedelta64(30, 'm')
+
+    transform = from_origin(0, cube.shape[1], 1, 1)
+
+    output_prefix = os.path.join(os.path.dirname(data['cube']), f"rfactor_{sizes['cube_cells']}")
+
+    return lambda: rfactor_grid(cube, times, transform, 'EPSG:4326', output_prefix, tile_size=4)
+
+
+# Benchmark cases: name to (function returning the timed callable, scales on which it runs)
+CASES = {'idw_windowed': (case_idw_windowed, ('small', 'medium', 'large')),
+
+         'idw_full': (case_idw_full, ('small', 'medium')),
+
+         'sample_monthly': (case_sample_monthly, ('small', 'medium', 'large')),
+
+         'sample_classes': (case_sample_classes, ('small', 'medium', 'large')),
+
+         'sample_classes_nearest': (case_sample_classes_nearest, ('small', 'medium', 'large')),
+
+         'metrics': (case_metrics, ('small', 'medium', 'large')),
+
+         'grouped_metrics': (case_grouped_metrics, ('small', 'medium', 'large')),
+
+         'bootstrap_intervals': (case_bootstrap_intervals, ('small', 'medium', 'large')),
+
+         'raster_metrics': (case_raster_metrics, ('small', 'medium', 'large')),
+
+         'gpr_search': (case_gpr_search, ('small', 'medium', 'large')),
+
+         'gpr_search_default': (case_gpr_search_default, ('small',)),
+
+         'erosivity30': (case_erosivity30, ('small', 'medium', 'large')),
+
+         'event_stream': (case_event_stream, ('small', 'medium', 'large')),
+
+         'rfactor_grid': (case_rfactor_grid, ('small', 'medium'))}
+
+
+def time_case(name, scale, data, repeats=3, min_time=0.2):
+
+    """
+    Times one case and returns its record. Runs in a fresh process (see run_benchmarks).
+
+    Like timeit, every repeat calls the case as many times as needed to last at least min_time seconds,
+    and the time per call is recorded. The peak resident set size of the process is read at the end.
+
+    Parameters:
+    name (str): Key of CASES.
+    scale (str): Key of SCALES.
+    data (dict): Paths of the synthetic inputs (see synthetic_data).
+    repeats (int): Number of repeats.
+    min_time (float): Minimum duration of a repeat in seconds.
+
+    Returns:
+    record (dict): Case, scale, sizes, seconds per call of every repeat, min, median, number of calls per
+                   repeat, and the RSS after the setup and at the peak (MB).
+    """
+
+    sizes = SCALES[scale]
+
+    run = CASES[name][0](data, sizes)
+
+    # First call: warm-up, and the number of calls per repeat
+    start = time.perf_counter()
+
+    run()
+
+    number = max(1, int(np.ceil(min_time / max(time.perf_counter() - start, 1e-9))))
+
+    setup_rss = _peak_rss_mb()
+
+    seconds = []
+
+    for _ in range(repeats):
+
+        start = time.perf_counter()
+
+        for _ in range(number):
+
+            run()
+
+        seconds.append((time.perf_counter() - start) / number)
+
+    return {'case': name, 'scale': scale, 'sizes': sizes, 'seconds': seconds, 'min': min(seconds),
+
+            'median': float(np.median(seconds)), 'number': number, 'setup_rss_mb': setup_rss,
+
+            'peak_rss_mb': _peak_rss_mb()}
+
+
+def run_benchmarks(scales=('small', 'medium'), cases=None, data_dir='benchmark_data', output_json='benchmark.json',
+
+                   repeats=3):
+
+    """
+    Runs the benchmark cases on synthetic data and writes the results as JSON.
+
+    Every case runs in its own process, so its peak RSS is not inflated by the cases before it. The
+    synthetic inputs are generated once in data_dir and reused by later runs, and nothing is downloaded.
+    The results record the commit and the environment, so that runs of two commits can be compared with
+    compare_results.
+
+    Parameters:
+    scales (tuple): Keys of SCALES.
+    cases (list): Keys of CASES, None for all.
+    data_dir (str): Directory of the synthetic inputs.
+    output_json (str): Path of the results.
+    repeats (int): Number of repeats of every case.
+
+    Returns:
+    results (dict): The written results.
+    """
+
+    records = []
+
+    for scale in scales:
+
+        data = synthetic_data(data_dir, scale)
+
+        for name in cases or CASES:
+
+            if scale not in CASES[name][1]:
+
+                continue
+
+            # A new process for every case; the child imports this module by its file name
+            with ProcessPoolExecutor(max_workers=1) as executor:
+
+                record = executor.submit(time_case, name, scale, data, repeats).result()
+
+            print(f"{scale:>6} {name:<22} {record['median'] * 1000:10.2f} ms  peak RSS {record['peak_rss_mb']:8.1f} MB")
+
+            records.append(record)
+
+    results = {'commit': _git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+
+               'numpy': np.__version__, 'rasterio': rasterio.__version__, 'gdal': rasterio.__gdal_version__,
+
+               'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'results': records}
+
+    with open(output_json, 'w') as f:
+
+        json.dump(results, f, indent=1)
+
+    return results
+
+
+def compare_results(baseline_json, current_json, threshold=1.1):
+
+    """
+    Compares two result files case by case on the minimum time per call.
+
+    Parameters:
+    baseline_json (str): Results of the reference commit.
+    current_json (str): Results of the commit to check.
+    threshold (float): Ratio of current to baseline time above which a case counts as slower.
+
+    Returns:
+    comparison (pandas.DataFrame): Baseline and current times (s), their ratio and peak RSS per case and scale.
+    """
+
+    tables = []
+
+    for path in (baseline_json, current_json):
+
+        with open(path) as f:
+
+            records = json.load(f)['results']
+
+        tables.append(pd.DataFrame(records).set_index(['case', 'scale'])[['min', 'peak_rss_mb']])
+
+    comparison = tables[0].join(tables[1], lsuffix=' baseline', rsuffix=' current', how='inner')
+
+    comparison['ratio'] = comparison['min current'] / comparison['min baseline']
+
+    comparison['slower'] = comparison['ratio'] > threshold
+
+    return comparison
+
+
+def _peak_rss_mb():
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return peak / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+def _git_commit():
+
+    try:
+
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+
+    except (OSError, subprocess.CalledProcessError):
+
+        return None
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmarks of the hot paths on synthetic data.")
+
+    parser.add_argument('--scales', nargs='+', default=['small', 'medium'], choices=list(SCALES))
+
+    parser.add_argument('--cases', nargs='+', choices=list(CASES))
+
+    parser.add_argument('--data-dir', default='benchmark_data')
+
+    parser.add_argument('--output', default='benchmark.json')
+
+    parser.add_argument('--repeats', type=int, default=3)
+
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'), help="Compare two result files instead.")
+
+    args = parser.parse_args()
+
+    if args.compare:
+
+        print(compare_results(*args.compare).to_string())
+
+        return
+
+    run_benchmarks(args.scales, args.cases, args.data_dir, args.output, args.repeats)
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,266 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Event definitions of Erosivity30.m (30-minute satellite intensity in mm/hour)
+SETTINGS_30MIN = {'scale': 0.5, 'window': 12, 'run_threshold': 1.27, 'depth_threshold': 12.7,
+
+                  'peak_threshold': 12.7, 'intensity_factor': 2}
+
+# Event definitions of Erosivity60.m (hourly reanalysis intensity in m/hour)
+SETTINGS_60MIN = {'scale': 1000, 'window': 6, 'run_threshold': 0, 'depth_threshold': 12.7,
+
+                  'peak_threshold': 24.5, 'intensity_factor': 1}
+
+
+def erosive_events(prc, window, run_threshold, depth_threshold, peak_threshold, intensity_factor):
+
+    """
+    Identifies storm events in a precipitation series and computes their erosivity in a single linear pass.
+
+    The segmentation is the one of Erosivity30.m and Erosivity60.m: a storm is a run of time steps whose
+    centred moving sum over `window` steps exceeds `run_threshold`, extended by half a window on each side.
+    After a storm, the next one cannot use any time step of the previous event window. A storm is erosive
+    when its depth exceeds `depth_threshold` or its peak step exceeds `peak_threshold`, and its erosivity
+    follows the McGregor et al. (1995) kinetic energy equation.
+
+    Parameters:
+    prc (array-like): Precipitation depth per time step (mm).
+    window (int): Length of the moving-sum window in time steps (6 hours).
+    run_threshold (float): Moving-sum depth that a time step must exceed to belong to a storm (mm).
+    depth_threshold (float): Total storm depth above which the storm is erosive (mm).
+    peak_threshold (float): Single time step depth above which the storm is erosive (mm).
+    intensity_factor (float): Factor converting depth per time step to intensity (mm/hour).
+
+    Returns:
+    starts (numpy.ndarray): Index of the first time step of each event window.
+    ends (numpy.ndarray): Index of the last time step of each event window (inclusive).
+    ei (numpy.ndarray): Event erosivity (MJ mm ha-1 h-1), NaN for storms that are not erosive.
+    """
+
+    prc = np.asarray(prc, dtype="float").ravel()
+
+    starts, ends, _, _ = _segment(prc, window, run_threshold, cursor=0, final=True)
+
+    return starts, ends, event_erosivity(prc, starts, ends, depth_threshold, peak_threshold, intensity_factor)
+
+
+def _segment(prc, window, run_threshold, cursor, final):
+
+    # Event windows of the storms whose centre index is at or after `cursor`. Unless `final`, a run that
+    # reaches the last complete moving-sum window may still continue and is returned as `open_start`.
+    before = window // 2
+
+    after = window - before - 1
+
+    starts = []
+
+    ends = []
+
+    open_start = None
+
+    if len(prc) < window:
+
+        return np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64), cursor, open_start
+
+    # Moving sum centred like MATLAB movsum with 'Endpoints', 'fill'; windows containing NaN never qualify
+    result = sliding_window_view(prc, window).sum(axis=1)
+
+    idx = (result > run_threshold).astype(np.int8)
+
+    # Find start and end of sequences where the condition is met
+    edges = np.diff(np.concatenate(([0], idx, [0])))
+
+    run_starts = np.flatnonzero(edges == 1) + before
+
+    run_ends = np.flatnonzero(edges == -1) - 1 + before
+
+    last_centre = len(prc) - 1 - after
+
+    # A storm may not reuse time steps of the previous event window, which truncates or drops later runs
+    for run_start, run_end in zip(run_starts.tolist(), run_ends.tolist()):
+
+        run_start = max(run_start, cursor)
+
+        if run_start > run_end:
+
+            continue
+
+        if not final and run_end == last_centre:
+
+            open_start = run_start
+
+            break
+
+        starts.append(run_start - before)
+
+        ends.append(run_end + after)
+
+        cursor = run_end + window
+
+    return np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64), cursor, open_start
+
+
+class EventStream:
+
+    """
+    Incremental version of erosive_events for a series that arrives in consecutive chunks.
+
+    Only the boundary state needed to carry an open storm across chunk edges is kept: the time steps from
+    the start of the open event window (or the last incomplete moving-sum window) onwards and the position
+    before which no new storm may start. Feeding a series chunk by chunk and calling update with
+    final=True at the end gives exactly the events of erosive_events on the whole series.
+    """
+
+    def __init__(self, window, run_threshold, depth_threshold, peak_threshold, intensity_factor):
+
+        self.window = window
+
+        self.run_threshold = run_threshold
+
+        self.depth_threshold = depth_threshold
+
+        self.peak_threshold = peak_threshold
+
+        self.intensity_factor = intensity_factor
+
+        # Carried time steps, the absolute index of the first one, and the absolute cursor
+        self.tail = np.empty(0)
+
+        self.tail_start = 0
+
+        self.cursor = 0
+
+    def update(self, prc, final=False):
+
+        """
+        Adds the next chunk of the series and returns the storms that are complete.
+
+        Parameters:
+        prc (array-like): Precipitation depth per time step (mm) following the previous chunk.
+        final (bool): True for the last chunk, which closes any storm still open.
+
+        Returns:
+        starts, ends, ei (numpy.ndarray): As erosive_events, with indices counted from the start of the series.
+        """
+
+        buffer = np.concatenate((self.tail, np.asarray(prc, dtype="float").ravel()))
+
+        starts, ends, cursor, open_start = _segment(buffer, self.window, self.run_threshold,
+
+                                                    max(self.cursor - self.tail_start, 0), final)
+
+        ei = event_erosivity(buffer, starts, ends, self.depth_threshold, self.peak_threshold, self.intensity_factor)
+
+        before = self.window // 2
+
+        # Keep the open storm, or the time steps of moving-sum windows that are not complete yet
+        if final:
+
+            keep = len(buffer)
+
+        elif open_start is not None:
+
+            keep = open_start - before
+
+        else:
+
+            keep = min(len(buffer), max(0, len(buffer) - self.window + 1, cursor - before))
+
+        offset = self.tail_start
+
+        self.tail = buffer[keep:].copy()
+
+        self.tail_start = offset + keep
+
+        self.cursor = offset + cursor
+
+        return starts + offset, ends + offset, ei
+
+
+def event_erosivity(prc, starts, ends, depth_threshold, peak_threshold, intensity_factor):
+
+    """
+    Computes the erosivity of disjoint event windows of a precipitation series.
+
+    Parameters:
+    prc (numpy.ndarray): Precipitation depth per time step (mm).
+    starts (numpy.ndarray): Index of the first time step of each event window.
+    ends (numpy.ndarray): Index of the last time step of each event window (inclusive).
+    depth_threshold (float): Total storm depth above which the storm is erosive (mm).
+    peak_threshold (float): Single time step depth above which the storm is erosive (mm).
+    intensity_factor (float): Factor converting depth per time step to intensity (mm/hour).
+
+    Returns:
+    ei (numpy.ndarray): Event erosivity, NaN for storms that are not erosive.
+    """
+
+    if len(starts) == 0:
+
+        return np.empty(0)
+
+    # Keep only the event time steps, back to back
+    lengths = ends - starts + 1
+
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+
+    steps = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+
+    x = prc[steps]
+
+    depth = np.add.reduceat(x, offsets)
+
+    peak = np.maximum.reduceat(x, offsets)
+
+    # Unit kinetic energy of McGregor et al. (1995) times the depth of each time step
+    ev = x * (0.29 * (1 - 0.72 * np.exp(-0.082 * (x * intensity_factor))))
+
+    # Maximum intensity of each event
+    i30 = peak * intensity_factor
+
+    ei = np.add.reduceat(ev * np.repeat(i30, lengths), offsets)
+
+    # Storms below both thresholds are not erosive
+    ei[~((depth > depth_threshold) | (peak > peak_threshold))] = np.nan
+
+    return ei
+
+
+def _erosivity(Prc, scale, **settings):
+
+    # Scale the input to precipitation depth per time step
+    _, _, ei = erosive_events(np.asarray(Prc, dtype="float").ravel() * scale, **settings)
+
+    # Like the MATLAB functions, the series ends with NaN once no further storm is found
+    return np.append(ei, np.nan)
+
+
+def erosivity30(Prc):
+
+    """
+    Event-based rainfall erosivity from a 30-minute satellite series, equivalent to Erosivity30.m.
+
+    Parameters:
+    Prc (array-like): Rainfall intensity time series (mm/hour) for one grid cell.
+
+    Returns:
+    EI (numpy.ndarray): Erosivity of each storm in time order, NaN for storms that are not erosive,
+                        followed by a final NaN as in the MATLAB function.
+    """
+
+    return _erosivity(Prc, **SETTINGS_30MIN)
+
+
+def erosivity60(Prc):
+
+    """
+    Event-based rainfall erosivity from an hourly reanalysis series, equivalent to Erosivity60.m.
+
+    Parameters:
+    Prc (array-like): Rainfall intensity time series (m/hour) for one grid cell.
+
+    Returns:
+    EI (numpy.ndarray): Erosivity of each storm in time order, NaN for storms that are not erosive,
+                        followed by a final NaN as in the MATLAB function.
+    """
+
+    return _erosivity(Prc, **SETTINGS_60MIN)
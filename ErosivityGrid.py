@@ -0,0 +1,531 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+import copy
+import json
+import mmap
+import os
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from Erosivity import EventStream, SETTINGS_30MIN, SETTINGS_60MIN
+from PrecipitationReader import stream_array, stream_precipitation, grid_shape
+
+NODATA = -9999
+
+
+def calendar_index(times):
+
+    """
+    Converts time stamps to the year and month index used to aggregate event erosivity.
+
+    Parameters:
+    times (array-like): Time stamp of every time step (numpy.datetime64 compatible).
+
+    Returns:
+    years (numpy.ndarray): Calendar year of every time step.
+    months (numpy.ndarray): Month of every time step, 0 for January to 11 for December.
+    """
+
+    times = np.asarray(times, dtype="datetime64[s]")
+
+    years = times.astype("datetime64[Y]").astype(np.int64) + 1970
+
+    months = times.astype("datetime64[M]").astype(np.int64) % 12
+
+    return years, months
+
+
+class TileState:
+
+    """
+    Running erosivity aggregates of the cells of a tile, which can be saved and updated with new data.
+
+    For every cell the state holds the erosive event count, the EI sum of every calendar month and of
+    every year, whether the cell has any data, and the open storm carried by its EventStream. Event
+    erosivity is added to the sums one event at a time in time order, so updating a saved state with a
+    new period gives bit-for-bit the same sums as processing the whole period at once.
+    """
+
+    def __init__(self, shape, settings):
+
+        self.shape = tuple(shape)
+
+        self.settings = dict(settings)
+
+        n_cells = self.shape[0] * self.shape[1]
+
+        event_settings = {key: value for key, value in self.settings.items() if key != 'scale'}
+
+        self.streams = [EventStream(**event_settings) for _ in range(n_cells)]
+
+        self.event_count = np.zeros(n_cells, dtype=np.int64)
+
+        self.month_sum = np.zeros((12, n_cells))
+
+        self.years = np.empty(0, dtype=np.int64)
+
+        self.year_sum = np.zeros((0, n_cells))
+
+        self.has_data = np.zeros(n_cells, dtype=bool)
+
+        # Number of time steps processed and the calendar of the steps open storms may still need
+        self.n_steps = 0
+
+        self.carry_start = 0
+
+        self.carry_years = np.empty(0, dtype=np.int64)
+
+        self.carry_months = np.empty(0, dtype=np.int64)
+
+    def update(self, blocks, years, months):
+
+        """
+        Processes the time steps following the ones already in the state.
+
+        Parameters:
+        blocks (iterable): Consecutive time chunks of the tile, each of shape (time steps, rows, cols).
+        years (numpy.ndarray): Calendar year of every new time step.
+        months (numpy.ndarray): Month index (0-11) of every new time step.
+        """
+
+        new_years = np.setdiff1d(years, self.years)
+
+        if len(new_years):
+
+            self.years = np.concatenate((self.years, new_years))
+
+            self.year_sum = np.concatenate((self.year_sum, np.zeros((len(new_years), self.year_sum.shape[1]))))
+
+        # Calendar of the carried steps followed by the new ones, indexed from carry_start
+        calendar = (np.concatenate((self.carry_years, years)), np.concatenate((self.carry_months, months)))
+
+        for block in blocks:
+
+            block = block.reshape(len(block), -1) * self.settings['scale']
+
+            self.has_data |= ~np.isnan(block).all(axis=0)
+
+            for cell, stream in enumerate(self.streams):
+
+                self._add(cell, stream.update(block[:, cell]), calendar)
+
+        self.n_steps += len(years)
+
+        # Keep the calendar only from the first time step still carried by a stream
+        carry_start = min([stream.tail_start for stream in self.streams] + [self.n_steps])
+
+        self.carry_years = calendar[0][carry_start - self.carry_start:]
+
+        self.carry_months = calendar[1][carry_start - self.carry_start:]
+
+        self.carry_start = carry_start
+
+    def _add(self, cell, events, calendar):
+
+        starts, _, ei = events
+
+        erosive = ~np.isnan(ei)
+
+        steps = starts[erosive] - self.carry_start
+
+        ei = ei[erosive]
+
+        # Unbuffered adds accumulate the events one by one in time order
+        np.add.at(self.month_sum[:, cell], calendar[1][steps], ei)
+
+        np.add.at(self.year_sum[:, cell], np.searchsorted(self.years, calendar[0][steps]), ei)
+
+        self.event_count[cell] += len(ei)
+
+    def closed(self):
+
+        """
+        Returns a copy of the state in which the storms still open at the end of the data are closed.
+        """
+
+        state = copy.deepcopy(self)
+
+        calendar = (state.carry_years, state.carry_months)
+
+        for cell, stream in enumerate(state.streams):
+
+            state._add(cell, stream.update(np.empty(0), final=True), calendar)
+
+        return state
+
+    def climatology(self):
+
+        """
+        Mean annual and mean monthly R-factor over the years in the state, closing the open storms.
+
+        Returns:
+        annual (numpy.ndarray): Mean annual R-factor, shape (rows, cols), NaN for cells without data.
+        monthly (numpy.ndarray): Mean monthly R-factor, shape (12, rows, cols), NaN for cells without data.
+        """
+
+        state = self.closed()
+
+        n_years = len(state.years)
+
+        month_sum = state.month_sum.copy()
+
+        month_sum[:, ~state.has_data] = np.nan
+
+        monthly = (month_sum / n_years).reshape(12, *self.shape)
+
+        annual = (month_sum.sum(axis=0) / n_years).reshape(self.shape)
+
+        return annual, monthly
+
+    def save(self, path):
+
+        """
+        Saves the state, including the open storms, to an .npz file.
+
+        Parameters:
+        path (str): Path of the .npz file.
+        """
+
+        tails = [stream.tail for stream in self.streams]
+
+        np.savez(path, shape=self.shape, settings=json.dumps(self.settings), event_count=self.event_count,
+
+                 month_sum=self.month_sum, years=self.years, year_sum=self.year_sum, has_data=self.has_data,
+
+                 n_steps=self.n_steps, carry_start=self.carry_start, carry_years=self.carry_years,
+
+                 carry_months=self.carry_months, tail_lengths=[len(tail) for tail in tails],
+
+                 tails=np.concatenate(tails), tail_starts=[stream.tail_start for stream in self.streams],
+
+                 cursors=[stream.cursor for stream in self.streams])
+
+    @classmethod
+    def load(cls, path):
+
+        """
+        Loads a state saved with save.
+
+        Parameters:
+        path (str): Path of the .npz file.
+
+        Returns:
+        state (TileState): The loaded state.
+        """
+
+        with np.load(path) as saved:
+
+            state = cls(saved['shape'], json.loads(str(saved['settings'])))
+
+            for name in ('event_count', 'month_sum', 'years', 'year_sum', 'has_data', 'carry_years', 'carry_months'):
+
+                setattr(state, name, saved[name])
+
+            state.n_steps = int(saved['n_steps'])
+
+            state.carry_start = int(saved['carry_start'])
+
+            tails = np.split(saved['tails'], np.cumsum(saved['tail_lengths'])[:-1])
+
+            for stream, tail, tail_start, cursor in zip(state.streams, tails, saved['tail_starts'], saved['cursors']):
+
+                stream.tail, stream.tail_start, stream.cursor = tail, int(tail_start), int(cursor)
+
+        return state
+
+
+def tile_rfactor(blocks, shape, years, months, settings):
+
+    """
+    Computes the mean annual and mean monthly R-factor of every cell of a tile from streamed time chunks.
+
+    Each cell carries only the state of its open storm from one chunk to the next, so memory does not
+    depend on the length of the period. Events are assigned to the year and month of the first time
+    step of their event window.
+
+    Parameters:
+    blocks (iterable): Consecutive time chunks of the tile, each of shape (time steps, rows, cols).
+    shape (tuple): Number of rows and columns of the tile.
+    years (numpy.ndarray): Calendar year of every time step of the period.
+    months (numpy.ndarray): Month index (0-11) of every time step of the period.
+    settings (dict): Event definition, SETTINGS_30MIN or SETTINGS_60MIN.
+
+    Returns:
+    annual, monthly (numpy.ndarray): See TileState.climatology.
+    """
+
+    state = TileState(shape, settings)
+
+    state.update(blocks, years, months)
+
+    return state.climatology()
+
+
+def _memmap_spec(cube):
+
+    # File, byte offset, dtype and shape of a C-contiguous memory-mapped cube, None for other arrays
+    if not isinstance(cube, np.memmap) or cube.filename is None or cube.mode == 'c' or not cube.flags.c_contiguous:
+
+        return None
+
+    buffer = cube
+
+    while isinstance(buffer, np.ndarray):
+
+        buffer = buffer.base
+
+    if not isinstance(buffer, mmap.mmap):
+
+        return None
+
+    # np.memmap maps the file from the allocation boundary below its offset; slices keep the offset of the map
+    map_start = cube.offset - cube.offset % mmap.ALLOCATIONGRANULARITY
+
+    offset = map_start + cube.ctypes.data - np.frombuffer(buffer, dtype=np.uint8).ctypes.data
+
+    return {'filename': cube.filename, 'offset': int(offset), 'dtype': cube.dtype.str, 'shape': cube.shape}
+
+
+def _tile_source(cube, window):
+
+    row_off, col_off, height, width = window
+
+    # Files are passed by path so that workers read only their tile, one time chunk at a time
+    if not isinstance(cube, np.ndarray):
+
+        return cube
+
+    # Memory-mapped cubes are passed by file and offset for the same reason
+    spec = _memmap_spec(cube)
+
+    if spec is not None:
+
+        return spec
+
+    return np.ascontiguousarray(cube[:, row_off:row_off + height, col_off:col_off + width])
+
+
+def _tile_state_file(state_dir, window):
+
+    return os.path.join(state_dir, f"tile_{window[0]}_{window[1]}.npz")
+
+
+def _run_tile(source, window, variable, chunk_steps, years, months, settings, state_dir):
+
+    _, _, height, width = window
+
+    if isinstance(source, np.ndarray):
+
+        blocks = stream_array(source, chunk_steps)
+
+    elif isinstance(source, dict):
+
+        cube = np.memmap(source['filename'], dtype=source['dtype'], mode='r', offset=source['offset'],
+
+                         shape=tuple(source['shape']))
+
+        blocks = stream_array(cube, chunk_steps, window)
+
+    else:
+
+        blocks = stream_precipitation(source, chunk_steps, variable=variable, window=window)
+
+    state_file = _tile_state_file(state_dir, window) if state_dir else None
+
+    if state_file and os.path.exists(state_file):
+
+        state = TileState.load(state_file)
+
+    else:
+
+        state = TileState((height, width), settings)
+
+    state.update(blocks, years, months)
+
+    # The updated state only replaces the previous one once every tile has succeeded
+    if state_file:
+
+        state.save(state_file[:-4] + '.new.npz')
+
+    return window, state.climatology()
+
+
+def rfactor_grid(cube, times, transform, crs, output_prefix, settings=SETTINGS_30MIN, tile_size=16, n_workers=None,
+
+                 variable=None, chunk_steps=17520, state_dir=None):
+
+    """
+    Computes mean annual and mean monthly R-factor rasters from a (time, lat, lon) precipitation source.
+
+    The grid is split into spatial tiles that are processed on a process pool. File sources and memory-mapped
+    arrays (e.g. np.load(path, mmap_mode='r')) are streamed in chunks of `chunk_steps` time steps, so the
+    memory needed by each worker is bounded by chunk_steps x tile_size x tile_size values and does not grow
+    with the length of the period. In-memory arrays are not bounded this way: each worker receives a copy of
+    its tile over the whole period.
+    Tiles are written to the output rasters as soon as they are finished.
+
+    With `state_dir`, the running aggregates of every tile are persisted. A later call with the same
+    state_dir and only the data of the following period (e.g. a new year) updates the aggregates and
+    rewrites the mean rasters over all years covered, bit-for-bit equal to a full recompute.
+
+    Parameters:
+    cube (numpy.ndarray, str or list): Precipitation intensity cube of shape (time, lat, lon), or the path(s)
+                                       of .npy, NetCDF or HDF5 files holding consecutive time steps. NetCDF
+                                       and HDF5 files are read north up from their dimension scales, also
+                                       when stored as (time, lon, lat) as in IMERG.
+    times (array-like): Time stamp of every time step (numpy.datetime64 compatible).
+    transform (affine.Affine): Geotransform of the north-up grid.
+    crs (str or rasterio.crs.CRS): Coordinate reference system of the grid.
+    output_prefix (str): Prefix of the output rasters, e.g. 'IMERGFinalRun'.
+    settings (dict): Event definition, SETTINGS_30MIN (default) or SETTINGS_60MIN.
+    tile_size (int): Number of rows and columns of each tile.
+    n_workers (int): Number of worker processes, None for one per CPU and 1 to run in this process.
+    variable (str): Name of the precipitation variable for NetCDF and HDF5 files.
+    chunk_steps (int): Number of time steps read at once, one year of 30-minute data by default.
+    state_dir (str): Optional directory holding the persisted running aggregates.
+
+    Returns:
+    annual_tif (str): Path of the mean annual R-factor raster ('<prefix>_mean_<first>_<last>.tif').
+    monthly_tif (str): Path of the 12-band mean monthly R-factor raster ('<prefix>_monthly_mean_<first>_<last>.tif').
+    """
+
+    height, width = grid_shape(cube, variable)
+
+    times = np.asarray(times, dtype="datetime64[s]")
+
+    years, months = calendar_index(times)
+
+    covered = np.unique(years)
+
+    meta = {'shape': [int(height), int(width)], 'tile_size': tile_size, 'settings': dict(settings)}
+
+    if state_dir:
+
+        os.makedirs(state_dir, exist_ok=True)
+
+        meta_file = os.path.join(state_dir, 'climatology.json')
+
+        if os.path.exists(meta_file):
+
+            with open(meta_file) as f:
+
+                previous = json.load(f)
+
+            if {key: previous[key] for key in meta} != meta:
+
+                raise ValueError("The state was created for another grid, tile size or event definition.")
+
+            if times[0] <= np.datetime64(previous['last_time']):
+
+                raise ValueError(f"The state already covers the period up to {previous['last_time']}.")
+
+            covered = np.union1d(previous['years'], covered)
+
+        meta.update(years=covered.tolist(), last_time=str(times[-1]))
+
+    annual_tif = f"{output_prefix}_mean_{covered[0]}_{covered[-1]}.tif"
+
+    monthly_tif = f"{output_prefix}_monthly_mean_{covered[0]}_{covered[-1]}.tif"
+
+    profile = {'driver': 'GTiff', 'width': width, 'height': height, 'dtype': 'float32',
+
+               'crs': crs, 'transform': transform, 'nodata': NODATA}
+
+    windows = [(row_off, col_off, min(tile_size, height - row_off), min(tile_size, width - col_off))
+
+               for row_off in range(0, height, tile_size) for col_off in range(0, width, tile_size)]
+
+    with rasterio.open(annual_tif, 'w', count=1, **profile) as annual_dst, \
+            rasterio.open(monthly_tif, 'w', count=12, **profile) as monthly_dst:
+
+        def write(window, result):
+
+            row_off, col_off, tile_height, tile_width = window
+
+            annual, monthly = result
+
+            out_window = Window(col_off, row_off, tile_width, tile_height)
+
+            annual_dst.write(np.nan_to_num(annual, nan=NODATA).astype('float32'), 1, window=out_window)
+
+            monthly_dst.write(np.nan_to_num(monthly, nan=NODATA).astype('float32'), window=out_window)
+
+        if n_workers == 1:
+
+            for window in windows:
+
+                write(*_run_tile(_tile_source(cube, window), window, variable, chunk_steps, years, months,
+
+                                 settings, state_dir))
+
+        else:
+
+            n_workers = n_workers or os.cpu_count()
+
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+
+                # Keep only a few tiles in flight so that the parent never holds more than that
+                pending = set()
+
+                for window in windows:
+
+                    pending.add(executor.submit(_run_tile, _tile_source(cube, window), window, variable, chunk_steps,
+
+                                                 years, months, settings, state_dir))
+
+                    if len(pending) >= 2 * n_workers:
+
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                        for task in done:
+
+                            write(*task.result())
+
+                for task in as_completed(pending):
+
+                    write(*task.result())
+
+    if state_dir:
+
+        # Replace the previous state of all tiles together
+        for window in windows:
+
+            state_file = _tile_state_file(state_dir, window)
+
+            os.replace(state_file[:-4] + '.new.npz', state_file)
+
+        with open(meta_file, 'w') as f:
+
+            json.dump(meta, f)
+
+    return annual_tif, monthly_tif
+
+
+def main():
+
+    """
+    Main function to compute the IMERG and ERA5-Land R-factor rasters.
+    """
+
+    # 30-minute IMERG Final Run intensity (mm/hour) stacked as (time, lat, lon)
+    imerg_cube = 'path/to/IMERGFinalRun_2001_2020.npy'
+
+    imerg_times = np.arange('2001-01-01T00:00', '2021-01-01T00:00', 30, dtype='datetime64[m]')
+
+    rfactor_grid(imerg_cube, imerg_times, from_origin(-180, 90, 0.1, 0.1), 'EPSG:4326', 'IMERGFinalRun',
+
+                 settings=SETTINGS_30MIN)
+
+    # Hourly ERA5-Land intensity (m/hour) stacked as (time, lat, lon)
+    era5_cube = 'path/to/ERA5Land_2001_2020.npy'
+
+    era5_times = np.arange('2001-01-01T00', '2021-01-01T00', 1, dtype='datetime64[h]')
+
+    rfactor_grid(era5_cube, era5_times, from_origin(0, 90, 0.1, 0.1), 'EPSG:4326', 'ERA5Land',
+
+                 settings=SETTINGS_60MIN)
+
+
+if __name__ == "__main__":
+
+    main()
@@ -1,17 +1,332 @@
+from collections import OrderedDict
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+import hashlib
+import math
+import os
+import time
 import numpy as np
+import rasterio
+from rasterio.windows import Window
+from joblib import Parallel, delayed, effective_n_jobs
+from scipy.linalg import cholesky, cho_solve, solve_triangular
+from scipy.spatial.distance import cdist
+from sklearn.base import BaseEstimator, RegressorMixin, clone
 from sklearn.gaussian_process import GaussianProcessRegressor
 from sklearn.gaussian_process.kernels import RBF
-from sklearn.model_selection import train_test_split, KFold, cross_val_score
+from sklearn.model_selection import train_test_split, GroupKFold, KFold, cross_val_score
 from bayes_opt import BayesianOptimization
+from bayes_opt.acquisition import ConstantLiar, UpperConfidenceBound
 import pandas as pd
 from MetricsCalculator import MetCalculator
+from GridAlignment import raster_grid, read_aligned
+
+class SparseGPR(BaseEstimator, RegressorMixin):
+    
+    """
+    Sparse Gaussian Process Regression with inducing points (subset of regressors / DTC approximation).
+    
+    The training points are projected on n_inducing points drawn from the training set, which costs
+    O(n m^2) time and O(m^2) memory instead of the O(n^3) time and O(n^2) memory of the exact GP. The kernel
+    and the noise follow GaussianProcessRegressor: an RBF kernel with unit amplitude, alpha added to the
+    diagonal and a zero prior mean. With optimize_kernel, the length scale is fitted like the exact GP
+    does, by maximizing the marginal likelihood of an exact GP on the inducing points.
+    """
+    
+    def __init__(self, length_scale=1.0, alpha=1e-10, n_inducing=500, optimize_kernel=True, n_restarts_optimizer=10,
+                 
+                 chunk_size=10000, random_state=42):
+        
+        self.length_scale = length_scale
+        
+        self.alpha = alpha
+        
+        self.n_inducing = n_inducing
+        
+        self.optimize_kernel = optimize_kernel
+        
+        self.n_restarts_optimizer = n_restarts_optimizer
+        
+        self.chunk_size = chunk_size
+        
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        
+        X = np.asarray(X, dtype="float").reshape(len(X), -1)
+        
+        y = np.asarray(y, dtype="float").ravel()
+        
+        # Draw the inducing points from the training points
+        rng = np.random.RandomState(self.random_state)
+        
+        subset = rng.choice(len(X), min(self.n_inducing, len(X)), replace=False)
+        
+        self.inducing_points_ = X[subset]
+        
+        kernel = RBF(length_scale=self.length_scale)
+        
+        if self.optimize_kernel:
+            
+            gpr = GaussianProcessRegressor(kernel=kernel, alpha=self.alpha, n_restarts_optimizer=self.n_restarts_optimizer,
+                                           
+                                           random_state=self.random_state)
+            
+            kernel = gpr.fit(X[subset], y[subset]).kernel_
+        
+        self.kernel_ = kernel
+        
+        m = len(subset)
+        
+        # Cholesky factor of the inducing kernel matrix, with jitter for repeated points
+        self.L_ = cholesky(kernel(self.inducing_points_) + 1e-8 * np.eye(m), lower=True)
+        
+        # Accumulate A A^T and A y with A = L^-1 K_mn, chunk by chunk of training points
+        AAt = np.zeros((m, m))
+        
+        Ay = np.zeros(m)
+        
+        for start in range(0, len(X), self.chunk_size):
+            
+            A = solve_triangular(self.L_, kernel(self.inducing_points_, X[start:start + self.chunk_size]), lower=True)
+            
+            AAt += A @ A.T
+            
+            Ay += A @ y[start:start + self.chunk_size]
+        
+        self.Lb_ = cholesky(self.alpha * np.eye(m) + AAt, lower=True)
+        
+        self.weights_ = solve_triangular(self.L_.T, cho_solve((self.Lb_, True), Ay), lower=False)
+        
+        return self
+
+    def predict(self, X, return_std=False):
+        
+        X = np.asarray(X, dtype="float").reshape(len(X), -1)
+        
+        mean = np.empty(len(X))
+        
+        std = np.empty(len(X))
+        
+        for start in range(0, len(X), self.chunk_size):
+            
+            chunk = slice(start, start + self.chunk_size)
+            
+            K = self.kernel_(X[chunk], self.inducing_points_)
+            
+            mean[chunk] = K @ self.weights_
+            
+            if return_std:
+                
+                # DTC variance: k** - Q** + alpha * || Lb^-1 L^-1 K_m* ||^2
+                V = solve_triangular(self.L_, K.T, lower=True)
+                
+                W = solve_triangular(self.Lb_, V, lower=True)
+                
+                variance = self.kernel_.diag(X[chunk]) - (V ** 2).sum(axis=0) + self.alpha * (W ** 2).sum(axis=0)
+                
+                std[chunk] = np.sqrt(np.maximum(variance, 0))
+        
+        return (mean, std) if return_std else mean
+
+
+# Version of the saved model format, increased on incompatible changes
+ARTIFACT_VERSION = 1
+
+NODATA = -9999
+
+
+class GPRPredictor:
+    
+    """
+    Fitted exact or sparse GPR reduced to the arrays needed for prediction, which can be saved and loaded.
+    
+    Both models predict K(X, points) @ weights: for the exact GP the points are the training inputs and the
+    weights the alpha_ vector, for the sparse GP the points are the inducing points. The Cholesky factor of
+    the exact kernel matrix (or of the inducing kernel matrix and of the sparse system) is kept as well.
+    """
+    
+    def __init__(self, model, length_scale, alpha, points, weights, cholesky, cholesky_b=None, y_mean=0.0, y_std=1.0,
+                 
+                 features=()):
+        
+        self.model = model
+        
+        self.length_scale = length_scale
+        
+        self.alpha = alpha
+        
+        self.points = points
+        
+        self.weights = weights
+        
+        self.cholesky = cholesky
+        
+        self.cholesky_b = cholesky_b
+        
+        self.y_mean = y_mean
+        
+        self.y_std = y_std
+        
+        self.features = list(features)
+        
+        self.kernel = RBF(length_scale=length_scale)
+
+    @classmethod
+    def from_regressor(cls, gpr, features=()):
+        
+        """
+        Builds the predictor of a fitted GaussianProcessRegressor or SparseGPR.
+        
+        Parameters:
+        gpr (GaussianProcessRegressor or SparseGPR): Fitted regressor with an RBF kernel.
+        features (list): Optional names of the predictors, in the order of the columns of X.
+        """
+        
+        length_scale = np.atleast_1d(gpr.kernel_.length_scale).astype("float")
+        
+        if isinstance(gpr, SparseGPR):
+            
+            return cls('sparse', length_scale, gpr.alpha, gpr.inducing_points_, gpr.weights_, gpr.L_, gpr.Lb_,
+                       
+                       features=features)
+        
+        return cls('exact', length_scale, gpr.alpha, gpr.X_train_, gpr.alpha_.ravel(), gpr.L_,
+                   
+                   y_mean=float(np.ravel(gpr._y_train_mean)[0]), y_std=float(np.ravel(gpr._y_train_std)[0]), features=features)
+
+    def predict(self, X, return_std=False, chunk_size=4096):
+        
+        """
+        Predicts the mean, and optionally the standard deviation, in chunks of rows.
+        
+        The variance reuses the stored Cholesky factor instead of factorizing the kernel matrix again:
+        k(x, x) - ||L^-1 k(points, x)||^2 for the exact GP, plus the DTC correction for the sparse GP.
+        At most chunk_size x n_points kernel values are held at once.
+        
+        Parameters:
+        X (array-like): Predictors of shape (n, features).
+        return_std (bool): Also return the predictive standard deviation.
+        chunk_size (int): Number of rows predicted at once.
+        
+        Returns:
+        mean (numpy.ndarray): Predicted values.
+        std (numpy.ndarray): Predictive standard deviation, if return_std.
+        """
+        
+        X = np.asarray(X, dtype="float").reshape(len(X), -1)
+        
+        mean = np.empty(len(X))
+        
+        std = np.empty(len(X))
+        
+        for start in range(0, len(X), chunk_size):
+            
+            chunk = slice(start, start + chunk_size)
+            
+            K = self.kernel(X[chunk], self.points)
+            
+            mean[chunk] = K @ self.weights
+            
+            if return_std:
+                
+                V = solve_triangular(self.cholesky, K.T, lower=True, check_finite=False)
+                
+                variance = self.kernel.diag(X[chunk]) - (V ** 2).sum(axis=0)
+                
+                if self.cholesky_b is not None:
+                    
+                    W = solve_triangular(self.cholesky_b, V, lower=True, check_finite=False)
+                    
+                    variance += self.alpha * (W ** 2).sum(axis=0)
+                
+                std[chunk] = np.sqrt(np.maximum(variance, 0))
+        
+        mean = mean * self.y_std + self.y_mean
+        
+        return (mean, std * self.y_std) if return_std else mean
+
+    def save(self, path):
+        
+        """
+        Saves the predictor to a versioned .npz file, with the triangular factors stored as packed triangles.
+        
+        Parameters:
+        path (str): Path of the .npz file.
+        """
+        
+        arrays = {'version': ARTIFACT_VERSION, 'model': self.model, 'length_scale': self.length_scale, 'alpha': self.alpha,
+                  
+                  'points': self.points, 'weights': self.weights, 'cholesky': _pack(self.cholesky),
+                  
+                  'y_mean': self.y_mean, 'y_std': self.y_std, 'features': np.array(self.features, dtype=str)}
+        
+        if self.cholesky_b is not None:
+            
+            arrays['cholesky_b'] = _pack(self.cholesky_b)
+        
+        np.savez_compressed(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        
+        """
+        Loads a predictor saved with save.
+        
+        Parameters:
+        path (str): Path of the .npz file.
+        
+        Returns:
+        predictor (GPRPredictor): The loaded predictor.
+        """
+        
+        with np.load(path) as saved:
+            
+            if int(saved['version']) > ARTIFACT_VERSION:
+                
+                raise ValueError(f"{path} has model format version {int(saved['version'])}, "
+                                 
+                                 f"this code reads up to version {ARTIFACT_VERSION}.")
+            
+            n = len(saved['points'])
+            
+            m = len(saved['weights']) if 'cholesky_b' in saved else n
+            
+            return cls(str(saved['model']), saved['length_scale'], float(saved['alpha']), saved['points'], saved['weights'],
+                       
+                       _unpack(saved['cholesky'], m), _unpack(saved['cholesky_b'], m) if 'cholesky_b' in saved else None,
+                       
+                       float(saved['y_mean']), float(saved['y_std']), saved['features'].tolist())
+
 
 class GPRModel:
     
-    def __init__(self, X, y):
+    def __init__(self, X, y, n_inducing=None, locations=None, n_jobs=1):
+        
+        # Split data into training and testing sets, with the station locations (Lat, Lon, Continent, Country) if given
+        if locations is None:
+            
+            self.X_train, self.X_test, self.y_train, self.y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+            
+            self.locations_train = self.locations_test = None
+            
+        else:
+            
+            (self.X_train, self.X_test, self.y_train, self.y_test,
+             
+             self.locations_train, self.locations_test) = train_test_split(X, y, locations, test_size=0.2, random_state=42)
+        
+        # Cross-validation folds of the training set, random K-fold unless spatial_folds is used
+        self.folds = list(KFold(n_splits=5, shuffle=True, random_state=42).split(self.X_train))
+        
+        # Number of processes fitting the folds in gpr_cv
+        self.n_jobs = n_jobs
+        
+        # Number of inducing points of the sparse GP, None for the exact GP
+        self.n_inducing = n_inducing
         
-        # Split data into training and testing sets
-        self.X_train, self.X_test, self.y_train, self.y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+        # Keep the kernel hyperparameters as given instead of re-optimizing them in every fit
+        self.fixed_kernel = False
         
         # Initialize hyperparameters
         self.best_length_scale = None
@@ -20,54 +335,350 @@ class GPRModel:
         
         self.best_gpr = None
 
-    def gpr_cv(self, length_scale, alpha):
+    def regressor(self, length_scale, alpha, n_inducing=None, fixed_kernel=None):
+        
+        """
+        Returns an unfitted exact or sparse GPR with the given hyperparameters.
+        
+        Parameters:
+        length_scale (float): Length scale of the RBF kernel, the initial one unless fixed_kernel.
+        alpha (float): Value added to the diagonal of the kernel matrix.
+        n_inducing (int): Number of inducing points, defaults to the one of the model (None for the exact GP).
+        fixed_kernel (bool): Keep length_scale instead of optimizing it, defaults to the one of the model.
+        """
+        
+        n_inducing = self.n_inducing if n_inducing is None else n_inducing
+        
+        fixed_kernel = self.fixed_kernel if fixed_kernel is None else fixed_kernel
+        
+        if n_inducing:
+            
+            return SparseGPR(length_scale=length_scale, alpha=alpha, n_inducing=n_inducing, optimize_kernel=not fixed_kernel,
+                             
+                             n_restarts_optimizer=10, random_state=42)
         
         # Define the kernel with the given length_scale
         kernel = RBF(length_scale=length_scale)
         
+        if fixed_kernel:
+            
+            return GaussianProcessRegressor(kernel=kernel, alpha=alpha, optimizer=None)
+        
         # Initialize Gaussian Process Regressor with the given alpha
-        gpr = GaussianProcessRegressor(kernel=kernel, alpha=alpha, n_restarts_optimizer=10, random_state=42)
+        return GaussianProcessRegressor(kernel=kernel, alpha=alpha, n_restarts_optimizer=10, random_state=42)
+
+    def spatial_folds(self, by='block', block_size=5.0, n_splits=5):
+        
+        """
+        Replaces the random K-fold split of the training set by folds made of whole spatial groups, so that
+        neighbouring, autocorrelated stations are never split between training and validation.
+        
+        Parameters:
+        by (str): 'block' for Lat/Lon blocks of block_size degrees, or a column of the locations such as
+                  'Continent' or 'Country'.
+        block_size (float): Size of the Lat/Lon blocks in degrees.
+        n_splits (int): Number of folds, at most the number of groups; at least 2 groups are needed.
+        
+        Returns:
+        folds (list): (train, validation) indices of every fold, also used by gpr_cv and optimize_hyperparameters.
+        """
+        
+        if self.locations_train is None:
+            
+            raise ValueError("Spatial folds need the station locations, pass them to GPRModel.")
+        
+        locations = pd.DataFrame(self.locations_train)
+        
+        if by == 'block':
+            
+            # Block index of every station, longitudes wrapped to [-180, 180)
+            rows = np.floor((locations['Lat'].values + 90) / block_size)
+            
+            cols = np.floor(np.mod(locations['Lon'].values + 180, 360) / block_size)
+            
+            groups = rows * np.ceil(360 / block_size) + cols
+            
+        else:
+            
+            groups = locations[by].values
+        
+        n_groups = len(pd.unique(groups))
+        
+        if n_groups < 2:
+            
+            raise ValueError(f"Spatial folds need at least 2 groups, but all training stations fall in one group of '{by}'; "
+                             
+                             "use smaller blocks or another grouping.")
         
-        # Initialize K-Fold cross-validation
-        kf = KFold(n_splits=5, shuffle=True, random_state=42)
+        self.folds = list(GroupKFold(n_splits=min(n_splits, n_groups)).split(self.X_train, groups=groups))
         
-        # Compute cross-validation score
-        scores = cross_val_score(gpr, self.X_train, self.y_train, cv=kf, scoring='r2')
+        return self.folds
+
+    def gpr_cv(self, length_scale, alpha):
+        
+        # Exact or sparse GPR with the given hyperparameters
+        gpr = self.regressor(length_scale, alpha)
+        
+        # Compute cross-validation score on the random or spatial folds, fitting folds in parallel
+        scores = cross_val_score(gpr, self.X_train, self.y_train, cv=self.folds, scoring='r2', n_jobs=self.n_jobs)
         
         # Return the mean of the cross-validation scores
         return np.mean(scores)
 
-    def optimize_hyperparameters(self):
+    def optimize_hyperparameters(self, init_points=500, n_iter=20, n_jobs=1, batch_size=None, max_time=None, max_fits=None,
+                                 
+                                 halving=False, eta=3, log_space=False, fixed_kernel=False, length_scale_resolution=0.05):
+        
+        """
+        Searches length_scale and alpha by Bayesian optimization of the cross-validated R2 on the model folds.
+        
+        Candidates are evaluated in batches, one GP fit per candidate and fold, spread over n_jobs processes.
+        The random initial candidates form the first batch, and each following batch holds batch_size
+        points suggested by the optimizer (constant liar strategy). The search stops once max_time or
+        max_fits is reached, and the best parameters found so far are kept. With halving, every batch is
+        pruned by successive halving: all candidates are scored on 1 fold, the best 1/eta go on to eta
+        folds, and so on up to all folds.
+        
+        With log_space, the optimizer works on log10 of both parameters over the same range, so that every
+        decade is searched equally. With fixed_kernel, every candidate is evaluated with its own length_scale
+        instead of re-optimizing the kernel in each fit. For the exact GP, the candidates of a batch (or of a
+        halving rung) are then grouped by length scale and fold: a length scale shared by at least
+        _EIGEN_MIN_ALPHAS alphas gets the eigendecomposition of the fold kernel matrix, computed once and
+        reused for all of them and for later batches, the others one Cholesky factorization per alpha. The
+        length scales are rounded to length_scale_resolution decades so that nearby candidates share them.
+        
+        With the default settings (one process, no budget, halving, log_space or fixed_kernel), the search
+        runs sequentially through BayesianOptimization.maximize on gpr_cv, as in earlier versions, and
+        gives the same candidates and result.
+        
+        Parameters:
+        init_points (int): Number of random initial candidates.
+        n_iter (int): Number of candidates suggested by the optimizer.
+        n_jobs (int): Number of worker processes (-1 for all cores).
+        batch_size (int): Number of suggested candidates per batch, defaults to the number of workers.
+        max_time (float): Wall-clock budget in seconds.
+        max_fits (int): Budget in GP fits (one per candidate and fold).
+        halving (bool): Prune the worst candidates of each batch on partial folds.
+        eta (int): Reduction factor of successive halving.
+        log_space (bool): Search log10 of length_scale and alpha.
+        fixed_kernel (bool): Evaluate candidates with fixed kernel hyperparameters.
+        length_scale_resolution (float): Rounding of the length scale in decades when fixed_kernel, 0 for none.
+        """
+        
+        if log_space:
+            
+            pbounds = {'log_length_scale': (-5, 5), 'log_alpha': (-5, 5)}
+            
+        else:
+            
+            pbounds = {'length_scale': (1e-5, 1e5), 'alpha': (1e-5, 1e5)}
+        
+        self.fixed_kernel = fixed_kernel
+        
+        if (n_jobs == 1 and batch_size in (None, 1) and max_time is None and max_fits is None and not halving
+                
+                and not log_space and not fixed_kernel):
+            
+            # Define the optimizer for Bayesian optimization
+            optimizer = BayesianOptimization(f=self.gpr_cv, pbounds=pbounds, random_state=42)
+            
+            # Perform optimization
+            optimizer.maximize(init_points=init_points, n_iter=n_iter)
+            
+            self.search_history = pd.DataFrame([{**result['params'], 'score': result['target'], 'folds': len(self.folds)}
+                                                
+                                                for result in optimizer.res], columns=['length_scale', 'alpha', 'score', 'folds'])
+            
+            # Extract the best hyperparameters
+            self.best_length_scale = optimizer.max['params']['length_scale']
+            
+            self.best_alpha = optimizer.max['params']['alpha']
+            
+            print(f"Optimized length_scale: {self.best_length_scale}")
+            
+            print(f"Optimized alpha: {self.best_alpha}")
+            
+            return
+        
+        # Define the optimizer for Bayesian optimization, suggesting batches with a constant liar
+        acquisition = ConstantLiar(UpperConfidenceBound(kappa=2.576, random_state=42), random_state=42)
+        
+        optimizer = BayesianOptimization(f=None, pbounds=pbounds, acquisition_function=acquisition, random_state=42,
+                                         
+                                         verbose=0, allow_duplicate_points=True)
+        
+        # Same folds as gpr_cv
+        folds = self.folds
+        
+        X = np.asarray(self.X_train)
+        
+        y = np.asarray(self.y_train)
+        
+        # Fixed exact-GP kernels share fold distances and factors, identified by the training data and folds
+        if fixed_kernel and not self.n_inducing:
+            
+            digest = hashlib.sha1(X.tobytes() + y.tobytes())
+            
+            for _, test in folds:
+                
+                digest.update(np.asarray(test, dtype=np.int64).tobytes() + b'|')
+            
+            data_key = digest.hexdigest()
+            
+        else:
+            
+            data_key = None
+        
+        resolution = length_scale_resolution if data_key else 0
+        
+        budget = _Budget(max_time, max_fits)
+        
+        rng = np.random.RandomState(42)
+        
+        lows, highs = np.array(list(pbounds.values())).T
+        
+        candidates = [dict(zip(pbounds, rng.uniform(lows, highs))) for _ in range(init_points)]
         
-        # Define the optimizer for Bayesian optimization
-        optimizer = BayesianOptimization(
+        history = []
+        
+        n_suggested = 0
+        
+        with Parallel(n_jobs=n_jobs) as parallel:
             
-            f=self.gpr_cv,
+            batch_size = batch_size or effective_n_jobs(n_jobs)
             
-            pbounds={'length_scale': (1e-5, 1e5), 'alpha': (1e-5, 1e5)},
+            while candidates:
+                
+                params = [_candidate_params(point, log_space, resolution) for point in candidates]
+                
+                scores = self._cross_validate(parallel, params, X, y, folds, budget, halving, eta, data_key)
+                
+                for point, candidate, fold_scores in zip(candidates, params, scores):
+                    
+                    if fold_scores:
+                        
+                        optimizer.register(params=point, target=np.mean(fold_scores))
+                        
+                        history.append({**candidate, 'score': np.mean(fold_scores), 'folds': len(fold_scores)})
+                
+                if budget.exhausted() or n_suggested >= n_iter:
+                    
+                    break
+                
+                n_new = min(batch_size, n_iter - n_suggested)
+                
+                candidates = [optimizer.suggest() for _ in range(n_new)]
+                
+                n_suggested += n_new
+        
+        self.search_history = pd.DataFrame(history, columns=['length_scale', 'alpha', 'score', 'folds'])
+        
+        if not history:
             
-            random_state=42,
-        )
+            raise RuntimeError("The budget ended before any candidate was evaluated.")
+        
+        # Best candidate among the ones scored on the most folds
+        complete = self.search_history[self.search_history['folds'] == self.search_history['folds'].max()]
         
-        # Perform optimization
-        optimizer.maximize(init_points=500, n_iter=20)
+        best = complete.loc[complete['score'].idxmax()]
         
         # Extract the best hyperparameters
-        self.best_length_scale = optimizer.max['params']['length_scale']
+        self.best_length_scale = best['length_scale']
         
-        self.best_alpha = optimizer.max['params']['alpha']
+        self.best_alpha = best['alpha']
+        
+        if budget.exhausted():
+            
+            print(f"Search budget reached after {budget.fits} fits in {budget.elapsed():.1f} s.")
         
         print(f"Optimized length_scale: {self.best_length_scale}")
         
         print(f"Optimized alpha: {self.best_alpha}")
 
-    def train(self):
+    def _cross_validate(self, parallel, params, X, y, folds, budget, halving, eta, data_key=None):
+        
+        # Fold scores of every candidate, stopping on the budget and pruning when halving
+        scores = [[] for _ in params]
+        
+        active = list(range(len(params)))
+        
+        rung = 1 if halving else len(folds)
         
-        # Define the kernel with the optimized length_scale
-        kernel = RBF(length_scale=self.best_length_scale)
+        while active:
+            
+            tasks = [(i, fold) for i in active for fold in range(len(scores[i]), rung)]
+            
+            if data_key:
+                
+                # Group the tasks of the whole rung by length scale and fold, so that every group holds all the
+                # alphas that can share the fold factors of its length scale
+                groups = {}
+                
+                for i, fold in tasks:
+                    
+                    groups.setdefault((params[i]['length_scale'], fold), []).append((i, fold))
+                
+                units = [groups[key] for key in sorted(groups)]
+                
+            else:
+                
+                units = [[task] for task in tasks]
+            
+            # Dispatch a few tasks per worker at a time so that the budget is checked often
+            step = 4 * effective_n_jobs(parallel.n_jobs)
+            
+            for start in range(0, len(units), step):
+                
+                chunk = budget.take([task for unit in units[start:start + step] for task in unit])
+                
+                if data_key:
+                    
+                    # One task per length scale and fold, scoring all the alphas on the same factors
+                    groups = {}
+                    
+                    for i, fold in chunk:
+                        
+                        groups.setdefault((params[i]['length_scale'], fold), []).append(i)
+                    
+                    results = parallel(delayed(_fixed_kernel_scores)(data_key, X, y, *folds[fold], fold, length_scale,
+                                                                     
+                                                                     [params[i]['alpha'] for i in members])
+                                       
+                                       for (length_scale, fold), members in groups.items())
+                    
+                    for members, group_scores in zip(groups.values(), results):
+                        
+                        for i, score in zip(members, group_scores):
+                            
+                            scores[i].append(score)
+                    
+                else:
+                    
+                    results = parallel(delayed(_fold_score)(self.regressor(**params[i]), X, y, *folds[fold]) for i, fold in chunk)
+                    
+                    for (i, _), score in zip(chunk, results):
+                        
+                        scores[i].append(score)
+                
+                if budget.exhausted():
+                    
+                    return scores
+            
+            if rung == len(folds):
+                
+                break
+            
+            # Keep the best 1/eta of the candidates for the next rung
+            active = sorted(active, key=lambda i: np.mean(scores[i]), reverse=True)[:math.ceil(len(active) / eta)]
+            
+            rung = min(rung * eta, len(folds))
         
-        # Initialize Gaussian Process Regressor with the optimized alpha
-        self.best_gpr = GaussianProcessRegressor(kernel=kernel, alpha=self.best_alpha, n_restarts_optimizer=10, random_state=42)
+        return scores
+
+    def train(self):
+        
+        # Exact or sparse GPR with the optimized length_scale and alpha, fixed if they were searched that way
+        self.best_gpr = self.regressor(self.best_length_scale, self.best_alpha)
         
         # Fit the model on the training data
         self.best_gpr.fit(self.X_train, self.y_train)
@@ -79,12 +690,14 @@ class GPRModel:
         
         self.y_train_pred = pd.Series(y_train_pred)
         
-        # Predict on the test data
+        # Predict on the test data, with the predictive standard deviation
         self.y_test = pd.Series(self.y_test)
         
-        y_test_pred = self.best_gpr.predict(self.X_test)
+        y_test_pred, y_test_std = self.best_gpr.predict(self.X_test, return_std=True)
         
         self.y_test_pred = pd.Series(y_test_pred)
+        
+        self.y_test_std = pd.Series(y_test_std)
 
     def evaluate(self):
         
@@ -120,3 +733,381 @@ class GPRModel:
         print(f"NSE (Testing): {nse_test:.3f}")
         
         print(f"Correlation (Testing): {correlation_test:.3f}")
+
+    def save(self, path):
+        
+        """
+        Saves the trained model (kernel parameters, alpha, training or inducing points, weights and
+        Cholesky factors) to a versioned .npz file.
+        
+        Parameters:
+        path (str): Path of the .npz file.
+        """
+        
+        if self.best_gpr is None:
+            
+            raise ValueError("The model must be trained before it is saved.")
+        
+        features = list(self.X_train.columns) if isinstance(self.X_train, pd.DataFrame) else ()
+        
+        GPRPredictor.from_regressor(self.best_gpr, features).save(path)
+
+    @staticmethod
+    def load(path):
+        
+        """
+        Loads a model saved with save, ready for predict and predict_raster.
+        
+        Parameters:
+        path (str): Path of the .npz file.
+        
+        Returns:
+        predictor (GPRPredictor): The loaded model.
+        """
+        
+        return GPRPredictor.load(path)
+
+    def compare_exact(self, n_inducing=None):
+        
+        """
+        Fits the exact and the sparse GPR with the optimized hyperparameters and compares them on the test set.
+        
+        Parameters:
+        n_inducing (int): Number of inducing points of the sparse GP, defaults to the one of the model or 500.
+        
+        Returns:
+        comparison (pandas.DataFrame): Test metrics and fit time (seconds) of the exact and the sparse GPR.
+        """
+        
+        n_inducing = n_inducing or self.n_inducing or 500
+        
+        y_test = np.asarray(self.y_test, dtype="float")
+        
+        predictions = {}
+        
+        fit_times = {}
+        
+        for name, gpr in (('Exact GPR', self.regressor(self.best_length_scale, self.best_alpha, n_inducing=0)),
+                          
+                          (f'Sparse GPR ({n_inducing} inducing points)', self.regressor(self.best_length_scale, self.best_alpha, n_inducing))):
+            
+            start = time.perf_counter()
+            
+            gpr.fit(self.X_train, self.y_train)
+            
+            fit_times[name] = time.perf_counter() - start
+            
+            predictions[name] = gpr.predict(self.X_test)
+        
+        comparison = MetCalculator().product_metrics(y_test, pd.DataFrame(predictions))
+        
+        comparison['Fit Time'] = pd.Series(fit_times)
+        
+        print(comparison)
+        
+        return comparison
+
+
+class _Budget:
+    
+    # Wall-clock and fit budget of a hyperparameter search
+    def __init__(self, max_time=None, max_fits=None):
+        
+        self.start = time.perf_counter()
+        
+        self.max_time = max_time
+        
+        self.max_fits = max_fits
+        
+        self.fits = 0
+
+    def elapsed(self):
+        
+        return time.perf_counter() - self.start
+
+    def exhausted(self):
+        
+        return ((self.max_time is not None and self.elapsed() >= self.max_time)
+                
+                or (self.max_fits is not None and self.fits >= self.max_fits))
+
+    def take(self, tasks):
+        
+        # The tasks that still fit in the budget, counted as spent
+        if self.exhausted():
+            
+            return []
+        
+        if self.max_fits is not None:
+            
+            tasks = tasks[:self.max_fits - self.fits]
+        
+        self.fits += len(tasks)
+        
+        return tasks
+
+
+def _fold_score(gpr, X, y, train, test):
+    
+    # R2 of a GPR fitted on one training fold, as cross_val_score with scoring='r2'
+    return clone(gpr).fit(X[train], y[train]).score(X[test], y[test])
+
+
+def _candidate_params(point, log_space, resolution):
+    
+    # length_scale and alpha of a point of the search space, the length scale rounded to `resolution` decades
+    if log_space:
+        
+        length_scale, alpha = 10 ** point['log_length_scale'], 10 ** point['log_alpha']
+        
+    else:
+        
+        length_scale, alpha = point['length_scale'], point['alpha']
+    
+    if resolution:
+        
+        length_scale = 10 ** (round(np.log10(length_scale) / resolution) * resolution)
+    
+    return {'length_scale': float(length_scale), 'alpha': float(alpha)}
+
+
+# Eigendecompositions of fold kernel matrices of the current process, most recently used last
+_FOLD_FACTORS = OrderedDict()
+
+_FOLD_FACTORS_SIZE = 16
+
+# Squared distances between the points of each fold, most recently used last
+_FOLD_DISTANCES = OrderedDict()
+
+_FOLD_DISTANCES_SIZE = 10
+
+# An eigendecomposition costs about as much as this many Cholesky factorizations
+_EIGEN_MIN_ALPHAS = 8
+
+
+def _fixed_kernel_scores(data_key, X, y, train, test, fold, length_scale, alphas):
+    
+    # R2 of fixed-kernel GPRs on one fold for several alphas. With the eigendecomposition K = Q diag(w) Q^T of
+    # the fold kernel matrix, the predictive mean is K_*Q (Q^T y / (w + alpha)) for any alpha, so it is
+    # computed once per length scale when enough alphas share it, and kept for later batches
+    key = (data_key, fold, length_scale)
+    
+    if key in _FOLD_FACTORS:
+        
+        _FOLD_FACTORS.move_to_end(key)
+        
+    elif len(alphas) >= _EIGEN_MIN_ALPHAS:
+        
+        K, K_test = _fold_kernels(data_key, X, train, test, fold, length_scale)
+        
+        w, Q = np.linalg.eigh(K)
+        
+        _FOLD_FACTORS[key] = (np.maximum(w, 0), K_test @ Q, Q.T @ y[train])
+        
+        if len(_FOLD_FACTORS) > _FOLD_FACTORS_SIZE:
+            
+            _FOLD_FACTORS.popitem(last=False)
+    
+    if key in _FOLD_FACTORS:
+        
+        w, KQ, Qty = _FOLD_FACTORS[key]
+        
+        predictions = KQ @ (Qty[:, None] / (w[:, None] + np.asarray(alphas)[None, :]))
+        
+    else:
+        
+        # Few alphas: one Cholesky factorization of K + alpha I each, on the same kernel matrices
+        K, K_test = _fold_kernels(data_key, X, train, test, fold, length_scale)
+        
+        predictions = np.empty((len(test), len(alphas)))
+        
+        for column, alpha in enumerate(alphas):
+            
+            K_alpha = K.copy()
+            
+            K_alpha[np.diag_indices_from(K_alpha)] += alpha
+            
+            try:
+                
+                predictions[:, column] = K_test @ cho_solve((cholesky(K_alpha, lower=True), True), y[train])
+                
+            except np.linalg.LinAlgError:
+                
+                # As cross_val_score, a failed fit scores NaN
+                predictions[:, column] = np.nan
+    
+    residuals = ((y[test][:, None] - predictions) ** 2).sum(axis=0)
+    
+    return list(1 - residuals / ((y[test] - y[test].mean()) ** 2).sum())
+
+
+def _pack(lower):
+    
+    # Lower triangle of a square matrix as a flat array
+    return lower[np.tril_indices(len(lower))]
+
+
+def _unpack(packed, n):
+    
+    lower = np.zeros((n, n))
+    
+    lower[np.tril_indices(n)] = packed
+    
+    return lower
+
+
+def predict_raster(model_path, predictor_tifs, output_tif, tile_size=512, n_workers=None, chunk_size=4096, std=False,
+                   
+                   resampling=None):
+    
+    """
+    Predicts a merged raster with a saved GPR model from aligned predictor GeoTIFFs, tile by tile.
+    
+    With std, the predictive standard deviation is written as well, to '<output>_std.tif' next to the
+    mean. It is computed chunk by chunk from the Cholesky factor stored with the model.
+    
+    Tiles are predicted on a process pool in which every worker loads the model once. Only a few tiles
+    are in flight at a time and each is written as soon as it is finished, so memory is bounded by the
+    tile size and chunk_size x n_points kernel values, whatever the size of the rasters.
+    
+    With resampling, predictors on other grids (e.g. 0.1 degree reanalysis next to 1 km rasters) are
+    resampled onto the grid of the first predictor tile by tile as they are read (see GridAlignment).
+    
+    Parameters:
+    model_path (str): Path of a model saved with GPRModel.save.
+    predictor_tifs (list): Paths of the predictor GeoTIFFs on the same grid, in the order of the model inputs.
+    output_tif (str): Path of the output GeoTIFF.
+    tile_size (int): Number of rows and columns of each tile.
+    n_workers (int): Number of worker processes, None for one per CPU and 1 to run in this process.
+    chunk_size (int): Number of pixels predicted at once.
+    std (bool): Also write the predictive standard deviation raster.
+    resampling (str): 'nearest', 'bilinear' or 'average' to align predictors on other grids, None if
+                      they share the grid of the first one.
+    
+    Returns:
+    output_tif (str): Path of the output GeoTIFF, NODATA where any predictor is missing.
+    std_tif (str): Path of the standard deviation GeoTIFF, None without std.
+    """
+    
+    with rasterio.open(predictor_tifs[0]) as src:
+        
+        height, width = src.height, src.width
+        
+        profile = {'driver': 'GTiff', 'width': width, 'height': height, 'count': 1, 'dtype': 'float32',
+                   
+                   'crs': src.crs, 'transform': src.transform, 'nodata': NODATA, 'tiled': True,
+                   
+                   'blockxsize': 256, 'blockysize': 256}
+    
+    grid = raster_grid(predictor_tifs[0]) if resampling else None
+    
+    windows = [Window(col_off, row_off, min(tile_size, width - col_off), min(tile_size, height - row_off))
+               
+               for row_off in range(0, height, tile_size) for col_off in range(0, width, tile_size)]
+    
+    std_tif = f"{os.path.splitext(output_tif)[0]}_std.tif" if std else None
+    
+    with rasterio.open(output_tif, 'w', **profile) as dst, \
+            (rasterio.open(std_tif, 'w', **profile) if std else nullcontext()) as std_dst:
+        
+        def write(window, mean, deviation):
+            
+            dst.write(np.nan_to_num(mean, nan=NODATA).astype('float32'), 1, window=window)
+            
+            if std:
+                
+                std_dst.write(np.nan_to_num(deviation, nan=NODATA).astype('float32'), 1, window=window)
+        
+        if n_workers == 1:
+            
+            _init_worker(model_path)
+            
+            for window in windows:
+                
+                write(*_predict_tile(predictor_tifs, window, chunk_size, std, grid, resampling))
+            
+        else:
+            
+            n_workers = n_workers or os.cpu_count()
+            
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(model_path,)) as executor:
+                
+                # Keep only a few tiles in flight so that the parent never holds more than that
+                pending = set()
+                
+                for window in windows:
+                    
+                    pending.add(executor.submit(_predict_tile, predictor_tifs, window, chunk_size, std, grid, resampling))
+                    
+                    if len(pending) >= 2 * n_workers:
+                        
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        
+                        for task in done:
+                            
+                            write(*task.result())
+                
+                for task in as_completed(pending):
+                    
+                    write(*task.result())
+    
+    return output_tif, std_tif
+
+
+# Model of the current worker process
+_PREDICTOR = None
+
+
+def _init_worker(model_path):
+    
+    global _PREDICTOR
+    
+    _PREDICTOR = GPRPredictor.load(model_path)
+
+
+def _predict_tile(predictor_tifs, window, chunk_size, std=False, grid=None, resampling=None):
+    
+    # Predicted mean and standard deviation (None without std) of a tile, NaN where any predictor is missing
+    layers = [read_aligned(tif, grid, window, resampling or 'nearest') for tif in predictor_tifs]
+    
+    X = np.stack(layers, axis=-1).reshape(-1, len(layers))
+    
+    valid = np.isfinite(X).all(axis=1)
+    
+    shape = (int(window.height), int(window.width))
+    
+    mean = np.full(len(X), np.nan)
+    
+    if not std:
+        
+        mean[valid] = _PREDICTOR.predict(X[valid], chunk_size=chunk_size)
+        
+        return window, mean.reshape(shape), None
+    
+    deviation = np.full(len(X), np.nan)
+    
+    mean[valid], deviation[valid] = _PREDICTOR.predict(X[valid], return_std=True, chunk_size=chunk_size)
+    
+    return window, mean.reshape(shape), deviation.reshape(shape)
+
+
+def _fold_kernels(data_key, X, train, test, fold, length_scale):
+    
+    # RBF kernel matrices (train x train, test x train) of a fold from its cached squared distances
+    key = (data_key, fold)
+    
+    if key in _FOLD_DISTANCES:
+        
+        _FOLD_DISTANCES.move_to_end(key)
+        
+    else:
+        
+        _FOLD_DISTANCES[key] = (cdist(X[train], X[train], 'sqeuclidean'), cdist(X[test], X[train], 'sqeuclidean'))
+        
+        if len(_FOLD_DISTANCES) > _FOLD_DISTANCES_SIZE:
+            
+            _FOLD_DISTANCES.popitem(last=False)
+    
+    distances, test_distances = _FOLD_DISTANCES[key]
+    
+    return np.exp(-0.5 * distances / length_scale ** 2), np.exp(-0.5 * test_distances / length_scale ** 2)
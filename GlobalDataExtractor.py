@@ -1,8 +1,8 @@
-from MetricsCalculator import MetricsCalculator
-import pandas as pd
+from MetricsCalculator import MetCalculator
+from TableIO import read_table, write_table
 import os
 
-def main(input_csv, GloRESatE_tif, GloREDa_tif, GloREDa1_2_dir, output_csv):
+def main(input_csv, GloRESatE_tif, GloREDa_tif, GloREDa1_2_dir, output_path, export_csv=False, n_workers=None):
     
     """
     Main function to perform data extraction and processing.
@@ -12,68 +12,67 @@ def main(input_csv, GloRESatE_tif, GloREDa_tif, GloREDa1_2_dir, output_csv):
     - GloRESatE_tif (str): Path to the GloRESatE TIFF file.
     - GloREDa_tif (str): Path to the GloREDa TIFF file.
     - GloREDa1_2_dir (str): Directory containing GloREDa1.2 TIFF files.
-    - output_csv (str): Path to save the output CSV file.
+    - output_path (str): Path to save the output table (.parquet or .feather, or .csv).
+    - export_csv (bool): Also save a CSV copy of the output table.
+    - n_workers (int): Number of threads reading the rasters, None for the default and 1 to read them one by one.
     """
 
-    calculator = MetricsCalculator()
+    calculator = MetCalculator()
     
     # Read the input CSV file
-    df = pd.read_csv(input_csv)
+    df = read_table(input_csv)
     
-    # Apply inverse distance weighting for GloRESatE and GloREDa
-    df = calculator.inverse_distance_weighted(df, GloRESatE_tif, 'GloRESatE', 0)
+    # Apply inverse distance weighting for GloRESatE and GloREDa, reading both rasters at once
+    sampled = calculator.sample_rasters(df, {'GloRESatE': GloRESatE_tif, 'GloREDa': GloREDa_tif}, 0, windowed=True,
+                                        
+                                        n_workers=n_workers)
     
-    df = calculator.inverse_distance_weighted(df, GloREDa_tif, 'GloREDa', 0)
+    df[sampled.columns] = sampled
     
     # Calculate R factors and add them to the DataFrame
-    df = calculate_r_factors(df, calculator, GloREDa1_2_dir)
+    df = calculate_r_factors(df, calculator, GloREDa1_2_dir, n_workers)
 
     # Filter rows based on criteria
     df_filtered = filter_rows(df)
     
-    # Save the filtered DataFrame to a CSV file
-    save_to_csv(df_filtered, output_csv)
+    # Save the filtered DataFrame in a columnar format, with an optional CSV export
+    write_table(df_filtered, output_path, export_csv)
 
 
-def calculate_r_factors(df, calculator, GloREDa1_2_dir):
+def calculate_r_factors(df, calculator, GloREDa1_2_dir, n_workers=None):
     
     """
-    Calculate R factors from TIFF files and add them as new columns to the DataFrame.
+    Calculate R factors from the monthly TIFF files and add their sum as a new column to the DataFrame.
     
     Parameters:
     - df (DataFrame): Input DataFrame to be updated.
-    - calculator (MetricsCalculator): MetricsCalculator object for distance weighting.
+    - calculator (MetCalculator): MetCalculator object for distance weighting.
     - GloREDa1_2_dir (str): Directory containing GloREDa1.2 TIFF files.
+    - n_workers (int): Number of threads reading the monthly files, None for the default and 1 to read them one by one.
     
     Returns:
-    - DataFrame: Updated DataFrame with R factors and GloREDa1.2 column.
+    - DataFrame: Updated DataFrame with the GloREDa1.2 column.
     """
 
+    monthly_files = {}
 
-    for map_file in os.listdir(GloREDa1_2_dir):
+    # Sorted, so that the monthly columns are always summed in the same order
+    for map_file in sorted(os.listdir(GloREDa1_2_dir)):
         
         if map_file.endswith('.tif'):
             
             # Extract month name from the file name
             month_name = map_file.split('_')[-1].split('.')[0]
             
-            new_col_name = f'Rfactor_{month_name}'
-            
             # Construct path to the TIFF file
-            tif_file = os.path.join(GloREDa1_2_dir, map_file)
-            
-            new_col_name = new_col_name
-            
-            # Apply inverse distance weighting and add the result as a new column
-            df = calculator.inverse_distance_weighted(df, tif_file, new_col_name, 0)
+            monthly_files[month_name] = os.path.join(GloREDa1_2_dir, map_file)
     
-    # Calculate GloREDa1.2 as the sum of all R factor columns
-    rfactor_columns = [col for col in df.columns if col.startswith('Rfactor_')]
+    # Sample all monthly rasters concurrently, sharing the station-to-pixel mapping; windowed reads keep
+    # the memory of every thread to the blocks around the stations
+    monthly_r_factors = calculator.sample_rasters(df, monthly_files, 0, windowed=True, n_workers=n_workers)
     
-    df['GloREDa1.2'] = df[rfactor_columns].sum(axis=1)
-
-    # Drop the individual R factor columns
-    df = df.drop(columns=rfactor_columns)
+    # Calculate GloREDa1.2 as the sum of all monthly R factors
+    df['GloREDa1.2'] = monthly_r_factors.sum(axis=1)
             
     return df
 
@@ -104,20 +103,6 @@ def filter_rows(df):
     return df_filtered
 
 
-def save_to_csv(df, output_csv):
-    
-    """
-    Save the DataFrame to a CSV file.
-    
-    Parameters:
-    - df (DataFrame): DataFrame to be saved.
-    - output_csv (str): Path to save the output CSV file.
-    """
-
-
-    df.to_csv(output_csv, index=False)
-
-
 if __name__ == "__main__":
     
     # Define file paths
@@ -129,7 +114,7 @@ if __name__ == "__main__":
     
     GloREDa1_2_dir = 'path_to_GloREDa1.2_directory'
     
-    output_csv = 'path_to_output_csv.csv'
+    output_path = 'path_to_output.parquet'
     
     # Execute the main function
-    main(input_csv, GloRESatE_tif, GloREDa_tif, GloREDa1_2_dir, output_csv)
+    main(input_csv, GloRESatE_tif, GloREDa_tif, GloREDa1_2_dir, output_path)
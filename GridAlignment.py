@@ -0,0 +1,190 @@
+from contextlib import contextmanager
+from xml.sax.saxutils import escape
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from MetricsCalculator import MetCalculator
+
+# Resampling methods of the alignment
+RESAMPLING = {'nearest': Resampling.nearest, 'bilinear': Resampling.bilinear, 'average': Resampling.average}
+
+# GDAL names of the raster data types
+GDAL_TYPES = {'uint8': 'Byte', 'int8': 'Int8', 'uint16': 'UInt16', 'int16': 'Int16', 'uint32': 'UInt32', 'int32': 'Int32',
+
+              'float32': 'Float32', 'float64': 'Float64'}
+
+
+def raster_grid(tif_file):
+
+    """
+    Returns the grid of a raster, to be used as the target grid of the alignment.
+
+    Parameters:
+    tif_file (str): Path of the raster file (TIFF).
+
+    Returns:
+    grid (dict): 'crs', 'transform', 'width' and 'height' of the raster.
+    """
+
+    with rasterio.open(tif_file) as src:
+
+        return {'crs': src.crs, 'transform': src.transform, 'width': src.width, 'height': src.height}
+
+
+def on_grid(src, grid):
+
+    """
+    Tells whether an open raster already lies on a grid.
+
+    Parameters:
+    src (rasterio.io.DatasetReader): Open raster dataset.
+    grid (dict): Grid as returned by raster_grid.
+
+    Returns:
+    on_grid (bool): True if the raster has the shape, transform and CRS of the grid.
+    """
+
+    return ((src.height, src.width) == (grid['height'], grid['width']) and src.transform.almost_equals(grid['transform'])
+
+            and src.crs == grid['crs'])
+
+
+@contextmanager
+def open_aligned(tif_file, grid=None, resampling='nearest', src_nodata=None):
+
+    """
+    Opens a raster as if it lay on another grid, resampling it lazily window by window.
+
+    Nothing is written to disk: reading a window of the returned dataset only warps the source pixels
+    under that window (GDAL WarpedVRT). Global grids, e.g. the 0-360 degree grids of ERA5-Land and CMORPH,
+    are first rotated through a virtual raster to start at the western edge of the target grid, so
+    targets on either side of the antimeridian are covered. Rasters already on the grid are returned as
+    they are.
+
+    Parameters:
+    tif_file (str): Path of the raster file (TIFF).
+    grid (dict): Target grid as returned by raster_grid, None to open the raster on its own grid.
+    resampling (str): 'nearest', 'bilinear' or 'average' (area-weighted mean, for coarser targets).
+    src_nodata (float): No-data value of the source, if it is not set in the file. Resampling leaves
+                        no-data pixels out, so it should be known for bilinear and average.
+
+    Yields:
+    src (rasterio dataset): Dataset on the target grid, with the source no-data value (NaN for float
+                            rasters without one) outside the source.
+    """
+
+    if resampling not in RESAMPLING:
+
+        raise ValueError(f"Unknown resampling method: {resampling}")
+
+    with rasterio.open(tif_file) as src:
+
+        if grid is None or on_grid(src, grid):
+
+            yield src
+
+            return
+
+        nodata = src_nodata if src_nodata is not None else src.nodata
+
+        west = grid['transform'].c if grid['crs'] is not None and grid['crs'].is_geographic else -180
+
+        shift = _recentre_shift(src, west)
+
+        if shift:
+
+            source = rasterio.open(_recentred_vrt(tif_file, src, shift, west, nodata))
+
+        else:
+
+            source = src
+
+        if nodata is None and np.dtype(src.dtypes[0]).kind == 'f':
+
+            nodata = np.nan
+
+        try:
+
+            with WarpedVRT(source, crs=grid['crs'], transform=grid['transform'], width=grid['width'], height=grid['height'],
+
+                           resampling=RESAMPLING[resampling], src_nodata=nodata, nodata=nodata) as vrt:
+
+                yield vrt
+
+        finally:
+
+            if source is not src:
+
+                source.close()
+
+
+def read_aligned(tif_file, grid=None, window=None, resampling='nearest', src_nodata=None):
+
+    """
+    Reads a window of a raster resampled onto a grid (see open_aligned).
+
+    Parameters:
+    tif_file (str): Path of the raster file (TIFF).
+    grid (dict): Target grid as returned by raster_grid, None for the grid of the raster.
+    window (rasterio.windows.Window): Window of the target grid, None for the whole grid.
+    resampling (str): 'nearest', 'bilinear' or 'average'.
+    src_nodata (float): No-data value of the source, if it is not set in the file.
+
+    Returns:
+    values (numpy.ndarray): Float array of the window, NaN for no data.
+    """
+
+    with open_aligned(tif_file, grid, resampling, src_nodata) as src:
+
+        values = src.read(1, window=window, masked=True).astype("float").filled(np.nan)
+
+    if src_nodata is not None:
+
+        values[values == src_nodata] = np.nan
+
+    return values
+
+
+def _recentre_shift(src, west):
+
+    # Column of a global grid that becomes the first one when the grid starts at `west`, 0 otherwise
+    if not MetCalculator().wraps(src.transform, src.width) or (src.crs is not None and not src.crs.is_geographic):
+
+        return 0
+
+    return int(round((west - src.transform.c) / src.transform.a)) % src.width
+
+
+def _recentred_vrt(tif_file, src, shift, target_west, nodata):
+
+    # VRT that places the columns from `shift` onwards first, georeferenced from about target_west
+    transform = src.transform
+
+    west = transform.c + shift * transform.a
+
+    west -= 360 * round((west - target_west) / 360)
+
+    width, height = src.width, src.height
+
+    def simple_source(src_off, dst_off, size):
+
+        return (f'<SimpleSource><SourceFilename relativeToVRT="0">{escape(tif_file)}</SourceFilename>'
+
+                f'<SourceBand>1</SourceBand><SrcRect xOff="{src_off}" yOff="0" xSize="{size}" ySize="{height}"/>'
+
+                f'<DstRect xOff="{dst_off}" yOff="0" xSize="{size}" ySize="{height}"/></SimpleSource>')
+
+    nodata_element = f'<NoDataValue>{nodata}</NoDataValue>' if nodata is not None else ''
+
+    srs = f'<SRS>{escape(src.crs.to_wkt())}</SRS>' if src.crs else ''
+
+    return (f'<VRTDataset rasterXSize="{width}" rasterYSize="{height}">{srs}'
+
+            f'<GeoTransform>{west!r}, {transform.a!r}, 0, {transform.f!r}, 0, {transform.e!r}</GeoTransform>'
+
+            f'<VRTRasterBand dataType="{GDAL_TYPES[src.dtypes[0]]}" band="1">{nodata_element}'
+
+            f'{simple_source(shift, 0, width - shift)}{simple_source(0, width - shift, shift)}'
+
+            f'</VRTRasterBand></VRTDataset>')
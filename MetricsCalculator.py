@@ -1,9 +1,43 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
+import os
+import threading
 import rasterio
+from affine import Affine
+from rasterio.windows import Window
 import numpy as np
+import pandas as pd
+
+# Column names of the metric tables
+METRIC_COLUMNS = ['Mean Percent Bias', 'Std Percent Bias', 'NSE', 'Correlation Coefficient', 'ubRMSE']
+
+# Class codes of the Koppen-Geiger maps of Beck et al. (2018); 0 marks water and no data
+KOPPEN_GEIGER_CLASSES = {1: 'Af', 2: 'Am', 3: 'Aw', 4: 'BWh', 5: 'BWk', 6: 'BSh', 7: 'BSk', 8: 'Csa', 9: 'Csb',
+                         
+                         10: 'Csc', 11: 'Cwa', 12: 'Cwb', 13: 'Cwc', 14: 'Cfa', 15: 'Cfb', 16: 'Cfc', 17: 'Dsa',
+                         
+                         18: 'Dsb', 19: 'Dsc', 20: 'Dsd', 21: 'Dwa', 22: 'Dwb', 23: 'Dwc', 24: 'Dwd', 25: 'Dfa',
+                         
+                         26: 'Dfb', 27: 'Dfc', 28: 'Dfd', 29: 'ET', 30: 'EF'}
+
+# Upper bound of the gathered values (resamples x rows x columns) of one bootstrap batch
+BOOTSTRAP_BATCH_VALUES = 2000000
 
 class MetCalculator:
-    def __init__(self):
-        pass
+    def __init__(self, cache_dir=None):
+        
+        """
+        Parameters:
+        cache_dir (str): Optional directory where station-to-pixel neighbourhoods and IDW weights
+                         are stored as .npz files and reused by later runs on the same grid.
+        """
+        
+        self.cache_dir = cache_dir
+        
+        # Neighbourhoods computed by this instance, keyed like the cache files
+        self._neighbourhoods = {}
     
     def ubrmse(self, observed, predicted):
         
@@ -88,74 +122,1199 @@ class MetCalculator:
         return correlation
 
 
-    def inverse_distance_weighted(self, df, tif_file, new_col_name, nodata_value):
+    def grouped_metrics(self, observed, predicted, groups, n_bootstrap=0, confidence=0.95, random_state=None, n_jobs=1):
         
         """
-        Applies inverse distance weighting interpolation to assign values from a raster to DataFrame points.
+        Calculates percentage bias statistics, NSE, Pearson correlation and ubRMSE for every group in one pass.
+        
+        The metrics are derived from per-group sums, sums of squares and cross-products accumulated with
+        np.bincount, so the cost hardly depends on the number of groups. Rows where either value is
+        missing are left out, as in Series.corr. Results equal those of ubrmse, nse and correlation applied
+        to the remaining rows of each group separately.
         
         Parameters:
-        df (pandas.DataFrame): DataFrame with latitude and longitude columns.
-        tif_file (str): Path to the raster file (TIFF).
-        new_col_name (str): Name of the new column to store interpolated values.
-        nodata_value (float): Value in the raster representing no data.
+        observed (array-like): Array of observed values.
+        predicted (array-like): Array of predicted values.
+        groups (array-like): Group label of every value, e.g. continent, country or climate type.
+        n_bootstrap (int): Number of bootstrap resamples for confidence intervals, 0 for point estimates only.
+        confidence (float): Confidence level of the bootstrap intervals.
+        random_state (int): Seed of the bootstrap resampling.
+        n_jobs (int): Number of worker processes for the bootstrap.
         
         Returns:
-        df (pandas.DataFrame): DataFrame with new column containing interpolated values.
+        metrics (pandas.DataFrame): One row per group (sorted labels) and one column per metric (METRIC_COLUMNS),
+                                    followed by '<metric> Lower' and '<metric> Upper' columns if n_bootstrap > 0.
         """
         
-        with rasterio.open(tif_file) as src:
+        if not len(observed) == len(predicted) == len(groups):
+            raise ValueError("All arrays must have the same length.")
+        
+        codes, labels = pd.factorize(np.asarray(groups), sort=True)
+        
+        # Incomplete pairs are left out like rows with an unknown group label
+        codes[np.isnan(np.asarray(observed, dtype="float")) | np.isnan(np.asarray(predicted, dtype="float"))] = -1
+        
+        sums = self.metric_sums(observed, predicted, codes, len(labels))
+        
+        metrics = pd.DataFrame(self.metrics_from_sums(sums), index=pd.Index(labels, name=getattr(groups, 'name', None)))
+        
+        metrics = metrics[METRIC_COLUMNS]
+        
+        if n_bootstrap:
+            
+            intervals = self.bootstrap_intervals(observed, predicted, codes, len(labels), n_bootstrap, confidence,
+                                                 
+                                                 random_state, n_jobs)
+            
+            for name, (lower, upper) in intervals.items():
+                
+                metrics[f'{name} Lower'] = lower[:, 0]
+                
+                metrics[f'{name} Upper'] = upper[:, 0]
+        
+        return metrics
+
+
+    def metric_sums(self, observed, predicted, codes=None, n_groups=1, shift=None):
+        
+        """
+        Accumulates the sufficient statistics of the metrics, per group if codes are given.
+        
+        Without codes, the sums are taken along the first axis, so 2-D inputs give the statistics of every
+        column. Observed and predicted values, their differences and percentage biases are shifted by
+        their means before squaring, which keeps the sums of squares accurate without changing any of the
+        metrics; the sums 'd0' and 'b0' of the shifts of the last two keep their absolute level. Pairs with
+        a missing value are left out of the sums and the count of their column or group.
+        
+        Parameters:
+        observed (array-like): Observed values, 1-D or (n, columns).
+        predicted (array-like): Predicted values, broadcastable against observed.
+        codes (numpy.ndarray): Group index (0 to n_groups - 1) of every value of 1-D inputs, None for column sums.
+        n_groups (int): Number of groups.
+        shift (tuple): Values subtracted from observed, predicted, differences and percentage biases before
+                       squaring (see metric_shift), None for their means.
+        
+        Returns:
+        sums (dict): Count and sums, arrays of length n_groups or one value per column.
+        """
+        
+        observed, predicted = np.broadcast_arrays(np.asarray(observed, dtype="float"), np.asarray(predicted, dtype="float"))
+        
+        if codes is not None:
+            
+            # Rows with an unknown group label are left out
+            keep = np.asarray(codes) >= 0
+            
+            observed, predicted, codes = observed[keep], predicted[keep], np.asarray(codes)[keep]
+        
+        values = self.metric_values(observed, predicted, shift)
+        
+        if codes is None:
+            
+            sums = {name: value.sum(axis=0) for name, value in values.items()}
+            
+        else:
+            
+            sums = {name: np.bincount(codes, weights=value, minlength=n_groups) for name, value in values.items()}
+        
+        return sums
+
+
+    def metric_values(self, observed, predicted, shift=None):
+        
+        """
+        Calculates the per-value terms whose sums are the sufficient statistics of the metrics.
+        
+        Parameters:
+        observed (numpy.ndarray): Observed values.
+        predicted (numpy.ndarray): Predicted values with the same shape.
+        shift (tuple): Values subtracted from observed, predicted, differences and percentage biases before
+                       squaring (see metric_shift), None for their means.
+        
+        Returns:
+        values (dict): Term name to array with the shape of the inputs; 'n' is 1 for complete pairs, and
+                       all terms of pairs with a missing value are 0.
+        """
+        
+        with np.errstate(divide="ignore", invalid="ignore"):
+            
+            percentage_bias = ((predicted - observed) / observed) * 100
+        
+        difference = predicted - observed
+        
+        if shift is None:
+            
+            shift = self.metric_shift(observed, predicted)
+        
+        shifted_observed = observed - shift[0]
+        
+        shifted_predicted = predicted - shift[1]
+        
+        shifted_difference = difference - shift[2]
+        
+        shifted_bias = percentage_bias - shift[3]
+        
+        complete = ~(np.isnan(observed) | np.isnan(predicted))
+        
+        values = {
+            'o': shifted_observed,
+            
+            'p': shifted_predicted,
+            
+            'oo': shifted_observed ** 2,
             
-            # Read raster data and handle no-data values
-            tiff_array = src.read(1)
+            'pp': shifted_predicted ** 2,
             
-            tiff_array = tiff_array.astype("float")
+            'op': shifted_observed * shifted_predicted,
             
-            tiff_array[tiff_array < nodata_value] = np.nan
+            'd': shifted_difference,
             
-            # Get the transformation matrix
-            transform = src.transform
+            'dd': shifted_difference ** 2,
+            
+            'd0': np.broadcast_to(shift[2], difference.shape),
+            
+            'b': shifted_bias,
+            
+            'bb': shifted_bias ** 2,
+            
+            'b0': np.broadcast_to(shift[3], percentage_bias.shape)
+        }
+        
+        if not complete.all():
+            
+            values = {name: np.where(complete, value, 0.0) for name, value in values.items()}
+        
+        values['n'] = complete.astype("float")
+        
+        return values
 
-            for index, row in df.iterrows():
-                lat, lon = row['Lat'], row['Lon']
+
+    def metric_shift(self, observed, predicted):
+        
+        """
+        Calculates the shifts of the sufficient statistics: the means of the observed and predicted values,
+        of their differences and of the percentage biases.
+        
+        Parameters:
+        observed (numpy.ndarray): Observed values.
+        predicted (numpy.ndarray): Predicted values with the same shape.
+        
+        Returns:
+        shift (tuple): Mean observed, predicted, difference and percentage bias of the complete pairs along
+                       the first axis, 0 where there are no values or the mean is not finite.
+        """
+        
+        if not len(observed):
+            
+            return (0.0, 0.0, 0.0, 0.0)
+        
+        complete = ~(np.isnan(observed) | np.isnan(predicted))
+        
+        with np.errstate(divide="ignore", invalid="ignore"):
+            
+            terms = (observed, predicted, predicted - observed, ((predicted - observed) / observed) * 100)
+            
+            if complete.all():
+                
+                means = tuple(np.mean(term, axis=0) for term in terms)
+                
+            else:
                 
-                # Convert latitude and longitude to raster coordinates
-                col, row = ~transform * (lon, lat)
+                means = tuple(np.where(complete, term, 0.0).sum(axis=0) / complete.sum(axis=0) for term in terms)
+        
+        return tuple(np.where(np.isfinite(mean), mean, 0.0) for mean in means)
+
+
+    def bootstrap_intervals(self, observed, predicted, codes, n_groups, n_resamples=10000, confidence=0.95,
+                            
+                            random_state=None, n_jobs=1):
+        
+        """
+        Calculates bootstrap confidence intervals of the metrics, per group and per column.
+        
+        Values are resampled with replacement within each group. Each batch of resamples is drawn as one
+        index matrix and all metrics of the batch are evaluated with array operations on the sufficient
+        statistics. Every resample draws from its own seed spawned from random_state, so batches can be
+        spread over a process pool and the result depends neither on n_jobs nor on the batch size.
+        
+        Parameters:
+        observed (array-like): Observed values, 1-D or (n, columns).
+        predicted (array-like): Predicted values, broadcastable against observed.
+        codes (numpy.ndarray): Group index (0 to n_groups - 1) of every row.
+        n_groups (int): Number of groups.
+        n_resamples (int): Number of bootstrap resamples.
+        confidence (float): Confidence level of the intervals.
+        random_state (int): Seed of the resampling.
+        n_jobs (int): Number of worker processes.
+        
+        Returns:
+        intervals (dict): Metric name to (lower, upper) arrays of shape (n_groups, columns).
+        """
+        
+        observed, predicted = np.broadcast_arrays(np.asarray(observed, dtype="float"), np.asarray(predicted, dtype="float"))
+        
+        observed = observed.reshape(len(observed), -1)
+        
+        predicted = predicted.reshape(len(predicted), -1)
+        
+        codes = np.asarray(codes)
+        
+        # Sort the rows by group so that every group is a contiguous block
+        keep = np.flatnonzero(codes >= 0)
+        
+        order = keep[np.argsort(codes[keep], kind="stable")]
+        
+        group_sizes = np.bincount(codes[order], minlength=n_groups)
+        
+        values = self.metric_values(observed[order], predicted[order])
+        
+        # Bound the size of the gathered index matrix of one batch
+        batch_size = max(1, BOOTSTRAP_BATCH_VALUES // max(len(order) * observed.shape[1], 1))
+        
+        seeds = np.random.SeedSequence(random_state).spawn(n_resamples)
+        
+        args = [(values, group_sizes, seeds[start:start + batch_size]) for start in range(0, n_resamples, batch_size)]
+        
+        if n_jobs == 1:
+            
+            samples = [_bootstrap_batch(*arg) for arg in args]
+            
+        else:
+            
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
                 
-                col, row = int(round(col)), int(round(row))
+                samples = list(executor.map(_bootstrap_batch, *zip(*args)))
+        
+        alpha = (1 - confidence) / 2 * 100
+        
+        intervals = {}
+        
+        for name in METRIC_COLUMNS:
+            
+            metric = np.concatenate([sample[name] for sample in samples])
+            
+            intervals[name] = (np.nanpercentile(metric, alpha, axis=0), np.nanpercentile(metric, 100 - alpha, axis=0))
+        
+        return intervals
+
 
-                pixel_values = []
+    def product_metrics(self, observed, predicted, n_bootstrap=0, confidence=0.95, random_state=None, n_jobs=1):
+        
+        """
+        Calculates the metrics of several products against one reference in a single matrix operation.
+        
+        Either observed or predicted holds several columns (2-D array or DataFrame) and the other one is a
+        single column compared with each of them. All statistics are column-wise reductions over one
+        float64 block. Pairs with a missing value are left out of their column only. Results equal those of
+        grouped_metrics, and of ubrmse, nse and correlation, applied to the complete pairs of each column.
+        
+        Parameters:
+        observed (array-like): Observed values, one column or (n, columns).
+        predicted (array-like): Predicted values, one column or (n, columns).
+        n_bootstrap (int): Number of bootstrap resamples for confidence intervals, 0 for point estimates only.
+        confidence (float): Confidence level of the bootstrap intervals.
+        random_state (int): Seed of the bootstrap resampling.
+        n_jobs (int): Number of worker processes for the bootstrap.
+        
+        Returns:
+        metrics (pandas.DataFrame): One row per column of the 2-D input and one column per metric (METRIC_COLUMNS),
+                                    followed by '<metric> Lower' and '<metric> Upper' columns if n_bootstrap > 0.
+        """
+        
+        if len(observed) != len(predicted):
+            raise ValueError("Both arrays must have the same length.")
+        
+        names = getattr(observed, 'columns', None)
+        
+        if names is None:
+            
+            names = getattr(predicted, 'columns', None)
+        
+        observed = np.asarray(observed, dtype="float")
+        
+        predicted = np.asarray(predicted, dtype="float")
+        
+        # Single columns are compared with every column of the other input
+        observed = observed.reshape(len(observed), -1)
+        
+        predicted = predicted.reshape(len(predicted), -1)
+        
+        sums = self.metric_sums(observed, predicted)
+        
+        if names is None:
+            
+            names = range(len(sums['n']))
+        
+        metrics = pd.DataFrame(self.metrics_from_sums(sums), index=pd.Index(names))[METRIC_COLUMNS]
+        
+        if n_bootstrap:
+            
+            # All rows form a single group; every column is resampled with the same rows
+            intervals = self.bootstrap_intervals(observed, predicted, np.zeros(len(observed), dtype=np.int64), 1,
+                                                 
+                                                 n_bootstrap, confidence, random_state, n_jobs)
+            
+            for name, (lower, upper) in intervals.items():
+                
+                metrics[f'{name} Lower'] = lower[0]
                 
-                distances = []
+                metrics[f'{name} Upper'] = upper[0]
+        
+        return metrics
+
+
+    def raster_metrics(self, observed_tif, predicted_tif, nodata_value, zones_tif=None, zone_names=None, tile_size=512,
+                       
+                       n_workers=None, resampling=None):
+        
+        """
+        Calculates the metrics over every valid pixel of two rasters, optionally per zone.
+        
+        The rasters are read tile by tile, with tiles aligned to their internal blocks, and only the sufficient
+        statistics of each tile are kept. Tiles are processed on a thread pool (GDAL decodes without holding
+        the GIL) with a few tiles in flight, so memory use is about one tile per worker whatever the size of
+        the rasters. Results do not depend on n_workers.
+        
+        With resampling, the predicted and zone rasters may lie on other grids: each tile of them is then
+        resampled onto the grid of the observed raster as it is read (see GridAlignment.open_aligned), the
+        zones always with the nearest pixel.
+        
+        Parameters:
+        observed_tif (str): Path of the reference raster, e.g. GloREDa.
+        predicted_tif (str): Path of the compared raster, e.g. GloRESatE, on the grid of observed_tif unless
+                             resampling is given.
+        nodata_value (float): Values below this threshold are treated as no data in both rasters.
+        zones_tif (str): Optional raster of integer zone codes on the grid of observed_tif unless resampling is
+                         given, e.g. continents or Koppen-Geiger classes; pixels equal to its no-data value
+                         are left out.
+        zone_names (dict): Optional mapping of zone code to name, e.g. KOPPEN_GEIGER_CLASSES; zones that
+                           are not in it are left out.
+        tile_size (int): Tiles hold about tile_size x tile_size pixels.
+        n_workers (int): Number of threads, None for one per CPU and 1 to run in this thread.
+        resampling (str): 'nearest', 'bilinear' or 'average' to align rasters on other grids, None to
+                          require the grid of observed_tif.
+        
+        Returns:
+        metrics (pandas.DataFrame): One row per zone (a single row 'All' without zones) with the metric
+                                    columns (METRIC_COLUMNS) and the number of valid pixels ('Pixels').
+        """
+        
+        from GridAlignment import raster_grid, on_grid
+        
+        tifs = [tif for tif in (observed_tif, predicted_tif, zones_tif) if tif is not None]
+        
+        grid = raster_grid(observed_tif)
+        
+        height, width = grid['height'], grid['width']
+        
+        block_shapes = []
+        
+        for tif in tifs:
+            
+            with rasterio.open(tif) as src:
                 
-                # Loop over a 3x3 window around the target pixel
-                for r in range(row - 1, row + 2):
+                if on_grid(src, grid):
                     
-                    for c in range(col - 1, col + 2):
-                        
-                        if 0 <= r < tiff_array.shape[0] and 0 <= c < tiff_array.shape[1]:
-                            
-                            pixel_value = tiff_array[r, c]
-                            
-                            if not np.isnan(pixel_value):
-                                
-                                pixel_values.append(pixel_value)
-                                
-                                pixel_lat, pixel_lon = transform * (c, r)
-                                
-                                distance = np.sqrt((lat - pixel_lat) ** 2 + (lon - pixel_lon) ** 2)
-                                
-                                distances.append(distance)
-                
-                # Compute weighted average if there are valid pixel values
-                if len(pixel_values) > 0:
+                    block_shapes.append(src.block_shapes[0])
+                    
+                elif resampling is None:
+                    
+                    raise ValueError(f"{tif} is not on the grid of {observed_tif}; pass resampling to align it.")
+        
+        # Whole blocks of the largest block shape per tile, so that rasters stored in strips are not decoded
+        # again for every tile
+        block_height, block_width = max(shape[0] for shape in block_shapes), max(shape[1] for shape in block_shapes)
+        
+        tile_width = min(width, block_width * max(1, tile_size // block_width))
+        
+        tile_height = min(height, block_height * max(1, tile_size * tile_size // tile_width // block_height))
+        
+        windows = [Window(col_off, row_off, min(tile_width, width - col_off), min(tile_height, height - row_off))
+                   
+                   for row_off in range(0, height, tile_height) for col_off in range(0, width, tile_width)]
+        
+        totals = {}
+        
+        reference = []
+        
+        def add(zones, sums, shift):
+            
+            # Move the sums of the tile to the shift of the first tile and add them to the zone totals
+            if not zones:
+                
+                return
+            
+            if not reference:
+                
+                reference.append(shift)
+            
+            deltas = [value - reference_value for value, reference_value in zip(shift, reference[0])]
+            
+            n = sums['n']
+            
+            sums['op'] += deltas[0] * sums['p'] + deltas[1] * sums['o'] + n * deltas[0] * deltas[1]
+            
+            for (first, square), delta in zip((('o', 'oo'), ('p', 'pp'), ('d', 'dd'), ('b', 'bb')), deltas):
+                
+                sums[square] += 2 * delta * sums[first] + n * delta ** 2
+                
+                sums[first] += n * delta
+            
+            sums['d0'] -= n * deltas[2]
+            
+            sums['b0'] -= n * deltas[3]
+            
+            for index, zone in enumerate(zones):
+                
+                total = totals.setdefault(zone, {name: 0.0 for name in sums})
+                
+                for name, value in sums.items():
                     
-                    weights = [1 / distance for distance in distances]
+                    total[name] += value[index]
+        
+        arguments = (observed_tif, predicted_tif, zones_tif, zone_names, nodata_value, grid, resampling)
+        
+        if n_workers == 1:
+            
+            for window in windows:
+                
+                add(*_tile_sums(window, *arguments))
+            
+        else:
+            
+            n_workers = n_workers or os.cpu_count()
+            
+            with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                
+                # Keep only a few tiles in flight and add them in tile order, so the sums are reproducible
+                pending = deque()
+                
+                for window in windows:
                     
-                    weighted_average = np.average(pixel_values, weights=weights)
+                    pending.append(executor.submit(_tile_sums, window, *arguments))
                     
-                    df.loc[index, new_col_name] = weighted_average
+                    if len(pending) >= 2 * n_workers:
+                        
+                        add(*pending.popleft().result())
+                
+                while pending:
                     
-                else:
-                    df.loc[index, new_col_name] = float('NaN')
+                    add(*pending.popleft().result())
+        
+        zones = sorted(totals)
+        
+        sums = self.metric_sums(np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.int64), len(zones), (0.0, 0.0, 0.0, 0.0))
+        
+        for name in sums:
+            
+            sums[name] = np.array([totals[zone][name] for zone in zones], dtype="float")
+        
+        metrics = pd.DataFrame(self.metrics_from_sums(sums), columns=METRIC_COLUMNS)
+        
+        metrics['Pixels'] = sums['n'].astype(np.int64)
+        
+        if zones_tif is None:
+            
+            metrics.index = pd.Index(['All'] * len(zones))
+            
+        else:
+            
+            metrics.index = pd.Index([zone_names[zone] if zone_names is not None else zone for zone in zones], name='Zone')
+        
+        return metrics
 
-        return df
+
+    def metrics_from_sums(self, sums):
+        
+        """
+        Calculates the metrics from the sufficient statistics returned by metric_sums.
+        
+        Parameters:
+        sums (dict): Count and sums, arrays of any matching shape.
+        
+        Returns:
+        metrics (dict): Metric name (METRIC_COLUMNS) to array of metric values.
+        """
+        
+        n = sums['n']
+        
+        with np.errstate(divide="ignore", invalid="ignore"):
+            
+            # 'b' and 'd' are sums of deviations from the shifts, whose sums are 'b0' and 'd0'
+            mean_percentage_bias = (sums['b'] + sums['b0']) / n
+            
+            std_percentage_bias = np.sqrt(np.maximum(sums['bb'] / n - (sums['b'] / n) ** 2, 0))
+            
+            ubrmse = np.sqrt(np.maximum(sums['dd'] / n - (sums['d'] / n) ** 2, 0))
+            
+            squared_error = sums['dd'] + 2 * sums['d0'] / n * sums['d'] + sums['d0'] ** 2 / n
+            
+            # Sums of squared deviations from the group means; rounding residues of constant values are 0
+            ss_observed = sums['oo'] - sums['o'] ** 2 / n
+            
+            ss_observed = np.where(ss_observed <= 1e-12 * sums['oo'], 0.0, ss_observed)
+            
+            ss_predicted = sums['pp'] - sums['p'] ** 2 / n
+            
+            ss_predicted = np.where(ss_predicted <= 1e-12 * sums['pp'], 0.0, ss_predicted)
+            
+            cross_product = sums['op'] - sums['o'] * sums['p'] / n
+            
+            nse = 1 - (squared_error / ss_observed)
+            
+            # Undefined, as in Series.corr, if either side is constant
+            denominator = np.sqrt(ss_observed * ss_predicted)
+            
+            correlation = np.where(denominator > 0, cross_product / denominator, np.nan)
+        
+        return {
+            'Mean Percent Bias': mean_percentage_bias,
+            
+            'Std Percent Bias': std_percentage_bias,
+            
+            'NSE': nse,
+            
+            'Correlation Coefficient': correlation,
+            
+            'ubRMSE': ubrmse
+        }
+
+
+    def inverse_distance_weighted(self, df, tif_file, new_col_name, nodata_value, windowed=False):
+        
+        """
+        Applies inverse distance weighting interpolation to assign values from a raster to DataFrame points.
+        
+        Parameters:
+        df (pandas.DataFrame): DataFrame with latitude and longitude columns.
+        tif_file (str): Path to the raster file (TIFF).
+        new_col_name (str): Name of the new column to store interpolated values.
+        nodata_value (float): Value in the raster representing no data.
+        windowed (bool): If True, read only the raster blocks touched by the stations instead of the full band.
+        
+        Returns:
+        df (pandas.DataFrame): DataFrame with new column containing interpolated values.
+        """
+        
+        sampled = self.sample_rasters(df, {new_col_name: tif_file}, nodata_value, windowed=windowed)
+        
+        df[new_col_name] = sampled[new_col_name]
+
+        return df
+
+
+    def sample_classes(self, df, tif_file, new_col_name, class_names=None, method='nearest', nodata_value=0):
+        
+        """
+        Assigns the class of a categorical raster, e.g. the Koppen-Geiger map, to DataFrame points.
+        
+        Class codes cannot be averaged, so each station takes either the class of the pixel that contains
+        it or the most frequent valid class of its 3x3 neighbourhood. In the majority vote a tie is won by
+        the class of the centre pixel, which helps stations on the coast whose own pixel is water. Only
+        the raster blocks touched by the stations are read.
+        
+        Parameters:
+        df (pandas.DataFrame): DataFrame with latitude and longitude columns.
+        tif_file (str): Path to the categorical raster file (TIFF).
+        new_col_name (str): Name of the new column to store the classes.
+        class_names (dict): Optional mapping of class code to class name, e.g. KOPPEN_GEIGER_CLASSES.
+        method (str): 'nearest' for the pixel containing the station or 'majority' for the 3x3 majority vote.
+        nodata_value (int): Code of the pixels without a class.
+        
+        Returns:
+        df (pandas.DataFrame): DataFrame with new column containing the class codes, or the class names
+                               if class_names is given, and NaN for stations without a class.
+        """
+        
+        if method not in ('nearest', 'majority'):
+            
+            raise ValueError(f"Unknown method: {method}")
+        
+        with rasterio.open(tif_file) as src:
+            
+            row, col = self.station_pixels(src.transform, df['Lat'].values, df['Lon'].values, src.width)
+            
+            # Stations without coordinates get no class; their neighbourhoods would reach real pixels
+            located = np.isfinite(df['Lat'].values.astype("float")) & np.isfinite(df['Lon'].values.astype("float"))
+            
+            row, col = row[located], col[located]
+            
+            if method == 'nearest':
+                
+                rows, cols = row[:, None], col[:, None]
+                
+            else:
+                
+                # Offsets of the 3x3 window, row-major with the centre pixel at index 4
+                offset_r, offset_c = np.divmod(np.arange(9), 3)
+                
+                rows = row[:, None] + offset_r[None, :] - 1
+                
+                cols = col[:, None] + offset_c[None, :] - 1
+                
+                if self.wraps(src.transform, src.width):
+                    
+                    cols = cols % src.width
+            
+            codes = np.full((len(df), rows.shape[1]), np.nan)
+            
+            codes[located] = self.read_pixels(src, rows, cols, -np.inf)
+            
+            if src.nodata is not None:
+                
+                codes[codes == src.nodata] = np.nan
+        
+        codes[codes == nodata_value] = np.nan
+        
+        if method == 'majority':
+            
+            # Votes of each neighbour: the number of valid neighbours sharing its class, plus half for the centre
+            votes = (codes[:, :, None] == codes[:, None, :]).sum(axis=2).astype("float")
+            
+            votes[:, 4] += 0.5
+            
+            votes[np.isnan(codes)] = 0
+            
+            codes = codes[np.arange(len(codes)), np.argmax(votes, axis=1)]
+            
+        else:
+            
+            codes = codes[:, 0]
+        
+        classes = pd.Series(codes, index=df.index)
+        
+        df[new_col_name] = classes.map(class_names) if class_names is not None else classes
+        
+        return df
+
+
+    def sample_rasters(self, df, tif_files, nodata_value, windowed=False, n_workers=1):
+        
+        """
+        Applies inverse distance weighting interpolation for several rasters in one pass over the stations.
+        
+        The station-to-pixel mapping and the IDW weights are computed once per raster grid and reused
+        for every raster that shares the same transform, shape and CRS. The rasters are then read on a
+        pool of n_workers threads, as GDAL reads and decompresses without holding the GIL, so many
+        rasters take about the time of the slowest one. The columns follow the order of tif_files.
+        
+        Parameters:
+        df (pandas.DataFrame): DataFrame with latitude and longitude columns.
+        tif_files (dict): Mapping of output column name to raster file path (TIFF).
+        nodata_value (float): Value in the rasters representing no data.
+        windowed (bool): If True, read only the raster blocks touched by the stations instead of the full band.
+        n_workers (int): Number of threads reading rasters, None for the ThreadPoolExecutor default and 1 to
+                         read them one after another. Without windowed, every thread holds a full band.
+        
+        Returns:
+        sampled (pandas.DataFrame): DataFrame with one column per raster, indexed like df.
+        """
+        
+        neighbourhoods = self.raster_neighbourhoods(df, tif_files)
+        
+        if n_workers == 1:
+            
+            sampled = {col_name: self.sample_raster(tif_file, neighbourhoods[col_name], nodata_value, windowed)
+                       
+                       for col_name, tif_file in tif_files.items()}
+            
+        else:
+            
+            with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                
+                tasks = {col_name: executor.submit(self.sample_raster, tif_file, neighbourhoods[col_name], nodata_value, windowed)
+                         
+                         for col_name, tif_file in tif_files.items()}
+                
+                sampled = {col_name: task.result() for col_name, task in tasks.items()}
+        
+        return pd.DataFrame(sampled, index=df.index)
+
+
+    async def sample_rasters_async(self, df, tif_files, nodata_value, windowed=False, executor=None):
+        
+        """
+        Asyncio version of sample_rasters: the rasters are read in an executor while the event loop runs.
+        
+        Parameters:
+        df (pandas.DataFrame): DataFrame with latitude and longitude columns.
+        tif_files (dict): Mapping of output column name to raster file path (TIFF).
+        nodata_value (float): Value in the rasters representing no data.
+        windowed (bool): If True, read only the raster blocks touched by the stations instead of the full band.
+        executor (concurrent.futures.Executor): Thread pool for the reads, None for the default executor of the loop.
+        
+        Returns:
+        sampled (pandas.DataFrame): DataFrame with one column per raster in the order of tif_files, indexed like df.
+        """
+        
+        loop = asyncio.get_running_loop()
+        
+        neighbourhoods = await loop.run_in_executor(executor, self.raster_neighbourhoods, df, tif_files)
+        
+        values = await asyncio.gather(*(loop.run_in_executor(executor, self.sample_raster, tif_file, neighbourhoods[col_name],
+                                                             
+                                                             nodata_value, windowed)
+                                        
+                                        for col_name, tif_file in tif_files.items()))
+        
+        return pd.DataFrame(dict(zip(tif_files, values)), index=df.index)
+
+
+    def raster_neighbourhoods(self, df, tif_files):
+        
+        """
+        Returns the neighbourhoods and IDW weights of the stations on the grid of every raster.
+        
+        Only the raster headers are read. This runs in the calling thread, so the neighbourhoods of rasters
+        on the same grid are computed (or loaded from cache_dir) once before any raster is read.
+        
+        Parameters:
+        df (pandas.DataFrame): DataFrame with latitude and longitude columns.
+        tif_files (dict): Mapping of output column name to raster file path (TIFF).
+        
+        Returns:
+        neighbourhoods (dict): Column name to (rows, cols, weights), see pixel_neighbourhoods.
+        """
+        
+        lat, lon = df['Lat'].values, df['Lon'].values
+        
+        neighbourhoods = {}
+        
+        for col_name, tif_file in tif_files.items():
+            
+            with rasterio.open(tif_file) as src:
+                
+                # Reuse the neighbourhoods of a previous raster on the same grid
+                neighbourhoods[col_name] = self.station_neighbourhoods(src, lat, lon)
+        
+        return neighbourhoods
+
+
+    def sample_raster(self, tif_file, neighbourhood, nodata_value, windowed=False):
+        
+        """
+        Reads one raster at the station neighbourhoods and returns the IDW value of every station.
+        
+        Parameters:
+        tif_file (str): Path to the raster file (TIFF).
+        neighbourhood (tuple): Rows, cols and weights of the stations on the grid of the raster.
+        nodata_value (float): Value in the raster representing no data.
+        windowed (bool): If True, read only the raster blocks touched by the stations instead of the full band.
+        
+        Returns:
+        values (numpy.ndarray): Interpolated value of every station.
+        """
+        
+        rows, cols, weights = neighbourhood
+        
+        with rasterio.open(tif_file) as src:
+            
+            if windowed:
+                
+                pixel_values = self.read_pixels(src, rows, cols, nodata_value)
+                
+            else:
+                
+                # Read raster data and handle no-data values
+                tiff_array = src.read(1)
+                
+                tiff_array = tiff_array.astype("float")
+                
+                tiff_array[tiff_array < nodata_value] = np.nan
+                
+                pixel_values = self.gather_pixels(tiff_array, rows, cols)
+                
+                del tiff_array
+        
+        return self.weighted_average(pixel_values, weights)
+
+
+    def station_neighbourhoods(self, src, lat, lon):
+        
+        """
+        Returns the 3x3 pixel neighbourhoods and IDW weights of the stations on the grid of a raster.
+        
+        Results are keyed by a hash of the station coordinates and the raster transform, shape and CRS.
+        They are kept on the instance and, when cache_dir is set, saved as .npz files so that later
+        runs against any raster on the same grid skip the coordinate inversion and weight computation.
+        
+        Parameters:
+        src (rasterio.io.DatasetReader): Open raster dataset defining the grid.
+        lat (array-like): Latitudes of the stations.
+        lon (array-like): Longitudes of the stations.
+        
+        Returns:
+        rows, cols, weights (numpy.ndarray): See pixel_neighbourhoods.
+        """
+        
+        lat = np.ascontiguousarray(lat, dtype="float")
+        
+        lon = np.ascontiguousarray(lon, dtype="float")
+        
+        # Hash the station coordinates together with the grid definition
+        key = hashlib.sha1()
+        
+        key.update(lat.tobytes())
+        
+        key.update(lon.tobytes())
+        
+        key.update(repr((tuple(src.transform), src.width, src.height, src.crs.to_wkt() if src.crs else None)).encode())
+        
+        if self.wraps(src.transform, src.width):
+            
+            key.update(b'wrap')
+        
+        key = key.hexdigest()
+        
+        if key in self._neighbourhoods:
+            
+            return self._neighbourhoods[key]
+        
+        cache_file = os.path.join(self.cache_dir, f"idw_{key}.npz") if self.cache_dir else None
+        
+        if cache_file and os.path.exists(cache_file):
+            
+            with np.load(cache_file) as cached:
+                
+                neighbourhood = (cached["rows"].astype(np.int64), cached["cols"].astype(np.int64), cached["weights"])
+        
+        else:
+            
+            neighbourhood = self.pixel_neighbourhoods(src.transform, lat, lon, src.width)
+            
+            if cache_file:
+                
+                os.makedirs(self.cache_dir, exist_ok=True)
+                
+                # Write to a temporary file first so an interrupted run never leaves a partial cache entry; the
+                # name is unique per process and thread, as rasters on the same grid may be sampled concurrently
+                tmp_file = f"{cache_file[:-4]}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+                
+                rows, cols, weights = neighbourhood
+                
+                np.savez(tmp_file, rows=rows.astype(np.int32), cols=cols.astype(np.int32), weights=weights)
+                
+                os.replace(tmp_file, cache_file)
+        
+        self._neighbourhoods[key] = neighbourhood
+        
+        return neighbourhood
+
+
+    def wraps(self, transform, width):
+        
+        """
+        Tells whether a raster is a global grid whose columns span 360 degrees of longitude.
+        
+        Parameters:
+        transform (affine.Affine): Geotransform of the raster.
+        width (int): Number of columns.
+        
+        Returns:
+        wraps (bool): True if the first column follows the last one across the antimeridian.
+        """
+        
+        return transform.b == 0 and abs(abs(transform.a) * width - 360) < abs(transform.a) / 2
+
+
+    def pixel_neighbourhoods(self, transform, lat, lon, width=None):
+        
+        """
+        Converts station coordinates to the 3x3 pixel neighbourhoods used by the IDW interpolation.
+        
+        Global grids (see wraps), including the 0-360 degree grids of ERA5-Land and CMORPH, are handled
+        without rewriting them: the stations are placed on the grid re-centred on -180..180 degrees and the
+        neighbour columns are mapped back with modular indexing, so neighbourhoods also wrap across the
+        antimeridian.
+        
+        Parameters:
+        transform (affine.Affine): Geotransform of the raster.
+        lat (array-like): Latitudes of the stations.
+        lon (array-like): Longitudes of the stations.
+        width (int): Number of columns of the raster, needed to handle global grids.
+        
+        Returns:
+        rows (numpy.ndarray): Row index of each neighbour, shape (n, 9).
+        cols (numpy.ndarray): Column index of each neighbour, shape (n, 9).
+        weights (numpy.ndarray): Inverse distance weight of each neighbour, shape (n, 9).
+        """
+        
+        lat = np.asarray(lat, dtype="float")
+        
+        lon = np.asarray(lon, dtype="float")
+        
+        shift = None
+        
+        if width is not None and self.wraps(transform, width):
+            
+            # Column of the raster that becomes the first one of the grid re-centred on -180
+            shift = int(round((-180 - transform.c) / transform.a)) % width
+            
+            west = transform.c + shift * transform.a
+            
+            west -= 360 * round((west + 180) / 360)
+            
+            transform = Affine(transform.a, transform.b, west, transform.d, transform.e, transform.f)
+            
+            lon = np.mod(lon + 180, 360) - 180
+        
+        # Convert latitude and longitude to raster coordinates for all stations at once
+        col, row = ~transform * (lon, lat)
+        
+        # Stations without coordinates are pushed outside the raster so that they get NaN
+        located = np.isfinite(col) & np.isfinite(row)
+        
+        col = np.where(located, np.rint(col), -2).astype(np.int64)
+        
+        row = np.where(located, np.rint(row), -2).astype(np.int64)
+        
+        # Offsets of the 3x3 window, row-major like the original nested loop
+        offset_r, offset_c = np.divmod(np.arange(9), 3)
+        
+        rows = row[:, None] + offset_r[None, :] - 1
+        
+        cols = col[:, None] + offset_c[None, :] - 1
+        
+        # Distance term kept identical to the previous per-row implementation
+        pixel_lat, pixel_lon = transform * (cols, rows)
+        
+        distances = np.sqrt((lat[:, None] - pixel_lat) ** 2 + (lon[:, None] - pixel_lon) ** 2)
+        
+        with np.errstate(divide="ignore"):
+            
+            weights = 1 / distances
+        
+        if shift is not None:
+            
+            # Columns of the re-centred grid back to raster columns, wrapping around the antimeridian
+            cols = (cols + shift) % width
+        
+        return rows, cols, weights
+
+
+    def station_pixels(self, transform, lat, lon, width=None):
+        
+        """
+        Returns the pixel that contains each station, wrapping the columns of global grids (see wraps).
+        
+        Parameters:
+        transform (affine.Affine): Geotransform of the raster.
+        lat (array-like): Latitudes of the stations.
+        lon (array-like): Longitudes of the stations.
+        width (int): Number of columns of the raster, needed to handle global grids.
+        
+        Returns:
+        row, col (numpy.ndarray): Row and column index of each station, -1 for stations without coordinates.
+        """
+        
+        lat = np.asarray(lat, dtype="float")
+        
+        lon = np.asarray(lon, dtype="float")
+        
+        col, row = ~transform * (lon, lat)
+        
+        located = np.isfinite(col) & np.isfinite(row)
+        
+        col = np.where(located, np.floor(col), -1).astype(np.int64)
+        
+        row = np.where(located, np.floor(row), -1).astype(np.int64)
+        
+        if width is not None and self.wraps(transform, width):
+            
+            col = np.where(located, col % width, -1)
+        
+        return row, col
+
+
+    def gather_pixels(self, tiff_array, rows, cols):
+        
+        """
+        Gathers raster values at the given pixel indices, using NaN for pixels outside the raster.
+        
+        Parameters:
+        tiff_array (numpy.ndarray): 2-D float raster with no-data values set to NaN.
+        rows (numpy.ndarray): Row indices.
+        cols (numpy.ndarray): Column indices, same shape as rows.
+        
+        Returns:
+        values (numpy.ndarray): Gathered values with the same shape as rows.
+        """
+        
+        inside = (rows >= 0) & (rows < tiff_array.shape[0]) & (cols >= 0) & (cols < tiff_array.shape[1])
+        
+        values = tiff_array[np.where(inside, rows, 0), np.where(inside, cols, 0)]
+        
+        values[~inside] = np.nan
+        
+        return values
+
+
+    def read_pixels(self, src, rows, cols, nodata_value):
+        
+        """
+        Reads raster values at the given pixel indices block by block, without loading the full band.
+        
+        Only the internal blocks of the raster that contain at least one requested pixel are read,
+        so memory use depends on the number of pixels requested rather than on the raster size.
+        
+        Parameters:
+        src (rasterio.io.DatasetReader): Open raster dataset.
+        rows (numpy.ndarray): Row indices.
+        cols (numpy.ndarray): Column indices, same shape as rows.
+        nodata_value (float): Values below this threshold are treated as no data.
+        
+        Returns:
+        values (numpy.ndarray): Values with the same shape as rows, NaN outside the raster or for no data.
+        """
+        
+        values = np.full(rows.shape, np.nan)
+        
+        inside = (rows >= 0) & (rows < src.height) & (cols >= 0) & (cols < src.width)
+        
+        r, c = rows[inside], cols[inside]
+        
+        inside_values = np.full(r.shape, np.nan)
+        
+        # Group the requested pixels by the raster block that holds them
+        block_height, block_width = src.block_shapes[0]
+        
+        block_row, block_col = r // block_height, c // block_width
+        
+        block_id = block_row * (src.width // block_width + 1) + block_col
+        
+        order = np.argsort(block_id, kind="stable")
+        
+        blocks, starts = np.unique(block_id[order], return_index=True)
+        
+        ends = np.append(starts[1:], len(order))
+        
+        for start, end in zip(starts, ends):
+            
+            members = order[start:end]
+            
+            row_off = block_row[members[0]] * block_height
+            
+            col_off = block_col[members[0]] * block_width
+            
+            window = Window(col_off, row_off, min(block_width, src.width - col_off), min(block_height, src.height - row_off))
+            
+            # Read the block, keep the requested pixels and handle no-data values
+            block_values = src.read(1, window=window)[r[members] - row_off, c[members] - col_off].astype("float")
+            
+            block_values[block_values < nodata_value] = np.nan
+            
+            inside_values[members] = block_values
+        
+        values[inside] = inside_values
+        
+        return values
+
+
+    def weighted_average(self, pixel_values, weights):
+        
+        """
+        Computes the inverse distance weighted average of each row, ignoring NaN pixels.
+        
+        Parameters:
+        pixel_values (numpy.ndarray): Neighbour values, shape (n, 9), NaN where invalid.
+        weights (numpy.ndarray): Neighbour weights, same shape as pixel_values.
+        
+        Returns:
+        weighted_average (numpy.ndarray): Weighted average per row, NaN if no neighbour is valid.
+        """
+        
+        valid = ~np.isnan(pixel_values)
+        
+        weights = np.where(valid, weights, 0)
+        
+        with np.errstate(invalid="ignore", divide="ignore"):
+            
+            weighted_sum = np.sum(np.where(valid, pixel_values, 0) * weights, axis=1)
+            
+            weighted_average = weighted_sum / np.sum(weights, axis=1)
+        
+        # Rows without any valid neighbour get NaN
+        weighted_average[~valid.any(axis=1)] = np.nan
+        
+        return weighted_average
+
+
+def _tile_sums(window, observed_tif, predicted_tif, zones_tif, zone_names, nodata_value, grid, resampling):
+    
+    # Sufficient statistics of one tile per zone, with the means of the tile as shift
+    from GridAlignment import read_aligned
+    
+    layers = []
+    
+    for tif in (observed_tif, predicted_tif):
+        
+        layer = read_aligned(tif, grid, window, resampling or 'nearest')
+        
+        layer[layer < nodata_value] = np.nan
+        
+        layers.append(layer.ravel())
+    
+    valid = np.isfinite(layers[0]) & np.isfinite(layers[1])
+    
+    if zones_tif is None:
+        
+        zone = np.zeros(valid.shape, dtype=np.int64)
+        
+    else:
+        
+        zone_layer = read_aligned(zones_tif, grid, window, 'nearest').ravel()
+        
+        valid &= np.isfinite(zone_layer)
+        
+        zone = np.where(valid, zone_layer, 0).astype(np.int64)
+        
+        if zone_names is not None:
+            
+            valid &= np.isin(zone, list(zone_names))
+    
+    observed, predicted = layers[0][valid], layers[1][valid]
+    
+    if not len(observed):
+        
+        return [], {}, None
+    
+    zones, codes = np.unique(zone[valid], return_inverse=True)
+    
+    calculator = MetCalculator()
+    
+    shift = calculator.metric_shift(observed, predicted)
+    
+    sums = calculator.metric_sums(observed, predicted, codes, len(zones), shift)
+    
+    return zones.tolist(), sums, shift
+
+
+def _bootstrap_batch(values, group_sizes, seeds):
+    
+    # Metrics of one stratified resample per seed of rows sorted by group, shape (n_resamples, groups, columns)
+    n_resamples = len(seeds)
+    
+    n_groups = len(group_sizes)
+    
+    group_starts = np.concatenate(([0], np.cumsum(group_sizes)[:-1]))
+    
+    row_codes = np.repeat(np.arange(n_groups), group_sizes)
+    
+    draws = np.array([np.random.default_rng(seed).random(len(row_codes)) for seed in seeds]).reshape(n_resamples, -1)
+    
+    # Every row is replaced by a random row of its own group
+    index = np.repeat(group_starts, group_sizes) + (draws * np.repeat(group_sizes, group_sizes)).astype(np.int64)
+    
+    keys = (np.arange(n_resamples)[:, None] * n_groups + row_codes[None, :]).ravel()
+    
+    n_columns = values['o'].shape[1]
+    
+    sums = {}
+    
+    for name, value in values.items():
+        
+        sums[name] = np.stack([np.bincount(keys, weights=value[:, column][index].ravel(), minlength=n_resamples * n_groups)
+                               
+                               for column in range(n_columns)], axis=-1).reshape(n_resamples, n_groups, n_columns)
+    
+    return MetCalculator().metrics_from_sums(sums)
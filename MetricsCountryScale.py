@@ -1,5 +1,6 @@
 import pandas as pd
 from MetricsCalculator import MetCalculator
+from TableIO import read_table
 
 
 def calculate_metrics_by_countries(input_csv, output_csv, countries):
@@ -8,55 +9,33 @@ def calculate_metrics_by_countries(input_csv, output_csv, countries):
     Calculate metrics for specified countries and save the results to a CSV file.
     
     Parameters:
-    - input_csv (str): Path to the input CSV file containing the data.
+    - input_csv (str): Path to the input table (.parquet, .feather or .csv) containing the data.
     - output_csv (str): Path to the output CSV file where metrics will be saved.
     - countries (list): List of country names to calculate metrics for.
     """
     calculator = MetCalculator()
     
-    df_filtered = pd.read_csv(input_csv)
-    
     metrics_dfs = []
     
     # Metrics to be calculated
     metrics = ['R_Final', 'GloREDa', 'GloREDa1.2']
     
+    # Load only the columns used from the filtered table
+    df_filtered = read_table(input_csv, columns=['Country', 'GloRESatE'] + metrics)
+    
+    # Keep only the requested countries
+    country_df = df_filtered[df_filtered['Country'].isin(countries)]
+    
+    simulated = country_df['GloRESatE']
+    
     for metric in metrics:
         
-        metrics_by_country = {}
+        # Calculate metrics for all countries in one pass
+        metrics_df = calculator.grouped_metrics(country_df[metric], simulated, country_df['Country'])
         
-        for country in countries:
-            
-            country_df = df_filtered[df_filtered['Country'] == country]
-            
-            metric_data = country_df[metric]
-            
-            simulated = country_df['GloRESatE']
-            
-            # Calculate metrics
-            mean_pbias, std_pbias, ubrmse = calculator.ubrmse(metric_data, simulated)
-            
-            nse = calculator.nse(metric_data, simulated)
-            
-            correlation = calculator.correlation(metric_data, simulated)
-            
-            metrics_by_country[country] = {
-                
-                'metrics for' : metric,
-                
-                'Mean Percent Bias': mean_pbias,
-                
-                'Std Percent Bias': std_pbias,
-                
-                'NSE': nse,
-                
-                'Correlation Coefficient': correlation,
-                
-                'ubRMSE': ubrmse
-            }
+        metrics_df = metrics_df.reindex(countries)
         
-        # Create DataFrame for current metric
-        metrics_df = pd.DataFrame(metrics_by_country).T
+        metrics_df.insert(0, 'metrics for', metric)
         
         metrics_df.index.name = 'Country'
         
@@ -74,7 +53,7 @@ def main():
     Main function to execute the metrics calculation and saving process.
     """
 
-    input_csv = 'df_filtered.csv'
+    input_csv = 'df_filtered.parquet'
     
     output_csv = 'metrics_by_countries.csv'
     
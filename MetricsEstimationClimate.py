@@ -1,62 +1,54 @@
-import os
 import pandas as pd
-from LongitudeAdjuster import LonAdjuster
-from MetricsCalculator import MetCalculator
-from ClimateExtractor import ClimExtractor
+from MetricsCalculator import MetCalculator, KOPPEN_GEIGER_CLASSES
+from TableIO import read_table, write_table
 
-def data_extraction_from_dataset(input_csv, climate_file, ERA5Land_file, IMERGFinalRun_file, COMPRH_file, GloRESatE_file):
+# Metric column names used in the climate tables
+CLIMATE_METRIC_COLUMNS = {'Mean Percent Bias': 'Mean_PBIAS', 'Std Percent Bias': 'Std_PBIAS', 'ubRMSE': 'UBRMSE',
+                          
+                          'NSE': 'NSE', 'Correlation Coefficient': 'Correlation'}
+
+def data_extraction_from_dataset(input_csv, climate_file, ERA5Land_file, IMERGFinalRun_file, COMPRH_file, GloRESatE_file,
+                                 
+                                 bias_path='Percentage_bias.parquet', export_csv=False, n_workers=None):
     
     """
     Extract and process data from various climate datasets and calculate percentage bias.
     
     Parameters:
     - input_csv (str): Path to the input CSV file.
-    - climate_file (str): Path to the climate TIFF file.
+    - climate_file (str): Path to the Koppen-Geiger climate classification TIFF file.
     - ERA5Land_file (str): Path to the ERA5Land TIFF file.
     - IMERGFinalRun_file (str): Path to the IMERGFinalRun TIFF file.
     - COMPRH_file (str): Path to the CMORPH TIFF file.
     - GloRESatE_file (str): Path to the GloRESatE TIFF file.
+    - bias_path (str): Path to save the table with the percentage biases (.parquet, .feather or .csv).
+    - export_csv (bool): Also save a CSV copy of the percentage bias table.
+    - n_workers (int): Number of threads reading the rasters, None for the default and 1 to read them one by one.
     
     Returns:
     - DataFrame: Processed DataFrame with percentage bias calculations.
     """
     
     # Initialize the necessary objects
-    adjuster = LonAdjuster()
-    
     calculator = MetCalculator()
     
-    climate = ClimExtractor()
-    
-    # Read the input CSV file
-    df_filtered = pd.read_csv(input_csv)
-    
-    # Extract climate values and add them to the DataFrame
-    df_filtered = climate.extract_climate_values(climate_file, df_filtered)
-    
-    # Get current working directory
-    cwd = os.getcwd()
-    
-    # Adjust longitude and save TIFF file for ERA5Land
-    output_ERA5Land_file = os.path.join(cwd, 'ERA5_land.tiff')
-    adjuster.adjust_longitude_and_save_tiff(ERA5Land_file, output_ERA5Land_file)
+    # Read the input table
+    df_filtered = read_table(input_csv)
     
-    # Apply inverse distance weighting for ERA5Land
-    calculator.inverse_distance_weighted(df_filtered, output_ERA5Land_file, "ERA5Land", 0)
+    # Tag each station with its Koppen-Geiger class by a 3x3 majority vote
+    df_filtered = calculator.sample_classes(df_filtered, climate_file, 'ClimateType', KOPPEN_GEIGER_CLASSES, method='majority')
     
-    # Apply inverse distance weighting for IMERGFinalRun
-    calculator.inverse_distance_weighted(df_filtered, IMERGFinalRun_file, "IMERGFinalRun", 0)
+    # Apply inverse distance weighting for all datasets in one pass, reading the rasters concurrently; the
+    # 0-360 degree ERA5Land and CMORPH grids are wrapped by the sampler instead of being re-centred on disk
+    sampled = calculator.sample_rasters(df_filtered, {"ERA5Land": ERA5Land_file,
+                                                      
+                                                      "IMERGFinalRun": IMERGFinalRun_file,
+                                                      
+                                                      "COMPRHFile": COMPRH_file,
+                                                      
+                                                      "GloRESatEfile": GloRESatE_file}, 0, windowed=True, n_workers=n_workers)
     
-    # Adjust longitude and save TIFF file for CMORPH
-    output_CMORPH_file = os.path.join(cwd, 'CMORPH.tiff')
-    
-    adjuster.adjust_longitude_and_save_tiff(COMPRH_file, output_CMORPH_file)
-    
-    # Apply inverse distance weighting for CMORPH
-    calculator.inverse_distance_weighted(df_filtered, output_CMORPH_file, "COMPRHFile", 0)
-    
-    # Apply inverse distance weighting for GloRESatE
-    calculator.inverse_distance_weighted(df_filtered, GloRESatE_file, "GloRESatEfile", 0)
+    df_filtered[sampled.columns] = sampled
     
     # Adjust ERA5Land values
     df_filtered["ERA5Land"] = df_filtered["ERA5Land"] * 1.5597
@@ -82,8 +74,8 @@ def data_extraction_from_dataset(input_csv, climate_file, ERA5Land_file, IMERGFi
     
     df_filtered["PercentGloRESatE"] = ((df_filtered["GloRESatEfile"] - df_filtered["R_Final"]) / df_filtered["R_Final"]) * 100
     
-    # Save the filtered DataFrame to a CSV file
-    df_filtered.to_csv("Percetage_bias.csv")
+    # Save the filtered DataFrame in a columnar format, with an optional CSV export
+    write_table(df_filtered, bias_path, export_csv)
     
     return df_filtered
     
@@ -103,47 +95,19 @@ def calculate_metrics_for_climate_datasets(df_filtered, output_csv):
     metrics_dfs = []
     
     
-    # Iterate through each dataset and climate type
+    # Iterate through each dataset
     for dataset in ['COMPRHFile', 'IMERGFinalRun', 'ERA5Land', 'GloRESatEfile']:
         
-        metrics = {}
-
-        for climate_type in df_filtered['ClimateType'].unique():
-            
-            df_climate = df_filtered[df_filtered['ClimateType'] == climate_type]
-            
-            simulated_values = df_climate[dataset]
-            
-            observed_values = df_climate['R_Final']
-            
-            # Calculate metrics
-            mean_pbias, std_pbias, ubrmse = calculator.ubrmse(observed_values, simulated_values)
-            
-            nse = calculator.nse(observed_values, simulated_values)
-            
-            correlation = calculator.correlation(observed_values, simulated_values)
-            
-            metrics[climate_type] = {
-                
-                'metrics for' : dataset,
-                
-                'Mean_PBIAS': mean_pbias,
-                
-                'Std_PBIAS': std_pbias,
-                
-                'UBRMSE': ubrmse,
-                
-                'NSE': nse,
-                
-                'Correlation': correlation
-            }
-            
-            # Convert metrics to DataFrame
-            metrics_df = pd.DataFrame(metrics).T
-            
-            metrics_df.index.name = 'ClimateType'
-            
-            metrics_dfs.append(metrics_df)
+        # Calculate metrics for all climate types in one pass
+        metrics_df = calculator.grouped_metrics(df_filtered['R_Final'], df_filtered[dataset], df_filtered['ClimateType'])
+        
+        metrics_df = metrics_df[list(CLIMATE_METRIC_COLUMNS)].rename(columns=CLIMATE_METRIC_COLUMNS)
+        
+        metrics_df.insert(0, 'metrics for', dataset)
+        
+        metrics_df.index.name = 'ClimateType'
+        
+        metrics_dfs.append(metrics_df)
     
     # Concatenate all metrics DataFrames and save to CSV
     final_df = pd.concat(metrics_dfs, axis=1)
@@ -162,44 +126,21 @@ def calculate_metrics_for_all_datasets(df_filtered, output_csv):
      """
     calculator = MetCalculator()
     
-    metrics = {}
+    # Calculate metrics for all datasets in a single matrix operation
+    df_metrics_all = calculator.product_metrics(df_filtered['R_Final'],
+                                                
+                                                df_filtered[['COMPRHFile', 'IMERGFinalRun', 'ERA5Land', 'GloRESatEfile']])
     
-    # Iterate through each dataset
-    for dataset in ['COMPRHFile', 'IMERGFinalRun', 'ERA5Land', 'GloRESatEfile']:
-
-        simulated_values = df_filtered[dataset]
-        
-        observed_values = df_filtered['R_Final']
-        
-        # Calculate metrics
-        mean_pbias, std_pbias, ubrmse = calculator.ubrmse(observed_values, simulated_values)
-        
-        nse = calculator.nse(observed_values, simulated_values)
-        
-        correlation = calculator.correlation(observed_values, simulated_values)
-        
-        metrics[dataset] = {
-            'Mean_PBIAS': mean_pbias,
-            
-            'Std_PBIAS': std_pbias,
-            
-            'UBRMSE': ubrmse,
-            
-            'NSE': nse,
-            
-            'Correlation': correlation
-        }
-    
-    # Convert metrics to DataFrame and save to CSV
-    df_metrics_all = pd.DataFrame(metrics).T
+    df_metrics_all = df_metrics_all[list(CLIMATE_METRIC_COLUMNS)].rename(columns=CLIMATE_METRIC_COLUMNS)
     
+    # Save metrics to CSV
     df_metrics_all.to_csv(output_csv)
 
 
 def main():
     
     # Define file paths
-    input_csv = '.../df_filtered.csv'
+    input_csv = '.../df_filtered.parquet'
     
     ERA5Land_file = '.../ERA5Land_mean_2001_2020.tif'
     
@@ -1,65 +1,85 @@
 from MetricsCalculator import MetCalculator
+from TableIO import read_table
 import pandas as pd
 
-def calculate_metrics(df_filtered):
+# Columns of the filtered table used by the global metrics
+COLUMNS = ['R_Final', 'GloREDa', 'GloREDa1.2', 'GloRESatE']
+
+def calculate_metrics(df_filtered, output_csv='metrics.csv'):
     """
     Calculate metrics comparing simulated data to observed data and save results to a CSV file.
 
     Parameters:
     - df_filtered (DataFrame): DataFrame containing observed and simulated values.
+    - output_csv (str): Path to the output CSV file where metrics will be saved.
     """
     
     # Instantiate the MetricsCalculator
     calculator = MetCalculator()
 
-    # Extract columns for comparison
-    simulated = df_filtered['GloRESatE']
-    
-    observed_a = df_filtered['GloREDa']
-    
-    observed_a_1_2 = df_filtered['GloREDa1.2']
-    
-    r_final = df_filtered['R_Final']
-
-    # Calculate metrics
-    mean_pbias_a, std_pbias_a, ubrmse_a = calculator.ubrmse(observed_a, simulated)
-    nse_a = calculator.nse(observed_a, simulated)
-    
-    correlation_a = calculator.correlation(observed_a, simulated)
-
-    mean_pbias_a_1_2, std_pbias_a_1_2, ubrmse_a_1_2 = calculator.ubrmse(observed_a_1_2, simulated)
-    nse_a_1_2 = calculator.nse(observed_a_1_2, simulated)
-    
-    correlation_a_1_2 = calculator.correlation(observed_a_1_2, simulated)
-
-    mean_pbias_r_final, std_pbias_r_final, ubrmse_r_final = calculator.ubrmse(r_final, simulated)
-    nse_r_final = calculator.nse(r_final, simulated)
-    
-    correlation_r_final = calculator.correlation(r_final, simulated)
+    # Calculate metrics of GloRESatE against all three datasets at once
+    metrics_df = calculator.product_metrics(df_filtered[['R_Final', 'GloREDa', 'GloREDa1.2']], df_filtered['GloRESatE'])
 
     # Create a DataFrame to store metrics
     metrics_data = {
         'Metric': ['Percent Bias (mean)', 'Percent Bias (std)', 'NSE', 'Correlation Coefficient', 'ubRMSE'],
         
-        'R_Final': [mean_pbias_r_final, std_pbias_r_final, nse_r_final, correlation_r_final, ubrmse_r_final],
+        'R_Final': metrics_df.loc['R_Final'].values,
         
-        'GloREDa': [mean_pbias_a, std_pbias_a, nse_a, correlation_a, ubrmse_a],
+        'GloREDa': metrics_df.loc['GloREDa'].values,
         
-        'GloREDA1.2': [mean_pbias_a_1_2, std_pbias_a_1_2, nse_a_1_2, correlation_a_1_2, ubrmse_a_1_2],    
+        'GloREDA1.2': metrics_df.loc['GloREDa1.2'].values,    
     }
 
     # Convert to DataFrame and save to CSV
     metrics_df = pd.DataFrame(metrics_data)
     
-    metrics_df.to_csv('metrics.csv', index=False)
+    metrics_df.to_csv(output_csv, index=False)
+
+def calculate_raster_metrics(GloRESatE_tif, reference_tifs, output_csv='metrics_raster.csv', zones_tif=None, zone_names=None,
+                             
+                             nodata_value=1, n_workers=None, resampling=None):
+    """
+    Calculate metrics of GloRESatE against other gridded products over all their valid pixels and save them to a CSV file.
+
+    The rasters are compared block by block on the grid of each reference product (see MetCalculator.raster_metrics).
+    GloRESatE and the zones on other grids need resampling, which aligns them to that grid tile by tile.
+
+    Parameters:
+    - GloRESatE_tif (str): Path to the GloRESatE TIFF file.
+    - reference_tifs (dict): Mapping of product name to TIFF file, e.g. {'GloREDa': 'GloREDa.tif'}.
+    - output_csv (str): Path to the output CSV file where metrics will be saved.
+    - zones_tif (str): Optional raster of zone codes (e.g. continents or Koppen-Geiger classes) for metrics per zone.
+    - zone_names (dict): Optional mapping of zone code to name, e.g. KOPPEN_GEIGER_CLASSES.
+    - nodata_value (float): Pixels below this value are left out; 1 matches the filter of the station data.
+    - n_workers (int): Number of threads, None for one per CPU.
+    - resampling (str): 'nearest', 'bilinear' or 'average' when GloRESatE is on another grid than a reference product,
+                        None if they share the grid.
+    """
+    
+    calculator = MetCalculator()
+    
+    metrics_dfs = []
+    
+    for name, reference_tif in reference_tifs.items():
+        
+        metrics_df = calculator.raster_metrics(reference_tif, GloRESatE_tif, nodata_value, zones_tif, zone_names,
+                                               
+                                               n_workers=n_workers, resampling=resampling)
+        
+        metrics_df.insert(0, 'metrics for', name)
+        
+        metrics_dfs.append(metrics_df)
+    
+    pd.concat(metrics_dfs).to_csv(output_csv)
 
 def main():
     """
     Main function to execute the metric calculation process.
     """
     try:
-        # Load filtered DataFrame
-        df_filtered = pd.read_csv('df_filtered.csv')
+        # Load only the columns used from the filtered table
+        df_filtered = read_table('df_filtered.parquet', columns=COLUMNS)
         
         # Calculate and save metrics
         calculate_metrics(df_filtered)
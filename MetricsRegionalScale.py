@@ -1,5 +1,6 @@
 import pandas as pd
 from MetricsCalculator import MetCalculator
+from TableIO import read_table
 
 
 def calculate_metrics_from_regional_dataset(input_csv, output_csv, countries, india_tif, china_tif, usa_tif):
@@ -8,7 +9,7 @@ def calculate_metrics_from_regional_dataset(input_csv, output_csv, countries, in
     Calculate metrics for specified countries using regional datasets and save results to a CSV file.
     
     Parameters:
-    - input_csv (str): Path to the input CSV file containing the data.
+    - input_csv (str): Path to the input table (.parquet, .feather or .csv) containing the data.
     - output_csv (str): Path to the output CSV file where metrics will be saved.
     - countries (list): List of countries to calculate metrics for.
     - india_tif (str): Path to the TIFF file for India.
@@ -18,14 +19,17 @@ def calculate_metrics_from_regional_dataset(input_csv, output_csv, countries, in
 
     calculator = MetCalculator()
     
-    df_filtered = pd.read_csv(input_csv)
+    # Load only the columns used from the filtered table
+    df_filtered = read_table(input_csv, columns=['Lat', 'Lon', 'Country', 'GloRESatE'])
     
     # Process regional data
-    calculator.inverse_distance_weighted(df_filtered, india_tif, 'R_India', nodata_value=0)
+    sampled = calculator.sample_rasters(df_filtered, {'R_India': india_tif,
+                                                      
+                                                      'R_China': china_tif,
+                                                      
+                                                      'R_United States': usa_tif}, nodata_value=0)
     
-    calculator.inverse_distance_weighted(df_filtered, china_tif, 'R_China', nodata_value=0)
-    
-    calculator.inverse_distance_weighted(df_filtered, usa_tif, 'R_United States', nodata_value=0)
+    df_filtered[sampled.columns] = sampled
     
     
     metrics_by_country = {}
@@ -90,7 +94,7 @@ def main():
     Main function to execute the metrics calculation and saving process.
     """
 
-    input_csv = 'df_filtered.csv'
+    input_csv = 'df_filtered.parquet'
     
     output_csv = 'metrics_by_Region.csv'
     
@@ -0,0 +1,392 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import hashlib
+import importlib
+import json
+import os
+from TableIO import read_table
+
+
+class Stage:
+
+    """
+    One step of the pipeline: a function called with its input paths, output paths and parameters as
+    keyword arguments.
+
+    The function is given as 'module.function' and imported when the stage runs, so that stages whose
+    modules need optional inputs or packages do not affect the others. A stage depends on every stage
+    that writes one of its inputs.
+    """
+
+    def __init__(self, name, func, inputs=None, outputs=None, params=None):
+
+        self.name = name
+
+        self.func = func
+
+        self.inputs = dict(inputs or {})
+
+        self.outputs = dict(outputs or {})
+
+        self.params = dict(params or {})
+
+
+def run_pipeline(stages, state_file='pipeline_state.json', n_workers=None, force=False):
+
+    """
+    Runs the stages in dependency order, skipping the ones whose outputs are up to date.
+
+    A stage is up to date when its function, its parameters and the content (SHA-1) of all its input files
+    and directories are the ones of its last run and its outputs are unchanged since then. Changing one
+    raster therefore only reruns the stages that read it and, if their outputs change, the stages after
+    them. Stages that do not depend on each other run concurrently on a process pool. Hashes are cached
+    by file size and modification time, so unchanged inputs are not read again.
+
+    Parameters:
+    stages (list): Stage objects, in any order.
+    state_file (str): JSON file keeping the hashes of the last runs.
+    n_workers (int): Number of worker processes, None for one per CPU and 1 to run in this process.
+    force (bool): Run all stages even when they are up to date.
+
+    Returns:
+    status (dict): 'ran' or 'skipped' for every stage name.
+    """
+
+    state = {'stages': {}, 'files': {}}
+
+    if os.path.exists(state_file):
+
+        with open(state_file) as f:
+
+            state = json.load(f)
+
+    writers = {os.path.abspath(path): stage.name for stage in stages for path in stage.outputs.values()}
+
+    if len(writers) < sum(len(stage.outputs) for stage in stages):
+
+        raise ValueError("Two stages write the same output.")
+
+    upstream = {stage.name: {writers[os.path.abspath(path)] for path in stage.inputs.values()
+
+                             if os.path.abspath(path) in writers} for stage in stages}
+
+    by_name = {stage.name: stage for stage in stages}
+
+    status = {}
+
+    def ready():
+
+        # Stages whose upstream stages are all finished
+        return [name for name in by_name if name not in status and name not in running and upstream[name] <= set(status)]
+
+    def start(name):
+
+        # Start the stage, or mark it as skipped when it is up to date
+        stage = by_name[name]
+
+        key = _stage_key(stage, state['files'])
+
+        previous = state['stages'].get(name, {})
+
+        if not force and previous.get('key') == key and _outputs_unchanged(stage, previous.get('outputs', {}), state['files']):
+
+            print(f"{name}: up to date")
+
+            status[name] = 'skipped'
+
+            return None
+
+        print(f"{name}: running")
+
+        for path in stage.outputs.values():
+
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        running[name] = key
+
+        return stage
+
+    def finish(name):
+
+        stage = by_name[name]
+
+        outputs = {path: _content_hash(path, state['files']) for path in stage.outputs.values()}
+
+        state['stages'][name] = {'key': running.pop(name), 'outputs': outputs}
+
+        status[name] = 'ran'
+
+        # Save after every stage so that finished work is kept if a later stage fails
+        os.makedirs(os.path.dirname(os.path.abspath(state_file)), exist_ok=True)
+
+        with open(state_file, 'w') as f:
+
+            json.dump(state, f, indent=1)
+
+    running = {}
+
+    if n_workers == 1:
+
+        while len(status) < len(stages):
+
+            names = ready()
+
+            if not names:
+
+                raise ValueError("The stages have a dependency cycle.")
+
+            for name in names:
+
+                stage = start(name)
+
+                if stage is not None:
+
+                    _run_stage(stage.func, stage.inputs, stage.outputs, stage.params)
+
+                    finish(name)
+
+        return status
+
+    with ProcessPoolExecutor(max_workers=n_workers or os.cpu_count()) as executor:
+
+        pending = {}
+
+        while len(status) < len(stages):
+
+            for name in ready():
+
+                stage = start(name)
+
+                if stage is not None:
+
+                    pending[executor.submit(_run_stage, stage.func, stage.inputs, stage.outputs, stage.params)] = name
+
+            if pending:
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+                for task in done:
+
+                    task.result()
+
+                    finish(pending.pop(task))
+
+            elif len(status) < len(stages) and not ready():
+
+                raise ValueError("The stages have a dependency cycle.")
+
+    return status
+
+
+def _run_stage(func, inputs, outputs, params):
+
+    module, name = func.rsplit('.', 1)
+
+    getattr(importlib.import_module(module), name)(**inputs, **outputs, **params)
+
+
+def _stage_key(stage, file_hashes):
+
+    # Hash of the function, the parameters and the content of the inputs
+    inputs = {arg: _content_hash(path, file_hashes) for arg, path in sorted(stage.inputs.items())}
+
+    description = json.dumps({'func': stage.func, 'params': stage.params, 'inputs': inputs,
+
+                              'outputs': stage.outputs}, sort_keys=True, default=str)
+
+    return hashlib.sha1(description.encode()).hexdigest()
+
+
+def _outputs_unchanged(stage, recorded, file_hashes):
+
+    return all(os.path.exists(path) and recorded.get(path) == _content_hash(path, file_hashes)
+
+               for path in stage.outputs.values())
+
+
+def _content_hash(path, file_hashes):
+
+    # SHA-1 of a file, or of the names and hashes of the files of a directory, cached by size and mtime
+    if os.path.isdir(path):
+
+        digest = hashlib.sha1()
+
+        for name in sorted(os.listdir(path)):
+
+            digest.update(f"{name}:{_content_hash(os.path.join(path, name), file_hashes)};".encode())
+
+        return digest.hexdigest()
+
+    if not os.path.exists(path):
+
+        return None
+
+    info = os.stat(path)
+
+    cached = file_hashes.get(path)
+
+    if cached and cached[0] == info.st_size and cached[1] == info.st_mtime_ns:
+
+        return cached[2]
+
+    digest = hashlib.sha1()
+
+    with open(path, 'rb') as f:
+
+        for block in iter(lambda: f.read(1 << 20), b''):
+
+            digest.update(block)
+
+    file_hashes[path] = [info.st_size, info.st_mtime_ns, digest.hexdigest()]
+
+    return file_hashes[path][2]
+
+
+def global_metrics(input_csv, output_csv):
+
+    """
+    Pipeline stage of MetricsGlobalData: metrics of GloRESatE against the station data and the GloREDa datasets.
+
+    Parameters:
+    input_csv (str): Path of the extracted station table.
+    output_csv (str): Path of the metrics table.
+    """
+
+    from MetricsGlobalData import calculate_metrics, COLUMNS
+
+    calculate_metrics(read_table(input_csv, columns=COLUMNS), output_csv)
+
+
+def climate_metrics(input_csv, climate_file, ERA5Land_file, IMERGFinalRun_file, COMPRH_file, GloRESatE_file,
+
+                    bias_path, climate_csv, all_csv):
+
+    """
+    Pipeline stage of MetricsEstimationClimate: metrics per climate type and for all stations.
+
+    Parameters:
+    input_csv (str): Path of the extracted station table.
+    climate_file, ERA5Land_file, IMERGFinalRun_file, COMPRH_file, GloRESatE_file (str): Paths of the rasters.
+    bias_path (str): Path of the table with the percentage biases.
+    climate_csv (str): Path of the metrics per climate type.
+    all_csv (str): Path of the metrics for all stations.
+    """
+
+    from MetricsEstimationClimate import (data_extraction_from_dataset, calculate_metrics_for_climate_datasets,
+
+                                          calculate_metrics_for_all_datasets)
+
+    df_filtered = data_extraction_from_dataset(input_csv, climate_file, ERA5Land_file, IMERGFinalRun_file, COMPRH_file,
+
+                                               GloRESatE_file, bias_path)
+
+    calculate_metrics_for_climate_datasets(df_filtered, climate_csv)
+
+    calculate_metrics_for_all_datasets(df_filtered, all_csv)
+
+
+def default_stages(paths, output_dir='.', countries=('India', 'United States', 'China', 'Italy'),
+
+                   regional_countries=('India', 'China', 'United States')):
+
+    """
+    Declares the workflow of this repository: the extraction of GlobalDataExtractor followed by the
+    metric scripts, which all read its station table.
+
+    Parameters:
+    paths (dict): Input paths: 'stations_csv', 'GloRESatE_tif', 'GloREDa_tif' and 'GloREDa1_2_dir', and
+                  optionally 'india_tif', 'china_tif' and 'usa_tif' (regional stage) and 'climate_file',
+                  'ERA5Land_file', 'IMERGFinalRun_file' and 'COMPRH_file' (climate stage).
+    output_dir (str): Directory of the outputs.
+    countries (tuple): Countries of the country-scale metrics.
+    regional_countries (tuple): Countries of the regional-scale metrics.
+
+    Returns:
+    stages (list): Stage objects for run_pipeline.
+    """
+
+    def output(name):
+
+        return os.path.join(output_dir, name)
+
+    stations = output('df_filtered.parquet')
+
+    stages = [
+
+        Stage('extract', 'GlobalDataExtractor.main',
+
+              inputs={'input_csv': paths['stations_csv'], 'GloRESatE_tif': paths['GloRESatE_tif'],
+
+                      'GloREDa_tif': paths['GloREDa_tif'], 'GloREDa1_2_dir': paths['GloREDa1_2_dir']},
+
+              outputs={'output_path': stations}),
+
+        Stage('global', 'Pipeline.global_metrics', inputs={'input_csv': stations},
+
+              outputs={'output_csv': output('metrics.csv')}),
+
+        Stage('continent', 'MetricsContinentScale.calculate_metrics_by_continent', inputs={'input_csv': stations},
+
+              outputs={'output_csv': output('metrics_by_continent.csv')}),
+
+        Stage('country', 'MetricsCountryScale.calculate_metrics_by_countries', inputs={'input_csv': stations},
+
+              outputs={'output_csv': output('metrics_by_countries.csv')}, params={'countries': list(countries)})
+
+    ]
+
+    if 'india_tif' in paths:
+
+        stages.append(Stage('regional', 'MetricsRegionalScale.calculate_metrics_from_regional_dataset',
+
+                            inputs={'input_csv': stations, 'india_tif': paths['india_tif'],
+
+                                    'china_tif': paths['china_tif'], 'usa_tif': paths['usa_tif']},
+
+                            outputs={'output_csv': output('metrics_by_Region.csv')},
+
+                            params={'countries': list(regional_countries)}))
+
+    if 'climate_file' in paths:
+
+        stages.append(Stage('climate', 'Pipeline.climate_metrics',
+
+                            inputs={'input_csv': stations, 'climate_file': paths['climate_file'],
+
+                                    'ERA5Land_file': paths['ERA5Land_file'],
+
+                                    'IMERGFinalRun_file': paths['IMERGFinalRun_file'],
+
+                                    'COMPRH_file': paths['COMPRH_file'], 'GloRESatE_file': paths['GloRESatE_tif']},
+
+                            outputs={'bias_path': output('Percentage_bias.parquet'), 'climate_csv': output('metrics_climate.csv'),
+
+                                     'all_csv': output('metrics_all.csv')}))
+
+    return stages
+
+
+def main():
+
+    # Define file paths
+    paths = {'stations_csv': 'path_to_input_csv.csv',
+
+             'GloRESatE_tif': 'path_to_GloRESatE.tif',
+
+             'GloREDa_tif': 'path_to_GloREDa.tif',
+
+             'GloREDa1_2_dir': 'path_to_GloREDa1.2_directory',
+
+             'india_tif': 'path/to/India_tif_file.tif',
+
+             'china_tif': 'path/to/China_tif_file.tif',
+
+             'usa_tif': 'path/to/USA_tif_file.tif'}
+
+    status = run_pipeline(default_stages(paths, output_dir='outputs'), state_file='outputs/pipeline_state.json')
+
+    print(status)
+
+
+if __name__ == "__main__":
+
+    main()
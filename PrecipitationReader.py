@@ -0,0 +1,334 @@
+import os
+import numpy as np
+
+# Dimension names recognised as the latitude and longitude axes of NetCDF and HDF5 variables
+LAT_NAMES = ('lat', 'latitude', 'y')
+
+LON_NAMES = ('lon', 'longitude', 'x')
+
+
+def stream_array(cube, chunk_steps, window=None):
+
+    """
+    Yields consecutive time chunks of a (time, lat, lon) array.
+
+    Parameters:
+    cube (numpy.ndarray): Precipitation cube, possibly memory-mapped.
+    chunk_steps (int): Number of time steps per chunk.
+    window (tuple): Optional spatial window (row_off, col_off, height, width).
+
+    Yields:
+    block (numpy.ndarray): Float array of shape (time steps, rows, cols), NaN for missing values.
+    """
+
+    row_off, col_off, height, width = window or (0, 0, cube.shape[1], cube.shape[2])
+
+    for start in range(0, cube.shape[0], chunk_steps):
+
+        yield _as_precipitation(cube[start:start + chunk_steps, row_off:row_off + height, col_off:col_off + width])
+
+
+def stream_npy(path, chunk_steps, window=None):
+
+    """
+    Yields consecutive time chunks of a (time, lat, lon) .npy stack through a memory map.
+
+    Parameters:
+    path (str): Path of the .npy file.
+    chunk_steps (int): Number of time steps per chunk.
+    window (tuple): Optional spatial window (row_off, col_off, height, width).
+
+    Yields:
+    block (numpy.ndarray): Float array of shape (time steps, rows, cols), NaN for missing values.
+    """
+
+    yield from stream_array(np.load(path, mmap_mode='r'), chunk_steps, window)
+
+
+def stream_hdf5(paths, variable, chunk_steps, window=None):
+
+    """
+    Yields consecutive time chunks from one or more HDF5 (or NetCDF-4) files, in the given order.
+
+    Each file holds the variable either with a time axis or as a single time step. The order of the lat
+    and lon axes and the direction of the latitudes are read from the dimension scales of the dataset,
+    so IMERG files, stored as (time, lon, lat) with the latitudes from south to north, are returned north
+    up like the other sources. Datasets without dimension scales are taken as (time, lat, lon) north up.
+
+    Parameters:
+    paths (str or list): Path of the file, or paths of consecutive files.
+    variable (str): Path of the dataset inside the files, e.g. 'Grid/precipitation'.
+    chunk_steps (int): Number of time steps per chunk.
+    window (tuple): Optional spatial window (row_off, col_off, height, width) of the north-up grid.
+
+    Yields:
+    block (numpy.ndarray): Float array of shape (time steps, rows, cols), north up, NaN for missing values.
+    """
+
+    import h5py
+
+    def slices():
+
+        for path in _as_list(paths):
+
+            with h5py.File(path, 'r') as src:
+
+                dataset = src[variable]
+
+                yield from _dataset_slices(dataset, chunk_steps, window, _hdf5_layout(dataset))
+
+    yield from _rebatch(slices(), chunk_steps)
+
+
+def stream_netcdf(paths, variable, chunk_steps, window=None):
+
+    """
+    Yields consecutive time chunks from one or more NetCDF files, in the given order.
+
+    The order of the lat and lon axes is read from the dimension names of the variable and the direction
+    of the latitudes from the latitude coordinate variable, as for stream_hdf5.
+
+    Parameters:
+    paths (str or list): Path of the file, or paths of consecutive files.
+    variable (str): Name of the precipitation variable, e.g. 'tp'.
+    chunk_steps (int): Number of time steps per chunk.
+    window (tuple): Optional spatial window (row_off, col_off, height, width) of the north-up grid.
+
+    Yields:
+    block (numpy.ndarray): Float array of shape (time steps, rows, cols), north up, NaN for missing values.
+    """
+
+    import netCDF4
+
+    def slices():
+
+        for path in _as_list(paths):
+
+            with netCDF4.Dataset(path) as src:
+
+                variable_data = src.variables[variable]
+
+                yield from _dataset_slices(variable_data, chunk_steps, window, _netcdf_layout(src, variable_data))
+
+    yield from _rebatch(slices(), chunk_steps)
+
+
+def stream_precipitation(source, chunk_steps, variable=None, window=None):
+
+    """
+    Yields consecutive time chunks of precipitation from an array or from files on disk.
+
+    Parameters:
+    source (numpy.ndarray, str or list): A (time, lat, lon) array, or the path(s) of .npy, NetCDF (.nc, .nc4)
+                                         or HDF5 (.h5, .hdf5, .he5) files.
+    chunk_steps (int): Number of time steps per chunk.
+    variable (str): Name of the precipitation variable for NetCDF and HDF5 files.
+    window (tuple): Optional spatial window (row_off, col_off, height, width).
+
+    Yields:
+    block (numpy.ndarray): Float array of shape (time steps, rows, cols), NaN for missing values.
+    """
+
+    if isinstance(source, np.ndarray):
+
+        return stream_array(source, chunk_steps, window)
+
+    extension = os.path.splitext(_as_list(source)[0])[1].lower()
+
+    if extension == '.npy':
+
+        return _chain(stream_npy(path, chunk_steps, window) for path in _as_list(source))
+
+    if extension in ('.nc', '.nc4'):
+
+        return stream_netcdf(source, variable, chunk_steps, window)
+
+    if extension in ('.h5', '.hdf5', '.he5'):
+
+        return stream_hdf5(source, variable, chunk_steps, window)
+
+    raise ValueError(f"Unsupported precipitation file type: {extension}")
+
+
+def grid_shape(source, variable=None):
+
+    """
+    Returns the (lat, lon) shape of the grid of a precipitation source without reading its data.
+
+    For NetCDF and HDF5 files the axes are ordered as in stream_netcdf and stream_hdf5, so the shape
+    is the one of the north-up blocks they yield.
+
+    Parameters:
+    source (numpy.ndarray, str or list): See stream_precipitation.
+    variable (str): Name of the precipitation variable for NetCDF and HDF5 files.
+
+    Returns:
+    shape (tuple): Number of rows and columns of the grid.
+    """
+
+    if isinstance(source, np.ndarray):
+
+        return source.shape[-2:]
+
+    path = _as_list(source)[0]
+
+    extension = os.path.splitext(path)[1].lower()
+
+    if extension == '.npy':
+
+        return np.load(path, mmap_mode='r').shape[-2:]
+
+    if extension in ('.nc', '.nc4'):
+
+        import netCDF4
+
+        with netCDF4.Dataset(path) as src:
+
+            variable_data = src.variables[variable]
+
+            return _grid_shape(variable_data.shape, _netcdf_layout(src, variable_data))
+
+    import h5py
+
+    with h5py.File(path, 'r') as src:
+
+        return _grid_shape(src[variable].shape, _hdf5_layout(src[variable]))
+
+
+def _as_list(paths):
+
+    return [paths] if isinstance(paths, str) else list(paths)
+
+
+def _chain(generators):
+
+    for generator in generators:
+
+        yield from generator
+
+
+def _as_precipitation(block):
+
+    # Negative values are the fill values of the satellite products
+    block = np.array(np.ma.filled(block, np.nan), dtype="float")
+
+    block[block < 0] = np.nan
+
+    return block
+
+
+def _grid_layout(names, latitudes):
+
+    # (transposed, flipped): whether the last two axes are (lon, lat) and whether the latitudes run south to north
+    names = [name.rsplit('/', 1)[-1].lower() for name in names]
+
+    transposed = len(names) >= 2 and names[-2] in LON_NAMES and names[-1] in LAT_NAMES
+
+    flipped = latitudes is not None and len(latitudes) > 1 and float(latitudes[-1]) > float(latitudes[0])
+
+    return transposed, flipped
+
+
+def _hdf5_layout(dataset):
+
+    # Dimension names and latitudes from the dimension scales attached to the dataset
+    names, latitudes = [], None
+
+    for dim in dataset.dims:
+
+        scale = dim[0] if len(dim) else None
+
+        name = dim.label or (scale.name if scale is not None else '')
+
+        names.append(name)
+
+        if scale is not None and name.rsplit('/', 1)[-1].lower() in LAT_NAMES:
+
+            latitudes = scale
+
+    return _grid_layout(names, latitudes)
+
+
+def _netcdf_layout(src, variable):
+
+    # Dimension names of the variable and latitudes from the coordinate variable of the same name
+    latitude = next((name for name in variable.dimensions if name.lower() in LAT_NAMES and name in src.variables), None)
+
+    return _grid_layout(variable.dimensions, src.variables[latitude] if latitude else None)
+
+
+def _grid_shape(shape, layout):
+
+    n_rows, n_cols = shape[-2:]
+
+    return (n_cols, n_rows) if layout[0] else (n_rows, n_cols)
+
+
+def _dataset_slices(dataset, chunk_steps, window, layout=(False, False)):
+
+    transposed, flipped = layout
+
+    n_rows, n_cols = _grid_shape(dataset.shape, layout)
+
+    row_off, col_off, height, width = window or (0, 0, n_rows, n_cols)
+
+    # Rows of the window in the stored latitude order, then the axes in the stored order
+    rows = slice(n_rows - row_off - height, n_rows - row_off) if flipped else slice(row_off, row_off + height)
+
+    cols = slice(col_off, col_off + width)
+
+    spatial = (cols, rows) if transposed else (rows, cols)
+
+    def north_up(block):
+
+        block = _as_precipitation(block)
+
+        if transposed:
+
+            block = block.swapaxes(-1, -2)
+
+        if flipped:
+
+            block = block[..., ::-1, :]
+
+        return np.ascontiguousarray(block)
+
+    if dataset.ndim == 2:
+
+        yield north_up(dataset[spatial])[None]
+
+        return
+
+    for start in range(0, dataset.shape[0], chunk_steps):
+
+        yield north_up(dataset[(slice(start, start + chunk_steps),) + spatial])
+
+
+def _rebatch(slices, chunk_steps):
+
+    # Join pieces from consecutive files into chunks of chunk_steps time steps
+    pieces = []
+
+    n_steps = 0
+
+    for piece in slices:
+
+        pieces.append(piece)
+
+        n_steps += len(piece)
+
+        if n_steps >= chunk_steps:
+
+            joined = np.concatenate(pieces)
+
+            for start in range(0, n_steps - chunk_steps + 1, chunk_steps):
+
+                yield joined[start:start + chunk_steps]
+
+            rest = joined[(n_steps // chunk_steps) * chunk_steps:]
+
+            pieces, n_steps = ([rest], len(rest)) if len(rest) else ([], 0)
+
+    if pieces:
+
+        yield np.concatenate(pieces)
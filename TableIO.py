@@ -0,0 +1,74 @@
+import os
+import pandas as pd
+
+
+def read_table(path, columns=None):
+
+    """
+    Reads a station table from Parquet, Feather or CSV, loading only the requested columns.
+
+    Parquet and Feather keep the column types and the full float precision and only read the
+    requested columns from disk. CSV files are still accepted, e.g. for the input data from Zenodo.
+
+    Parameters:
+    path (str): Path of the .parquet, .feather or .csv file.
+    columns (list): Columns to load, None for all.
+
+    Returns:
+    df (pandas.DataFrame): The table.
+    """
+
+    extension = os.path.splitext(path)[1].lower()
+
+    if extension in ('.parquet', '.pq'):
+
+        return pd.read_parquet(path, columns=columns)
+
+    if extension == '.feather':
+
+        return pd.read_feather(path, columns=columns)
+
+    if extension == '.csv':
+
+        return pd.read_csv(path, usecols=columns)
+
+    raise ValueError(f"Unsupported table file type: {extension}")
+
+
+def write_table(df, path, export_csv=False):
+
+    """
+    Writes a station table as Parquet or Feather (or CSV), optionally with a CSV copy for export.
+
+    Parameters:
+    df (pandas.DataFrame): Table to write.
+    path (str): Path of the .parquet, .feather or .csv file.
+    export_csv (bool): Also write the table to a .csv file with the same name.
+
+    Returns:
+    path (str): Path of the written table.
+    """
+
+    extension = os.path.splitext(path)[1].lower()
+
+    if extension in ('.parquet', '.pq'):
+
+        df.to_parquet(path, index=False)
+
+    elif extension == '.feather':
+
+        df.reset_index(drop=True).to_feather(path)
+
+    elif extension == '.csv':
+
+        df.to_csv(path, index=False)
+
+    else:
+
+        raise ValueError(f"Unsupported table file type: {extension}")
+
+    if export_csv and extension != '.csv':
+
+        df.to_csv(os.path.splitext(path)[0] + '.csv', index=False)
+
+    return path
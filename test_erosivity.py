@@ -0,0 +1,236 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+from Erosivity import erosivity30, erosivity60, SETTINGS_30MIN, SETTINGS_60MIN
+from ErosivityGrid import calendar_index, tile_rfactor, rfactor_grid
+
+# Expected EI values are computed by hand from the McGregor unit energy
+# e = 0.29 * (1 - 0.72 * exp(-0.082 * i)), as in Erosivity30.m and Erosivity60.m:
+#   30 min: 4 steps of 20 mm/h (10 mm each): 4 * 10 * e(20) * 20
+EI_30_STORM = 199.5975737357294
+#   30 min: 8 steps of 20 mm/h in one storm: 8 * 10 * e(20) * 20
+EI_30_MERGED = 399.1951474714588
+#   60 min: 4, 10 and 6 mm in three hours: (4 e(4) + 10 e(10) + 6 e(6)) * 10
+EI_60_STORM = 35.12766627418764
+#   60 min: 3 hours of 8 mm: 3 * 8 * e(8) * 8
+EI_60_FLAT = 34.87658930358014
+
+
+def series(*parts):
+
+    return np.concatenate([np.asarray(part, dtype=float) for part in parts])
+
+
+def dry(n_steps):
+
+    return np.zeros(n_steps)
+
+
+def test_erosivity30_single_storm():
+
+    ei = erosivity30(series(dry(20), [20] * 4, dry(30)))
+
+    np.testing.assert_allclose(ei[:-1], [EI_30_STORM])
+
+
+def test_erosivity30_ends_with_nan():
+
+    # Like the MATLAB scripts, the last entry is always NaN, also without any storm
+    assert np.isnan(erosivity30(series(dry(20), [20] * 4, dry(30)))[-1])
+
+    ei = erosivity30(dry(48))
+
+    assert len(ei) == 1 and np.isnan(ei[0])
+
+
+def test_erosivity30_non_erosive_storm():
+
+    # 2 steps of 2.5 mm: below the 12.7 mm depth and peak thresholds
+    ei = erosivity30(series(dry(20), [20] * 4, dry(30), [5] * 2, dry(30)))
+
+    np.testing.assert_allclose(ei[:-1], [EI_30_STORM, np.nan])
+
+
+def test_erosivity30_dry_gap_split():
+
+    # A 6 hour dry gap (12 steps) splits the storms, a shorter one does not
+    split = erosivity30(series(dry(20), [20] * 4, dry(12), [20] * 4, dry(30)))
+
+    merged = erosivity30(series(dry(20), [20] * 4, dry(11), [20] * 4, dry(30)))
+
+    np.testing.assert_allclose(split[:-1], [EI_30_STORM, EI_30_STORM])
+
+    np.testing.assert_allclose(merged[:-1], [EI_30_MERGED])
+
+
+def test_erosivity30_nan_gap():
+
+    # Missing steps end the storm before them, as moving sums over a gap are NaN
+    ei = erosivity30(series(dry(20), [20] * 4, dry(4), [np.nan] * 3, dry(4), [20] * 4, dry(30)))
+
+    np.testing.assert_allclose(ei[:-1], [EI_30_STORM, EI_30_STORM])
+
+
+def test_erosivity30_series_ending_in_nan():
+
+    ei = erosivity30(series(dry(20), [20] * 4, dry(4), [np.nan] * 12))
+
+    np.testing.assert_allclose(ei[:-1], [EI_30_STORM])
+
+    assert np.isnan(ei[-1])
+
+
+def test_erosivity60_storms():
+
+    # Hourly intensities are in m/h
+    ei = erosivity60(series(dry(10), [0.004, 0.010, 0.006], dry(10), [0.005] * 2, dry(10)))
+
+    np.testing.assert_allclose(ei, [EI_60_STORM, np.nan, np.nan])
+
+
+def test_erosivity60_dry_gap_split():
+
+    split = erosivity60(series(dry(10), [0.004, 0.010, 0.006], dry(6), [0.008] * 3, dry(10)))
+
+    merged = erosivity60(series(dry(10), [0.004, 0.010, 0.006], dry(5), [0.008] * 3, dry(10)))
+
+    np.testing.assert_allclose(split[:-1], [EI_60_STORM, EI_60_FLAT])
+
+    x = np.array([4, 10, 6, 8, 8, 8])
+
+    np.testing.assert_allclose(merged[:-1], [np.sum(x * 0.29 * (1 - 0.72 * np.exp(-0.082 * x))) * 10])
+
+
+def test_erosivity60_nan_gap_and_end():
+
+    ei = erosivity60(series(dry(10), [0.004, 0.010, 0.006], dry(2), [np.nan], dry(2), [0.008] * 3, dry(3), [np.nan] * 6))
+
+    np.testing.assert_allclose(ei[:-1], [EI_60_STORM, EI_60_FLAT])
+
+    assert np.isnan(ei[-1])
+
+
+@pytest.mark.parametrize("chunk_steps", [7, 1000])
+def test_rfactor_30min(chunk_steps):
+
+    # One storm at the end of 2001 and one in January 2002: R is the mean over the two years
+    prc = series(dry(20), [20] * 4, dry(56), [20] * 4, dry(30))
+
+    times = np.datetime64('2001-12-31T12:00') + np.arange(len(prc)) * np.timedelta64(30, 'm')
+
+    years, months = calendar_index(times)
+
+    cube = prc.reshape(-1, 1, 1)
+
+    blocks = (cube[start:start + chunk_steps] for start in range(0, len(cube), chunk_steps))
+
+    annual, monthly = tile_rfactor(blocks, (1, 1), years, months, SETTINGS_30MIN)
+
+    np.testing.assert_allclose(annual, [[EI_30_STORM]])
+
+    np.testing.assert_allclose(monthly[[0, 11], 0, 0], [EI_30_STORM / 2, EI_30_STORM / 2])
+
+    np.testing.assert_allclose(np.delete(monthly[:, 0, 0], [0, 11]), 0)
+
+
+def test_rfactor_60min():
+
+    prc = series(dry(10), [0.004, 0.010, 0.006], dry(6), [0.008] * 3, dry(10), [0.005] * 2, dry(10))
+
+    times = np.datetime64('2010-07-01T00:00') + np.arange(len(prc)) * np.timedelta64(1, 'h')
+
+    years, months = calendar_index(times)
+
+    annual, monthly = tile_rfactor([prc.reshape(-1, 1, 1)], (1, 1), years, months, SETTINGS_60MIN)
+
+    np.testing.assert_allclose(annual, [[EI_60_STORM + EI_60_FLAT]])
+
+    np.testing.assert_allclose(monthly[6], [[EI_60_STORM + EI_60_FLAT]])
+
+
+@pytest.mark.parametrize("steps", [slice(None), slice(96, None)])
+def test_rfactor_grid_memmap(tmp_path, steps):
+
+    # Memory-mapped cubes, also time slices of them, are read by the workers from the file
+    rng = np.random.default_rng(0)
+
+    cube = ((rng.random((480, 5, 7)) < 0.05) * rng.random((480, 5, 7)) * 60).astype("float32")
+
+    np.save(tmp_path / "cube.npy", cube)
+
+    times = (np.datetime64('2001-06-01T00:00') + np.arange(len(cube)) * np.timedelta64(30, 'm'))[steps]
+
+    mapped = np.load(tmp_path / "cube.npy", mmap_mode='r')[steps]
+
+    args = (times, from_origin(0, 5, 1, 1), 'EPSG:4326')
+
+    expected = rfactor_grid(cube[steps], *args, str(tmp_path / "array"), tile_size=3, n_workers=1)
+
+    result = rfactor_grid(mapped, *args, str(tmp_path / "memmap"), tile_size=3, n_workers=2)
+
+    for expected_tif, result_tif in zip(expected, result):
+
+        with rasterio.open(expected_tif) as expected_src, rasterio.open(result_tif) as result_src:
+
+            np.testing.assert_array_equal(result_src.read(), expected_src.read())
+
+
+def rfactor_rasters(paths):
+
+    arrays = []
+
+    for path in paths:
+
+        with rasterio.open(path) as src:
+
+            arrays.append(src.read())
+
+    return arrays
+
+
+def test_rfactor_grid_incremental_update(tmp_path):
+
+    # Mid-year split inside a storm, in two calls sharing one state_dir and with different workers
+    rng = np.random.default_rng(1)
+
+    times = np.arange(np.datetime64('2001-05-01T00:00'), np.datetime64('2002-03-01T00:00'), np.timedelta64(30, 'm'))
+
+    cube = ((rng.random((len(times), 5, 7)) < 0.02) * rng.gamma(0.7, 20.0, (len(times), 5, 7))).astype("float32")
+
+    split = int(np.searchsorted(times, np.datetime64('2001-07-02T12:00')))
+
+    cube[split - 4:split + 4, 1:4, 2:5] = 30
+
+    cube[split + 100:split + 300, 4, 6] = np.nan
+
+    args = (from_origin(0, 5, 1, 1), 'EPSG:4326')
+
+    full = rfactor_grid(cube, times, *args, str(tmp_path / "full"), tile_size=3, n_workers=1, chunk_steps=1000)
+
+    state_dir = str(tmp_path / "state")
+
+    rfactor_grid(cube[:split], times[:split], *args, str(tmp_path / "update"), tile_size=3, n_workers=1,
+
+                 chunk_steps=1000, state_dir=state_dir)
+
+    updated = rfactor_grid(cube[split:], times[split:], *args, str(tmp_path / "update"), tile_size=3, n_workers=2,
+
+                           chunk_steps=700, state_dir=state_dir)
+
+    assert [path.replace('update', 'full') for path in updated] == list(full)
+
+    for expected, result in zip(rfactor_rasters(full), rfactor_rasters(updated)):
+
+        np.testing.assert_array_equal(result, expected)
+
+    # Steps already in the state are rejected, and the state and rasters are left as they were
+    with pytest.raises(ValueError, match="already covers"):
+
+        rfactor_grid(cube[split:], times[split:], *args, str(tmp_path / "update"), tile_size=3, n_workers=1,
+
+                     state_dir=state_dir)
+
+    for expected, result in zip(rfactor_rasters(full), rfactor_rasters(updated)):
+
+        np.testing.assert_array_equal(result, expected)
@@ -0,0 +1,103 @@
+import io
+from contextlib import redirect_stdout
+import numpy as np
+import pytest
+from joblib import Parallel
+from sklearn.model_selection import cross_val_score
+import GPR
+from GPR import GPRModel, _Budget
+
+
+@pytest.fixture
+def model():
+
+    rng = np.random.default_rng(0)
+
+    X = rng.random((100, 3))
+
+    return GPRModel(X, X @ [3, 1, 2] + rng.normal(0, 0.1, 100))
+
+
+@pytest.fixture
+def eigh_calls(monkeypatch):
+
+    # Counts the eigendecompositions of fold kernel matrices, starting from an empty factor cache
+    calls = []
+
+    eigh = np.linalg.eigh
+
+    def counting_eigh(matrix):
+
+        calls.append(len(matrix))
+
+        return eigh(matrix)
+
+    monkeypatch.setattr(np.linalg, 'eigh', counting_eigh)
+
+    GPR._FOLD_FACTORS.clear()
+
+    GPR._FOLD_DISTANCES.clear()
+
+    return calls
+
+
+def cv_scores(model, params):
+
+    return [cross_val_score(model.regressor(**point), model.X_train, model.y_train, cv=model.folds, scoring='r2')
+
+            for point in params]
+
+
+def test_fixed_kernel_scores_reuse_fold_factors(model, eigh_calls):
+
+    model.fixed_kernel = True
+
+    n_folds = len(model.folds)
+
+    # Ten alphas on each of two length scales: one eigendecomposition per length scale and fold
+    params = [{'length_scale': length_scale, 'alpha': alpha} for length_scale in (0.5, 2.0) for alpha in np.logspace(-2, 0, 10)]
+
+    with Parallel(n_jobs=1) as parallel:
+
+        scores = model._cross_validate(parallel, params, model.X_train, model.y_train, model.folds, _Budget(), False, 3, 'data')
+
+        assert len(eigh_calls) == 2 * n_folds
+
+        np.testing.assert_allclose(scores, cv_scores(model, params), rtol=1e-6)
+
+        # A later batch with a few new alphas on a known length scale reuses the cached factors
+        later = [{'length_scale': 0.5, 'alpha': alpha} for alpha in (0.05, 0.3)]
+
+        later_scores = model._cross_validate(parallel, later, model.X_train, model.y_train, model.folds, _Budget(), False, 3, 'data')
+
+    assert len(eigh_calls) == 2 * n_folds
+
+    np.testing.assert_allclose(later_scores, cv_scores(model, later), rtol=1e-6)
+
+
+def test_fixed_kernel_scores_without_shared_length_scales(model, eigh_calls):
+
+    # Candidates with their own length scale are scored by Cholesky factorizations
+    model.fixed_kernel = True
+
+    params = [{'length_scale': length_scale, 'alpha': 0.1} for length_scale in np.linspace(0.3, 3, 5)]
+
+    with Parallel(n_jobs=1) as parallel:
+
+        scores = model._cross_validate(parallel, params, model.X_train, model.y_train, model.folds, _Budget(), False, 3, 'data')
+
+    assert not eigh_calls
+
+    np.testing.assert_allclose(scores, cv_scores(model, params), rtol=1e-6)
+
+
+def test_search_groups_length_scales_across_the_batch(model, eigh_calls):
+
+    # With one worker the candidates sharing a rounded length scale are still scored together
+    with redirect_stdout(io.StringIO()):
+
+        model.optimize_hyperparameters(init_points=60, n_iter=0, log_space=True, fixed_kernel=True, length_scale_resolution=2)
+
+    shared = model.search_history['length_scale'].value_counts()
+
+    assert len(eigh_calls) == (shared >= GPR._EIGEN_MIN_ALPHAS).sum() * len(model.folds) > 0
@@ -0,0 +1,316 @@
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+import MetricsCalculator
+from MetricsCalculator import MetCalculator, METRIC_COLUMNS
+
+
+def write_raster(path, values, transform, nodata=None, block_size=16):
+
+    profile = {'driver': 'GTiff', 'width': values.shape[1], 'height': values.shape[0], 'count': 1, 'dtype': values.dtype,
+
+               'crs': 'EPSG:4326', 'transform': transform, 'nodata': nodata, 'tiled': True,
+
+               'blockxsize': block_size, 'blockysize': block_size}
+
+    with rasterio.open(path, 'w', **profile) as dst:
+
+        dst.write(values, 1)
+
+    return str(path)
+
+
+def baseline_idw(df, tif_file, nodata_value):
+
+    # Per-station loop of the original inverse_distance_weighted
+    values = np.full(len(df), np.nan)
+
+    with rasterio.open(tif_file) as src:
+
+        tiff_array = src.read(1).astype("float")
+
+        tiff_array[tiff_array < nodata_value] = np.nan
+
+        transform = src.transform
+
+        for index, (lat, lon) in enumerate(zip(df['Lat'], df['Lon'])):
+
+            col, row = ~transform * (lon, lat)
+
+            col, row = int(round(col)), int(round(row))
+
+            pixel_values, distances = [], []
+
+            for r in range(row - 1, row + 2):
+
+                for c in range(col - 1, col + 2):
+
+                    if 0 <= r < tiff_array.shape[0] and 0 <= c < tiff_array.shape[1] and not np.isnan(tiff_array[r, c]):
+
+                        pixel_values.append(tiff_array[r, c])
+
+                        pixel_lat, pixel_lon = transform * (c, r)
+
+                        distances.append(np.sqrt((lat - pixel_lat) ** 2 + (lon - pixel_lon) ** 2))
+
+            if pixel_values:
+
+                values[index] = np.average(pixel_values, weights=[1 / distance for distance in distances])
+
+    return values
+
+
+@pytest.fixture
+def idw_raster(tmp_path):
+
+    # Regional 40 x 60 grid of 0.25 degrees with scattered no data and a 5 x 5 hole
+    rng = np.random.default_rng(0)
+
+    values = rng.uniform(1, 5000, (40, 60)).astype("float32")
+
+    values[rng.random(values.shape) < 0.1] = -9999
+
+    values[10:15, 20:25] = -9999
+
+    return write_raster(tmp_path / "r.tif", values, from_origin(10, 50, 0.25, 0.25), nodata=-9999)
+
+
+@pytest.mark.parametrize("windowed", [False, True])
+def test_inverse_distance_weighted_matches_baseline(idw_raster, windowed):
+
+    rng = np.random.default_rng(1)
+
+    lat = np.concatenate((rng.uniform(40.2, 49.8, 300), [46.9, 49.95, 40.05]))
+
+    lon = np.concatenate((rng.uniform(10.2, 24.8, 300), [15.6, 10.05, 24.95]))
+
+    df = pd.DataFrame({'Lat': lat, 'Lon': lon})
+
+    expected = baseline_idw(df, idw_raster, 0)
+
+    result = MetCalculator().inverse_distance_weighted(df.copy(), idw_raster, 'R', 0, windowed=windowed)['R'].values
+
+    # The station in the middle of the hole has no valid neighbour
+    assert np.isnan(expected[300]) and np.isnan(result[300])
+
+    assert np.isnan(expected).sum() >= 1
+
+    np.testing.assert_allclose(result, expected, rtol=1e-12)
+
+
+@pytest.fixture
+def station_values():
+
+    # Three groups of unequal size with an all-positive reference, as the percentage bias needs
+    rng = np.random.default_rng(2)
+
+    observed = pd.Series(rng.uniform(100, 3000, 150))
+
+    predicted = pd.Series(observed * rng.normal(1.05, 0.2, 150))
+
+    groups = pd.Series(np.repeat(['Africa', 'Asia', 'Europe'], [30, 80, 40]), name='Continent')
+
+    return observed, predicted, groups
+
+
+@pytest.mark.parametrize("grouped", [False, True])
+def test_bootstrap_independent_of_jobs_and_batches(monkeypatch, station_values, grouped):
+
+    observed, predicted, groups = station_values
+
+    codes, labels = pd.factorize(groups if grouped else np.zeros(len(groups)), sort=True)
+
+    calculator = MetCalculator()
+
+    expected = calculator.bootstrap_intervals(observed, predicted, codes, len(labels), 200, random_state=7)
+
+    parallel = calculator.bootstrap_intervals(observed, predicted, codes, len(labels), 200, random_state=7, n_jobs=2)
+
+    # Batches of 6 resamples instead of a single batch
+    monkeypatch.setattr(MetricsCalculator, 'BOOTSTRAP_BATCH_VALUES', 6 * len(observed))
+
+    batched = calculator.bootstrap_intervals(observed, predicted, codes, len(labels), 200, random_state=7)
+
+    other_seed = calculator.bootstrap_intervals(observed, predicted, codes, len(labels), 200, random_state=8)
+
+    for name in METRIC_COLUMNS:
+
+        assert expected[name][0].shape == (len(labels), 1)
+
+        assert np.all(expected[name][0] <= expected[name][1])
+
+        for result in (parallel, batched):
+
+            np.testing.assert_array_equal(result[name][0], expected[name][0])
+
+            np.testing.assert_array_equal(result[name][1], expected[name][1])
+
+    assert not np.array_equal(other_seed['NSE'][0], expected['NSE'][0])
+
+
+def test_bootstrap_keeps_point_estimates(station_values):
+
+    observed, predicted, groups = station_values
+
+    calculator = MetCalculator()
+
+    metrics = calculator.grouped_metrics(observed, predicted, groups, n_bootstrap=200, random_state=0)
+
+    pd.testing.assert_frame_equal(metrics[METRIC_COLUMNS], calculator.grouped_metrics(observed, predicted, groups))
+
+    # Without groups every row belongs to the single product column
+    products = calculator.product_metrics(observed, predicted.to_frame('P'), n_bootstrap=200, random_state=0)
+
+    pd.testing.assert_frame_equal(products[METRIC_COLUMNS], calculator.product_metrics(observed, predicted.to_frame('P')))
+
+    mean_bias, std_bias, ubrmse = calculator.ubrmse(observed, predicted)
+
+    np.testing.assert_allclose(products.loc['P', ['Mean Percent Bias', 'Std Percent Bias', 'ubRMSE', 'NSE', 'Correlation Coefficient']],
+
+                               [mean_bias, std_bias, ubrmse, calculator.nse(observed, predicted), calculator.correlation(observed, predicted)], rtol=1e-10)
+
+    for frame in (metrics, products):
+
+        for name in METRIC_COLUMNS:
+
+            assert np.all(frame[f'{name} Lower'] <= frame[f'{name} Upper'])
+
+
+# Series.corr of the single-row group warns about its degrees of freedom
+@pytest.mark.filterwarnings("ignore:Degrees of freedom")
+def test_grouped_metrics_match_per_group_calls():
+
+    rng = np.random.default_rng(3)
+
+    observed = pd.Series(rng.uniform(100, 3000, 60))
+
+    predicted = pd.Series(observed * rng.normal(1, 0.2, 60))
+
+    # A single-row group, a constant reference (NSE denominator 0) and groups with missing values
+    groups = pd.Series(np.repeat(['Af', 'Am', 'BSh', 'Cfa', 'ET'], [15, 1, 8, 30, 6]))
+
+    observed[16:24] = 500.0
+
+    observed[[30, 41]] = np.nan
+
+    predicted[[35, 41, 55]] = np.nan
+
+    observed[[54, 56]] = np.nan
+
+    calculator = MetCalculator()
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+
+        metrics = calculator.grouped_metrics(observed, predicted, groups)
+
+        for label, group in groups.groupby(groups).groups.items():
+
+            rows = group[observed[group].notna() & predicted[group].notna()]
+
+            mean_bias, std_bias, ubrmse = calculator.ubrmse(observed[rows], predicted[rows])
+
+            expected = [mean_bias, std_bias, calculator.nse(observed[rows], predicted[rows]),
+
+                        calculator.correlation(observed[rows], predicted[rows]), ubrmse]
+
+            np.testing.assert_allclose(metrics.loc[label, METRIC_COLUMNS].astype("float"), expected, rtol=1e-9, atol=1e-9)
+
+    assert metrics.loc['BSh', 'NSE'] == -np.inf and np.isnan(metrics.loc['Am', 'Correlation Coefficient'])
+
+    assert np.isfinite(metrics.loc[['Cfa', 'ET'], METRIC_COLUMNS].values).all()
+
+
+@pytest.mark.parametrize("reference_first", [True, False])
+def test_product_metrics_match_grouped_metrics(station_values, reference_first):
+
+    observed, predicted, _ = station_values
+
+    rng = np.random.default_rng(4)
+
+    products = pd.DataFrame({'GloRESatE': predicted, 'ERA5Land': observed * rng.normal(0.9, 0.3, len(observed)),
+
+                             'IMERGFinalRun': observed + rng.normal(0, 400, len(observed))})
+
+    # Missing values of one product leave the pairs of the others complete
+    products.loc[[3, 70, 71], 'ERA5Land'] = np.nan
+
+    calculator = MetCalculator()
+
+    if reference_first:
+
+        metrics = calculator.product_metrics(observed, products)
+
+    else:
+
+        # Several references against one product, e.g. station series against a gridded estimate
+        metrics = calculator.product_metrics(products, observed)
+
+    assert list(metrics.index) == list(products.columns)
+
+    single_group = np.zeros(len(observed))
+
+    for name, values in products.items():
+
+        reference, product = (observed, values) if reference_first else (values, observed)
+
+        expected = calculator.grouped_metrics(reference, product, single_group)
+
+        np.testing.assert_allclose(metrics.loc[name, METRIC_COLUMNS].astype("float"), expected.iloc[0].astype("float"), rtol=1e-10)
+
+
+@pytest.mark.parametrize("resampling", ['nearest', 'bilinear', 'average'])
+def test_raster_metrics_on_other_grids(tmp_path, resampling):
+
+    from GridAlignment import raster_grid, read_aligned
+
+    rng = np.random.default_rng(5)
+
+    # Reference on a 0.5 degree grid, product on a coarser 1 degree grid and zones on an offset 0.5 degree grid
+    observed = rng.uniform(100, 3000, (30, 40)).astype("float32")
+
+    observed[rng.random(observed.shape) < 0.05] = -9999
+
+    predicted = rng.uniform(100, 3000, (17, 22)).astype("float32")
+
+    predicted[2:4, 5:8] = -9999
+
+    zones = rng.integers(0, 4, (31, 41)).astype("uint8")
+
+    observed_tif = write_raster(tmp_path / "observed.tif", observed, from_origin(0, 30, 0.5, 0.5), nodata=-9999)
+
+    predicted_tif = write_raster(tmp_path / "predicted.tif", predicted, from_origin(-0.75, 30.6, 1, 1), nodata=-9999)
+
+    zones_tif = write_raster(tmp_path / "zones.tif", zones, from_origin(-0.25, 30.25, 0.5, 0.5), nodata=0)
+
+    zone_names = {1: 'Arid', 2: 'Temperate'}
+
+    calculator = MetCalculator()
+
+    metrics = calculator.raster_metrics(observed_tif, predicted_tif, 0, zones_tif, zone_names, tile_size=16, n_workers=2,
+
+                                        resampling=resampling)
+
+    # The whole rasters aligned at once onto the reference grid
+    grid = raster_grid(observed_tif)
+
+    reference = read_aligned(observed_tif, grid).ravel()
+
+    product = read_aligned(predicted_tif, grid, resampling=resampling).ravel()
+
+    zone = read_aligned(zones_tif, grid).ravel()
+
+    valid = (reference >= 0) & (product >= 0) & np.isin(zone, list(zone_names))
+
+    expected = calculator.grouped_metrics(reference[valid], product[valid], pd.Series(zone[valid]).map(zone_names))
+
+    assert list(metrics.index) == list(expected.index)
+
+    assert list(metrics['Pixels']) == list(pd.Series(zone[valid]).map(zone_names).value_counts().sort_index())
+
+    np.testing.assert_allclose(metrics[METRIC_COLUMNS].astype("float"), expected.astype("float"), rtol=1e-9)
+
+    with pytest.raises(ValueError, match="not on the grid"):
+
+        calculator.raster_metrics(observed_tif, predicted_tif, 0)
@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+from PrecipitationReader import stream_precipitation, grid_shape
+
+# North-up reference grid: 4 latitudes from north to south, 6 longitudes from west to east, 5 time steps
+LATS = np.array([67.5, 22.5, -22.5, -67.5])
+
+LONS = np.array([-150., -90., -30., 30., 90., 150.])
+
+CUBE = np.arange(5 * 4 * 6, dtype="float32").reshape(5, 4, 6)
+
+
+def write_imerg_hdf5(path, cube):
+
+    # IMERG layout: (time, lon, lat) with the latitudes from south to north and attached dimension scales
+    h5py = pytest.importorskip("h5py")
+
+    with h5py.File(path, 'w') as dst:
+
+        grid = dst.create_group('Grid')
+
+        for name, values in (('time', np.arange(len(cube))), ('lon', LONS), ('lat', LATS[::-1])):
+
+            grid[name] = values
+
+            grid[name].make_scale(name)
+
+        grid['precipitation'] = cube[:, ::-1, :].transpose(0, 2, 1)
+
+        for axis, name in enumerate(('time', 'lon', 'lat')):
+
+            grid['precipitation'].dims[axis].attach_scale(grid[name])
+
+
+def write_imerg_netcdf(path, cube):
+
+    netCDF4 = pytest.importorskip("netCDF4")
+
+    with netCDF4.Dataset(path, 'w') as dst:
+
+        for name, values in (('time', np.arange(len(cube))), ('lon', LONS), ('lat', LATS[::-1])):
+
+            dst.createDimension(name, len(values))
+
+            dst.createVariable(name, 'f8', (name,))[:] = values
+
+        dst.createVariable('precipitation', 'f4', ('time', 'lon', 'lat'))[:] = cube[:, ::-1, :].transpose(0, 2, 1)
+
+
+@pytest.fixture(params=['h5', 'nc4'])
+def imerg_file(request, tmp_path):
+
+    path = str(tmp_path / f"imerg.{request.param}")
+
+    (write_imerg_hdf5 if request.param == 'h5' else write_imerg_netcdf)(path, CUBE)
+
+    return path
+
+
+def test_imerg_grid_shape(imerg_file):
+
+    assert tuple(grid_shape(imerg_file, 'precipitation' if imerg_file.endswith('.nc4') else 'Grid/precipitation')) == (4, 6)
+
+
+@pytest.mark.parametrize("window", [None, (1, 2, 2, 3), (0, 5, 4, 1)])
+def test_imerg_blocks_are_north_up(imerg_file, window):
+
+    variable = 'precipitation' if imerg_file.endswith('.nc4') else 'Grid/precipitation'
+
+    blocks = list(stream_precipitation(imerg_file, 2, variable=variable, window=window))
+
+    row_off, col_off, height, width = window or (0, 0, 4, 6)
+
+    expected = CUBE[:, row_off:row_off + height, col_off:col_off + width]
+
+    assert [len(block) for block in blocks] == [2, 2, 1]
+
+    np.testing.assert_array_equal(np.concatenate(blocks), expected)
+
+
+def test_single_step_files_are_north_up(tmp_path):
+
+    # Half-hourly IMERG files hold one time step each
+    paths = []
+
+    for step in range(len(CUBE)):
+
+        paths.append(str(tmp_path / f"imerg_{step}.h5"))
+
+        write_imerg_hdf5(paths[-1], CUBE[step:step + 1])
+
+    blocks = list(stream_precipitation(paths, 3, variable='Grid/precipitation', window=(2, 1, 2, 4)))
+
+    np.testing.assert_array_equal(np.concatenate(blocks), CUBE[:, 2:4, 1:5])
+
+
+def test_unlabelled_dataset_is_read_as_stored(tmp_path):
+
+    h5py = pytest.importorskip("h5py")
+
+    path = str(tmp_path / "cube.h5")
+
+    with h5py.File(path, 'w') as dst:
+
+        dst['precipitation'] = CUBE
+
+    assert tuple(grid_shape(path, 'precipitation')) == (4, 6)
+
+    np.testing.assert_array_equal(np.concatenate(list(stream_precipitation(path, 5, variable='precipitation'))), CUBE)